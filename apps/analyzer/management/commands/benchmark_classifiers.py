@@ -0,0 +1,78 @@
+import time
+import random
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from apps.analyzer.models import MClassifierFeed, MClassifierAuthor, MClassifierTitle, MClassifierTag
+from apps.analyzer.models import ClassifierMatcher, compute_story_score
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-c", "--classifiers", dest="classifiers", type='int', default=500),
+        make_option("-s", "--stories", dest="stories", type='int', default=500),
+        make_option("-f", "--feeds", dest="feeds", type='int', default=20),
+    )
+
+    def handle(self, *args, **options):
+        random.seed(1)
+        words = ["apple", "bridge", "cloud", "delta", "engine", "forest", "garden", "harbor",
+                 "island", "jungle", "kettle", "lantern", "meadow", "needle", "orchard",
+                 "python", "quartz", "river", "summit", "tunnel", "Umbrella", "Valley"]
+        feed_ids = range(1, options['feeds'] + 1)
+        scores = [-1, 1]
+
+        def phrase(length):
+            return " ".join(random.choice(words) for _ in range(length))
+
+        classifiers = dict(feeds=[], authors=[], titles=[], tags=[])
+        for i in range(options['classifiers']):
+            feed_id = random.choice(feed_ids)
+            kind = i % 4
+            if kind == 0:
+                classifiers['titles'].append(MClassifierTitle(feed_id=feed_id, score=random.choice(scores),
+                                                              title=phrase(random.randint(1, 2))))
+            elif kind == 1:
+                classifiers['authors'].append(MClassifierAuthor(feed_id=feed_id, score=random.choice(scores),
+                                                                author=phrase(2)))
+            elif kind == 2:
+                classifiers['tags'].append(MClassifierTag(feed_id=feed_id, score=random.choice(scores),
+                                                          tag=random.choice(words)))
+            else:
+                classifiers['feeds'].append(MClassifierFeed(feed_id=feed_id, score=random.choice(scores)))
+
+        stories = []
+        for i in range(options['stories']):
+            stories.append({
+                'story_feed_id': random.choice(feed_ids),
+                'story_title': phrase(random.randint(4, 12)).title(),
+                'story_authors': phrase(2) if i % 3 else "",
+                'story_tags': random.sample(words, random.randint(0, 4)),
+            })
+
+        start = time.time()
+        legacy_scores = [compute_story_score(story,
+                                             classifier_titles=classifiers['titles'],
+                                             classifier_authors=classifiers['authors'],
+                                             classifier_tags=classifiers['tags'],
+                                             classifier_feeds=classifiers['feeds'])
+                         for story in stories]
+        legacy_time = time.time() - start
+
+        start = time.time()
+        matcher = ClassifierMatcher(classifier_feeds=classifiers['feeds'],
+                                    classifier_authors=classifiers['authors'],
+                                    classifier_titles=classifiers['titles'],
+                                    classifier_tags=classifiers['tags'])
+        compile_time = time.time() - start
+        matched_scores = matcher.score_stories(stories)
+        matcher_time = time.time() - start
+
+        print " ---> %s classifiers x %s stories" % (options['classifiers'], len(stories))
+        print " ---> compute_story_score: %.4f sec" % legacy_time
+        print " ---> ClassifierMatcher:   %.4f sec (%.4f compiling, %.1fx)" % (
+            matcher_time, compile_time, legacy_time / max(matcher_time, .000001))
+        mismatches = [i for i, (a, b) in enumerate(zip(legacy_scores, matched_scores)) if a != b]
+        if mismatches:
+            print " ***> %s scores differ, first at story %s" % (len(mismatches), mismatches[0])
+        else:
+            print " ---> All %s scores identical." % len(stories)
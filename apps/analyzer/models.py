@@ -1,3 +1,4 @@
+import re
 import mongoengine as mongo
 from collections import defaultdict
 from django.db import models
@@ -177,6 +178,116 @@ def apply_classifier_feeds(classifiers, feed, social_user_ids=None):
             return classifier.score
     return 0
     
+class ClassifierMatcher(object):
+    """
+    A user's classifiers bucketed by feed and compiled once, so a batch of stories
+    can be scored without rescanning every classifier for every story. Gives the
+    same scores as the apply_classifier_* functions and compute_story_score.
+    """
+    
+    def __init__(self, classifier_feeds=None, classifier_authors=None,
+                 classifier_titles=None, classifier_tags=None):
+        self.feeds = {}
+        for classifier in classifier_feeds or []:
+            self.feeds.setdefault(classifier.feed_id, classifier.score)
+        
+        authors = defaultdict(lambda: defaultdict(list))
+        for classifier in classifier_authors or []:
+            authors[classifier.feed_id][classifier.author].append(classifier.score)
+        self.authors = dict((feed_id, dict((author, self._matched_score(scores))
+                                           for author, scores in feed_authors.items()))
+                            for feed_id, feed_authors in authors.items())
+        
+        self.tags = defaultdict(lambda: {'classifiers': [], 'positions': defaultdict(list)})
+        for classifier in classifier_tags or []:
+            feed_tags = self.tags[classifier.feed_id]
+            feed_tags['positions'][classifier.tag].append(len(feed_tags['classifiers']))
+            feed_tags['classifiers'].append(classifier)
+        self.tags = dict(self.tags)
+        
+        titles = defaultdict(list)
+        for classifier in classifier_titles or []:
+            titles[classifier.feed_id].append((classifier.title.lower(), classifier.score))
+        self.titles = {}
+        for feed_id, feed_titles in titles.items():
+            self.titles[feed_id] = {
+                'pattern': re.compile('|'.join(re.escape(title) for title, _ in feed_titles), re.UNICODE),
+                'positive': [(title, score) for title, score in feed_titles if score > 0],
+                'others': [(title, score) for title, score in reversed(feed_titles) if score <= 0],
+            }
+    
+    @staticmethod
+    def _matched_score(scores):
+        # The first positive match wins, otherwise the last match does.
+        for score in scores:
+            if score > 0:
+                return score
+        return scores[-1] if scores else 0
+        
+    def feed_score(self, feed_id):
+        if not feed_id: return 0
+        return self.feeds.get(feed_id, 0)
+    
+    def author_score(self, story):
+        feed_authors = self.authors.get(story['story_feed_id'])
+        if not feed_authors or not story.get('story_authors'):
+            return 0
+        return feed_authors.get(story['story_authors'], 0)
+    
+    def tags_score(self, story):
+        feed_tags = self.tags.get(story['story_feed_id'])
+        story_tags = story['story_tags']
+        if not feed_tags or not story_tags:
+            return 0
+        if not isinstance(story_tags, (list, tuple)):
+            return apply_classifier_tags(feed_tags['classifiers'], story)
+        
+        positions = []
+        for tag in set(story_tags):
+            positions.extend(feed_tags['positions'].get(tag, []))
+        positions.sort()
+        return self._matched_score([feed_tags['classifiers'][p].score for p in positions])
+    
+    def title_score(self, story):
+        feed_titles = self.titles.get(story['story_feed_id'])
+        if not feed_titles:
+            return 0
+        story_title = story['story_title'].lower()
+        if not feed_titles['pattern'].search(story_title):
+            return 0
+        for title, score in feed_titles['positive']:
+            if title in story_title:
+                return score
+        for title, score in feed_titles['others']:
+            if title in story_title:
+                return score
+        return 0
+    
+    def intelligence(self, story):
+        return {
+            'feed': self.feed_score(story['story_feed_id']),
+            'author': self.author_score(story),
+            'tags': self.tags_score(story),
+            'title': self.title_score(story),
+        }
+    
+    def score(self, story):
+        intelligence = self.intelligence(story)
+        score_max = max(intelligence['title'],
+                        intelligence['author'],
+                        intelligence['tags'])
+        score_min = min(intelligence['title'],
+                        intelligence['author'],
+                        intelligence['tags'])
+        if score_max > 0:
+            return score_max
+        elif score_min < 0:
+            return score_min
+        return intelligence['feed']
+    
+    def score_stories(self, stories):
+        return [self.score(story) for story in stories]
+    
 def get_classifiers_for_user(user, feed_id=None, social_user_id=None, classifier_feeds=None, classifier_authors=None, 
                              classifier_titles=None, classifier_tags=None):
     params = dict(user_id=user.pk)
@@ -0,0 +1,74 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from apps.rss_feeds.models import Feed, MStory, MStarredStory
+from apps.reader.models import UserSubscription
+from utils import json_functions as json
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-u", "--username", dest="username",
+                    help="Build feed list, river and starred hash responses from this user's data."),
+        make_option("-r", "--recorded", dest="recorded",
+                    help="File of recorded JSON responses, one per line, to re-encode."),
+        make_option("-n", "--repeat", dest="repeat", type='int', default=10,
+                    help="Times each response is encoded."),
+    )
+
+    def handle(self, *args, **options):
+        responses = []
+        if options['username']:
+            user = User.objects.get(username=options['username'])
+            responses.extend(self.user_responses(user))
+        if options['recorded']:
+            with open(options['recorded']) as recorded:
+                for r, line in enumerate(recorded):
+                    if line.strip():
+                        responses.append(("recorded #%s" % r, json.decode(line)))
+        if not responses:
+            print " ---> Give a --username and/or a --recorded file of responses."
+            return
+
+        totals = {'legacy': 0, 'encoder': 0, 'stream': 0}
+        mismatches = 0
+        for name, response in responses:
+            legacy = json.legacy_json_encode(response)
+            encoded = json.json_encode(response)
+            streamed = ''.join(json.json_iterencode(response))
+            same = legacy == encoded == streamed
+            if not same:
+                mismatches += 1
+
+            times = {}
+            for engine, encode in (('legacy', json.legacy_json_encode),
+                                   ('encoder', json.json_encode),
+                                   ('stream', lambda data: ''.join(json.json_iterencode(data)))):
+                start = time.time()
+                for _ in range(options['repeat']):
+                    encode(response)
+                times[engine] = (time.time() - start) / options['repeat']
+                totals[engine] += times[engine]
+
+            print " ---> %-20s %8s bytes: legacy %6.1f ms, encoder %6.1f ms, stream %6.1f ms%s" % (
+                name[:20], len(legacy), times['legacy'] * 1000, times['encoder'] * 1000,
+                times['stream'] * 1000, '' if same else ' ~~~> OUTPUT DIFFERS')
+
+        print " ---> %s responses, %s differing. Legacy %.1f ms, encoder %.1f ms (%.1fx), stream %.1f ms" % (
+            len(responses), mismatches, totals['legacy'] * 1000, totals['encoder'] * 1000,
+            totals['legacy'] / max(totals['encoder'], .000001), totals['stream'] * 1000)
+
+    def user_responses(self, user):
+        user_subs = UserSubscription.objects.select_related('feed').filter(user=user)
+        feeds = dict((sub.feed_id, sub.canonical(include_favicon=False)) for sub in user_subs)
+        yield "load_feeds", {'feeds': feeds, 'result': 'ok', 'authenticated': True, 'user_id': user.pk}
+
+        feed_ids = [sub.feed_id for sub in user_subs if sub.active]
+        mstories = MStory.objects(story_feed_id__in=feed_ids).order_by('-story_date')[:100]
+        stories = Feed.format_stories(mstories)
+        yield "river_stories", {'stories': stories, 'feeds': [], 'result': 'ok'}
+
+        mstarred = MStarredStory.objects(user_id=user.pk).only('story_hash', 'starred_date')
+        story_hashes = [(s.story_hash, s.starred_date.strftime("%s")) for s in mstarred]
+        yield "starred_story_hashes", {'starred_story_hashes': story_hashes, 'result': 'ok'}
@@ -0,0 +1,57 @@
+import re
+import datetime
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from apps.reader.models import RUserUnreadIndex
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-u", "--user", dest="user", nargs=1, help="Specify user id or username"),
+        make_option("-D", "--days", dest="days", nargs=1, default=1, type='int',
+                    help="Users seen in the last N days, when no user is given."),
+        make_option("-c", "--check", dest="check", action="store_true", default=False,
+                    help="Compare each index against its unread stories computed from scratch."),
+        make_option("-r", "--rebuild", dest="rebuild", action="store_true", default=False,
+                    help="Rebuild each index (after checking, if both are given)."),
+        make_option("-x", "--delete", dest="delete", action="store_true", default=False,
+                    help="Delete each index."),
+    )
+
+    def handle(self, *args, **options):
+        if options['user']:
+            if re.match(r"([0-9]+)", options['user']):
+                users = User.objects.filter(pk=int(options['user']))
+            else:
+                users = User.objects.filter(username=options['user'])
+        else:
+            users = User.objects.filter(profile__last_seen_on__gte=datetime.datetime.now()-datetime.timedelta(days=options['days'])).order_by('pk')
+        
+        user_count = users.count()
+        inconsistent = 0
+        for i, user in enumerate(users):
+            if options['check']:
+                missing, extra = RUserUnreadIndex.check(user.pk)
+                if missing is None:
+                    print " ---> %s has no unread index (%s/%s)" % (user.username, i+1, user_count)
+                elif missing or extra:
+                    inconsistent += 1
+                    print " ***> %s: %s missing, %s extra (%s/%s)" % (user.username, len(missing),
+                                                                     len(extra), i+1, user_count)
+                    for story_hash in list(missing)[:5]:
+                        print "      missing: %s" % story_hash
+                    for story_hash in list(extra)[:5]:
+                        print "      extra:   %s" % story_hash
+                else:
+                    print " ---> %s: consistent (%s/%s)" % (user.username, i+1, user_count)
+            if options['delete']:
+                RUserUnreadIndex.delete(user.pk)
+                print " ---> %s: deleted (%s/%s)" % (user.username, i+1, user_count)
+            if options['rebuild']:
+                feed_count = RUserUnreadIndex.build(user.pk)
+                print " ---> %s: rebuilt across %s feeds (%s/%s)" % (user.username, feed_count,
+                                                                    i+1, user_count)
+        
+        if options['check']:
+            print " ---> %s/%s indexes inconsistent" % (inconsistent, user_count)
@@ -2,6 +2,7 @@ import datetime
 import time
 import re
 import redis
+from collections import defaultdict
 from utils import log as logging
 from utils import json_functions as json
 from django.db import models, IntegrityError
@@ -14,8 +15,9 @@ from mongoengine.queryset import NotUniqueError
 from apps.reader.managers import UserSubscriptionManager
 from apps.rss_feeds.models import Feed, MStory, DuplicateFeed
 from apps.analyzer.models import MClassifierFeed, MClassifierAuthor, MClassifierTag, MClassifierTitle
-from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds, apply_classifier_authors, apply_classifier_tags
+from apps.analyzer.models import apply_classifier_feeds, ClassifierMatcher
 from utils.feed_functions import add_object_to_folder, chunks
+from utils.feed_functions import relative_timesince, seconds_timesince
 
 class UserSubscription(models.Model):
     """
@@ -71,6 +73,9 @@ class UserSubscription(models.Model):
             self.user_title = self.user_title[:user_title_max]
         try:
             super(UserSubscription, self).save(*args, **kwargs)
+            if settings.UNREAD_INDEX:
+                RUserUnreadIndex.update_subscription(self.user_id, self.feed_id, self.mark_read_date,
+                                                     active=self.active)
         except IntegrityError:
             duplicate_feeds = DuplicateFeed.objects.filter(duplicate_feed_id=self.feed_id)
             for duplicate_feed in duplicate_feeds:
@@ -81,6 +86,15 @@ class UserSubscription(models.Model):
                     break
             else:
                 if self: self.delete()
+        if settings.FEED_LIST_CACHE:
+            RUserFeedList.mark_changed(self.user_id, feed_id=self.feed_id)
+    
+    def delete(self, *args, **kwargs):
+        if settings.UNREAD_INDEX:
+            RUserUnreadIndex.remove_feed(self.user_id, self.feed_id)
+        if settings.FEED_LIST_CACHE:
+            RUserFeedList.mark_changed(self.user_id, feed_id=self.feed_id)
+        super(UserSubscription, self).delete(*args, **kwargs)
     
     @classmethod
     def subs_for_feeds(cls, user_id, feed_ids=None, read_filter="unread"):
@@ -109,6 +123,27 @@ class UserSubscription(models.Model):
         if not feed_ids and not across_all_feeds:
             return story_hashes
         
+        if (settings.UNREAD_INDEX and read_filter == 'unread' and not usersubs and 
+            (not feed_ids or len(feed_ids) > 1)):
+            usersubs = cls.subs_for_feeds(user_id, feed_ids=feed_ids, read_filter=read_filter)
+            feed_ids = [sub.feed_id for sub in usersubs]
+            if not feed_ids:
+                return story_hashes
+            if not RUserUnreadIndex.is_built(user_id, r=r):
+                RUserUnreadIndex.build(user_id, r=r)
+            indexed_story_hashes = RUserUnreadIndex.story_hashes(user_id, feed_ids=feed_ids, order=order,
+                                                                 include_timestamps=include_timestamps,
+                                                                 group_by_feed=True, r=r)
+            if indexed_story_hashes is not None:
+                # Feed by feed, in the same order as below.
+                for feed_id in feed_ids:
+                    hashes = indexed_story_hashes.get(feed_id, [])
+                    if group_by_feed:
+                        story_hashes[feed_id] = hashes
+                    else:
+                        story_hashes.extend(hashes)
+                return story_hashes
+        
         if not usersubs:
             usersubs = cls.subs_for_feeds(user_id, feed_ids=feed_ids, read_filter=read_filter)
             feed_ids = [sub.feed_id for sub in usersubs]
@@ -660,8 +695,8 @@ class UserSubscription(models.Model):
                                                     cutoff_date=self.user.profile.unread_cutoff)
         
             if not stories:
-                stories_db = MStory.objects(story_hash__in=unread_story_hashes)
-                stories = Feed.format_stories(stories_db, self.feed_id)
+                stories = MStory.scoring_stories(unread_story_hashes, feed_id=self.feed_id,
+                                                 sort=[('story_date', -1)])
         
             unread_stories = []
             for story in stories:
@@ -689,30 +724,18 @@ class UserSubscription(models.Model):
             # if not silent:
             #     logging.info(' ---> [%s]    Classifiers: %s (%s)' % (self.user, datetime.datetime.now() - now, classifier_feeds.count() + classifier_authors.count() + classifier_tags.count() + classifier_titles.count()))
             
-            scores = {
-                'feed': apply_classifier_feeds(classifier_feeds, self.feed),
-            }
+            classifier_matcher = ClassifierMatcher(classifier_feeds=classifier_feeds,
+                                                   classifier_authors=classifier_authors,
+                                                   classifier_titles=classifier_titles,
+                                                   classifier_tags=classifier_tags)
         
-            for story in unread_stories:
-                scores.update({
-                    'author' : apply_classifier_authors(classifier_authors, story),
-                    'tags'   : apply_classifier_tags(classifier_tags, story),
-                    'title'  : apply_classifier_titles(classifier_titles, story),
-                })
-            
-                max_score = max(scores['author'], scores['tags'], scores['title'])
-                min_score = min(scores['author'], scores['tags'], scores['title'])
-                if max_score > 0:
+            for score in classifier_matcher.score_stories(unread_stories):
+                if score > 0:
                     feed_scores['positive'] += 1
-                elif min_score < 0:
+                elif score < 0:
                     feed_scores['negative'] += 1
                 else:
-                    if scores['feed'] > 0:
-                        feed_scores['positive'] += 1
-                    elif scores['feed'] < 0:
-                        feed_scores['negative'] += 1
-                    else:
-                        feed_scores['neutral'] += 1
+                    feed_scores['neutral'] += 1
         else:
             unread_story_hashes = self.story_hashes(user_id=self.user_id, feed_ids=[self.feed_id],
                                                     usersubs=[self],
@@ -747,6 +770,184 @@ class UserSubscription(models.Model):
         
         return self
     
+    @classmethod
+    def calculate_feed_scores_for_subscribers(cls, feed, user_subs, stories=None, silent=True):
+        """
+        Recounts unreads for all of a feed's subscriptions in a single pass: one Redis
+        pipeline for every subscriber's read stories, one query per classifier type,
+        and UPDATEs grouped by the values they write. The counts are the same ones
+        `calculate_feed_scores()` writes for each subscription on its own.
+        """
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        now = datetime.datetime.now()
+        current_time = int(time.time() + 60*60*24)
+        
+        user_subs = [sub for sub in user_subs
+                     if sub.user.profile.last_seen_on >= sub.user.profile.unread_cutoff]
+        if not user_subs:
+            return []
+        
+        # Two weeks in age. If mark_read_date is older, mark old stories as read.
+        date_deltas = {}
+        for sub in user_subs:
+            date_delta = sub.user.profile.unread_cutoff
+            if date_delta < sub.mark_read_date:
+                date_delta = sub.mark_read_date
+            else:
+                sub.mark_read_date = date_delta
+            date_deltas[sub.pk] = date_delta
+        read_dates = dict((sub_id, int(date_delta.strftime('%s')))
+                          for sub_id, date_delta in date_deltas.items())
+        
+        pipeline = r.pipeline()
+        pipeline.smembers('F:%s' % feed.pk)
+        pipeline.zrevrangebyscore('zF:%s' % feed.pk, current_time - 1, min(read_dates.values()),
+                                  withscores=True)
+        for sub in user_subs:
+            pipeline.smembers('RS:%s:%s' % (sub.user_id, feed.pk))
+        results = pipeline.execute()
+        feed_story_hashes = results[0]
+        # +1 for the intersection b/w zF and F, which carries an implicit score of 1.
+        ranked_story_hashes = [(story_hash, score + 1) for story_hash, score in results[1]
+                               if story_hash in feed_story_hashes]
+        read_story_hashes = dict((sub.pk, results[2+i]) for i, sub in enumerate(user_subs))
+        
+        unread_story_hashes = {}
+        for sub in user_subs:
+            min_score = read_dates[sub.pk] + 1
+            read_hashes = read_story_hashes[sub.pk]
+            unread_story_hashes[sub.pk] = [(story_hash, score) for story_hash, score in ranked_story_hashes
+                                           if score >= min_score and story_hash not in read_hashes]
+        
+        trained_user_ids = [sub.user_id for sub in user_subs if sub.is_trained]
+        classifiers = defaultdict(lambda: defaultdict(list))
+        if trained_user_ids:
+            for classifier_type, classifier_cls, params in (('feeds', MClassifierFeed, dict(social_user_id=0)),
+                                                            ('authors', MClassifierAuthor, {}),
+                                                            ('titles', MClassifierTitle, {}),
+                                                            ('tags', MClassifierTag, {})):
+                for classifier in classifier_cls.objects(user_id__in=trained_user_ids,
+                                                         feed_id=feed.pk, **params):
+                    classifiers[classifier.user_id][classifier_type].append(classifier)
+            
+            if not stories:
+                stories = cache.get('S:%s' % feed.pk)
+            if not stories:
+                story_hashes = set()
+                for sub in user_subs:
+                    if sub.is_trained:
+                        story_hashes.update(h for h, _ in unread_story_hashes[sub.pk])
+                stories = list(MStory.scoring_stories(story_hashes, feed_id=feed.pk,
+                                                      sort=[('story_date', -1)]))
+        
+        updates = defaultdict(list)
+        for sub in user_subs:
+            feed_scores = dict(negative=0, neutral=0, positive=0)
+            oldest_unread_story_date = now
+            ong = sub.unread_count_negative
+            ont = sub.unread_count_neutral
+            ops = sub.unread_count_positive
+            
+            if sub.is_trained:
+                date_delta = date_deltas[sub.pk]
+                unread_hashes = set(h for h, _ in unread_story_hashes[sub.pk])
+                unread_stories = []
+                for story in stories:
+                    if story['story_date'] < date_delta:
+                        continue
+                    if story['story_hash'] in unread_hashes:
+                        unread_stories.append(story)
+                        if story['story_date'] < oldest_unread_story_date:
+                            oldest_unread_story_date = story['story_date']
+                
+                user_classifiers = classifiers[sub.user_id]
+                if not any(user_classifiers.values()):
+                    sub.is_trained = False
+                
+                if (not user_classifiers['authors'] and
+                    not user_classifiers['titles'] and
+                    not user_classifiers['tags']):
+                    # Every story falls through to the feed classifier.
+                    feed_score = apply_classifier_feeds(user_classifiers['feeds'], feed)
+                    if feed_score > 0:
+                        feed_scores['positive'] = len(unread_stories)
+                    elif feed_score < 0:
+                        feed_scores['negative'] = len(unread_stories)
+                    else:
+                        feed_scores['neutral'] = len(unread_stories)
+                else:
+                    classifier_matcher = ClassifierMatcher(classifier_feeds=user_classifiers['feeds'],
+                                                           classifier_authors=user_classifiers['authors'],
+                                                           classifier_titles=user_classifiers['titles'],
+                                                           classifier_tags=user_classifiers['tags'])
+                    for score in classifier_matcher.score_stories(unread_stories):
+                        if score > 0:
+                            feed_scores['positive'] += 1
+                        elif score < 0:
+                            feed_scores['negative'] += 1
+                        else:
+                            feed_scores['neutral'] += 1
+            else:
+                unread_hashes = unread_story_hashes[sub.pk]
+                feed_scores['neutral'] = len(unread_hashes)
+                if feed_scores['neutral']:
+                    oldest_unread_story_date = datetime.datetime.fromtimestamp(unread_hashes[-1][1])
+            
+            if not silent or settings.DEBUG:
+                logging.user(sub.user, '~FBUnread count (~SB%s~SN%s): ~SN(~FC%s~FB/~FC%s~FB/~FC%s~FB) ~SBto~SN (~FC%s~FB/~FC%s~FB/~FC%s~FB)' % (sub.feed_id, '/~FMtrained~FB' if sub.is_trained else '', ong, ont, ops, feed_scores['negative'], feed_scores['neutral'], feed_scores['positive']))
+            
+            sub.unread_count_positive = feed_scores['positive']
+            sub.unread_count_neutral = feed_scores['neutral']
+            sub.unread_count_negative = feed_scores['negative']
+            sub.unread_count_updated = now
+            sub.oldest_unread_story_date = oldest_unread_story_date
+            sub.needs_unread_recalc = False
+            updates[(sub.unread_count_positive, sub.unread_count_neutral, sub.unread_count_negative,
+                     sub.oldest_unread_story_date, sub.mark_read_date, sub.is_trained)].append(sub.pk)
+        
+        for values, sub_ids in updates.items():
+            positive, neutral, negative, oldest_unread_story_date, mark_read_date, is_trained = values
+            for sub_ids_group in chunks(sub_ids, 500):
+                cls.objects.filter(pk__in=sub_ids_group).update(unread_count_positive=positive,
+                                                                unread_count_neutral=neutral,
+                                                                unread_count_negative=negative,
+                                                                unread_count_updated=now,
+                                                                oldest_unread_story_date=oldest_unread_story_date,
+                                                                mark_read_date=mark_read_date,
+                                                                is_trained=is_trained,
+                                                                needs_unread_recalc=False)
+        
+        # The updates skip save(), so the cached feed lists are told here.
+        if settings.FEED_LIST_CACHE:
+            feed_list_pipeline = redis.Redis(connection_pool=settings.REDIS_POOL).pipeline()
+            for sub in user_subs:
+                RUserFeedList.mark_changed(sub.user_id, feed_id=feed.pk, pipeline=feed_list_pipeline)
+            feed_list_pipeline.execute()
+        
+        if settings.UNREAD_INDEX:
+            RUserUnreadIndex.update_read_dates(feed.pk, dict((sub.user_id, sub.mark_read_date)
+                                                             for sub in user_subs), r=r)
+        
+        pipeline = r.pipeline()
+        for sub in user_subs:
+            if (sub.unread_count_positive == 0 and 
+                sub.unread_count_neutral == 0):
+                sub.mark_feed_read()
+            
+            stale_story_hashes = read_story_hashes[sub.pk] - feed_story_hashes
+            if stale_story_hashes:
+                logging.user(sub.user, "~FBTrimming ~FR%s~FB read stories (~SB%s~SN)..." % (len(stale_story_hashes), sub.feed_id))
+                pipeline.srem("RS:%s:%s" % (sub.user_id, sub.feed_id), *stale_story_hashes)
+                pipeline.srem("RS:%s" % sub.feed_id, *stale_story_hashes)
+        pipeline.execute()
+        
+        if not silent:
+            logging.debug(u'   ---> [%-30s] ~FCComputed scores for ~SB%s subscribers~SN in ~SB%s UPDATEs~SN (%.4s sec)' % (
+                          feed.title[:30], len(user_subs), len(updates),
+                          (datetime.datetime.now() - now).total_seconds()))
+        
+        return user_subs
+    
     def switch_feed(self, new_feed, old_feed):
         # Rewrite feed in subscription folders
         try:
@@ -938,6 +1139,8 @@ class RUserStory:
         
         read_story_key = 'RS:%s:%s' % (user_id, story_feed_id)
         redis_commands(read_story_key)
+        if settings.UNREAD_INDEX:
+            RUserUnreadIndex.mark_read(user_id, story_hash, r=r)
         
         if social_user_ids:
             for social_user_id in social_user_ids:
@@ -986,6 +1189,8 @@ class RUserStory:
         
         read_story_key = 'RS:%s:%s' % (user_id, story_feed_id)
         redis_commands(read_story_key)
+        if settings.UNREAD_INDEX:
+            RUserUnreadIndex.mark_unread(user_id, story_feed_id, story_hash, r=r)
         
         read_stories_list_key = 'lRS:%s' % user_id
         r.lrem(read_stories_list_key, story_hash)
@@ -1081,6 +1286,436 @@ class RUserStory:
         count = r.scard(key)
         return count
 
+class RUserUnreadIndex:
+    """
+    A user's unread story hashes across all of their active subscriptions, kept
+    current as stories arrive, are trimmed and are read, so rivers and counts can
+    read them back with one range query instead of rebuilding them feed by feed.
+    
+        zU:<user_id>   sorted set of unread story hashes, scored by story date
+        zUR:<user_id>  hash of indexed feed_id -> mark_read_date timestamp
+        zUF:<feed_id>  set of user_ids whose index includes the feed
+    
+    Read dates are applied when reading, so moving a subscription's
+    mark_read_date only has to update zUR.
+    """
+    
+    EXPIRE = 24*60*60
+    
+    @classmethod
+    def is_built(cls, user_id, r=None):
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        return r.exists('zUR:%s' % user_id)
+    
+    @classmethod
+    def build(cls, user_id, usersubs=None, r=None):
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        if usersubs is None:
+            usersubs = UserSubscription.objects.filter(user=user_id, active=True)\
+                                               .only('feed', 'mark_read_date')
+        
+        index_key = 'zU:%s' % user_id
+        read_dates_key = 'zUR:%s' % user_id
+        read_dates = dict((us.feed_id, int(us.mark_read_date.strftime('%s'))) for us in usersubs)
+        
+        # Each chunk of feeds is unioned into its own key, and those into the index,
+        # so no story is copied more than twice however many feeds there are.
+        building_keys = []
+        for c, feed_id_group in enumerate(chunks(read_dates.keys(), 20)):
+            building_key = 'zU:%s:building:%s' % (user_id, c)
+            unread_ranked_stories_keys = []
+            pipeline = r.pipeline()
+            for feed_id in feed_id_group:
+                unread_stories_key        = 'U:%s:%s' % (user_id, feed_id)
+                unread_ranked_stories_key = 'zU:%s:%s' % (user_id, feed_id)
+                cls.store_feed_unreads(user_id, feed_id, unread_stories_key,
+                                       unread_ranked_stories_key, r=pipeline)
+                pipeline.delete(unread_stories_key)
+                pipeline.sadd('zUF:%s' % feed_id, user_id)
+                unread_ranked_stories_keys.append(unread_ranked_stories_key)
+            pipeline.zunionstore(building_key, unread_ranked_stories_keys)
+            pipeline.expire(building_key, cls.EXPIRE)
+            pipeline.delete(*unread_ranked_stories_keys)
+            pipeline.execute()
+            building_keys.append(building_key)
+        
+        pipeline = r.pipeline()
+        if building_keys:
+            pipeline.zunionstore(index_key, building_keys)
+            pipeline.delete(*building_keys)
+        else:
+            pipeline.delete(index_key)
+        pipeline.delete(read_dates_key)
+        if read_dates:
+            pipeline.hmset(read_dates_key, read_dates)
+        pipeline.expire(index_key, cls.EXPIRE)
+        pipeline.expire(read_dates_key, cls.EXPIRE)
+        pipeline.execute()
+        
+        return len(read_dates)
+    
+    @staticmethod
+    def store_feed_unreads(user_id, feed_id, unread_stories_key, unread_ranked_stories_key, r):
+        """Stores a feed's unread story hashes for a user, scored by story date."""
+        r.sdiffstore(unread_stories_key, 'F:%s' % feed_id, 'RS:%s:%s' % (user_id, feed_id))
+        # Zero weight on the set so each hash keeps its zF story date.
+        r.zinterstore(unread_ranked_stories_key, {'zF:%s' % feed_id: 1, unread_stories_key: 0})
+    
+    @classmethod
+    def add_feed(cls, user_id, feed_id, mark_read_date, r=None):
+        """Adds a newly indexed feed's unread stories to an index that's already built."""
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        unread_stories_key        = 'U:%s:%s' % (user_id, feed_id)
+        unread_ranked_stories_key = 'zU:%s:%s' % (user_id, feed_id)
+        
+        pipeline = r.pipeline()
+        cls.store_feed_unreads(user_id, feed_id, unread_stories_key, unread_ranked_stories_key,
+                               r=pipeline)
+        pipeline.zrange(unread_ranked_stories_key, 0, -1, withscores=True)
+        pipeline.delete(unread_ranked_stories_key)
+        pipeline.delete(unread_stories_key)
+        unread_stories = pipeline.execute()[2]
+        
+        pipeline = r.pipeline()
+        if unread_stories:
+            pipeline.zadd('zU:%s' % user_id, **dict(unread_stories))
+        pipeline.hset('zUR:%s' % user_id, feed_id, int(mark_read_date.strftime('%s')))
+        pipeline.sadd('zUF:%s' % feed_id, user_id)
+        pipeline.execute()
+    
+    @classmethod
+    def story_hashes(cls, user_id, feed_ids=None, order="newest", include_timestamps=False,
+                     group_by_feed=True, r=None):
+        """Returns None when the user has no index, so callers can fall back."""
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        
+        current_time = int(time.time() + 60*60*24)
+        pipeline = r.pipeline()
+        pipeline.hgetall('zUR:%s' % user_id)
+        if order == 'oldest':
+            pipeline.zrangebyscore('zU:%s' % user_id, '-inf', current_time - 1, withscores=True)
+        else:
+            pipeline.zrevrangebyscore('zU:%s' % user_id, current_time - 1, '-inf', withscores=True)
+        read_dates, ranked_story_hashes = pipeline.execute()
+        if not read_dates:
+            return None
+        
+        if feed_ids:
+            feed_ids = set(str(feed_id) for feed_id in feed_ids)
+            read_dates = dict((feed_id, read_date) for feed_id, read_date in read_dates.items()
+                              if feed_id in feed_ids)
+        read_dates = dict((feed_id, int(read_date)) for feed_id, read_date in read_dates.items())
+        
+        story_hashes = {} if group_by_feed else []
+        if group_by_feed:
+            for feed_id in read_dates:
+                story_hashes[int(feed_id)] = []
+        for story_hash, score in ranked_story_hashes:
+            feed_id = story_hash.split(':', 1)[0]
+            read_date = read_dates.get(feed_id)
+            if read_date is None or score < read_date:
+                continue
+            # +1 as in UserSubscription.story_hashes, where F carries an implicit score of 1.
+            story = (story_hash, score + 1) if include_timestamps else story_hash
+            if group_by_feed:
+                story_hashes[int(feed_id)].append(story)
+            else:
+                story_hashes.append(story)
+        
+        return story_hashes
+    
+    @classmethod
+    def check(cls, user_id, r=None):
+        """
+        Compares the index against the unread stories computed from scratch, returning
+        the hashes missing from the index and the extra ones it still holds.
+        """
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        indexed = cls.story_hashes(user_id, group_by_feed=False, r=r)
+        if indexed is None:
+            return None, None
+        
+        usersubs = UserSubscription.objects.filter(user=user_id, active=True)\
+                                           .only('feed', 'mark_read_date')
+        computed = UserSubscription.story_hashes(user_id, usersubs=usersubs,
+                                                 feed_ids=[us.feed_id for us in usersubs],
+                                                 read_filter='unread', group_by_feed=False)
+        indexed = set(indexed)
+        computed = set(computed)
+        
+        return computed - indexed, indexed - computed
+    
+    @classmethod
+    def add_story(cls, story_feed_id, story_hash, story_timestamp, r=None):
+        cls.add_stories(story_feed_id, [(story_hash, story_timestamp)], r=r)
+    
+    @classmethod
+    def add_stories(cls, story_feed_id, stories, r=None):
+        """Adds (story_hash, story_timestamp) pairs from one feed to its indexed readers."""
+        ri = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        if not r:
+            r = ri
+        user_ids = list(ri.smembers('zUF:%s' % story_feed_id))
+        if not user_ids or not stories:
+            return
+        
+        pipeline = ri.pipeline()
+        for user_id in user_ids:
+            pipeline.exists('zUR:%s' % user_id)
+            for story_hash, _ in stories:
+                pipeline.sismember('RS:%s:%s' % (user_id, story_feed_id), story_hash)
+        results = pipeline.execute()
+        
+        results_per_user = 1 + len(stories)
+        for i, user_id in enumerate(user_ids):
+            indexed = results[i*results_per_user]
+            if not indexed:
+                r.srem('zUF:%s' % story_feed_id, user_id)
+                continue
+            read = results[i*results_per_user+1:(i+1)*results_per_user]
+            unread_stories = dict((story_hash, story_timestamp) for (story_hash, story_timestamp), is_read
+                                  in zip(stories, read) if not is_read)
+            if unread_stories:
+                r.zadd('zU:%s' % user_id, **unread_stories)
+    
+    @classmethod
+    def remove_story(cls, story_feed_id, story_hash, r=None):
+        ri = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        if not r:
+            r = ri
+        for user_id in ri.smembers('zUF:%s' % story_feed_id):
+            r.zrem('zU:%s' % user_id, story_hash)
+    
+    @classmethod
+    def remove_stories(cls, story_feed_id, story_hashes, r=None):
+        ri = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        if not r:
+            r = ri
+        if not story_hashes:
+            return
+        for user_id in ri.smembers('zUF:%s' % story_feed_id):
+            r.zrem('zU:%s' % user_id, *story_hashes)
+    
+    @classmethod
+    def mark_read(cls, user_id, story_hash, r=None):
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        r.zrem('zU:%s' % user_id, story_hash)
+    
+    @classmethod
+    def mark_unread(cls, user_id, story_feed_id, story_hash, r=None):
+        ri = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        if not r:
+            r = ri
+        pipeline = ri.pipeline()
+        pipeline.hexists('zUR:%s' % user_id, story_feed_id)
+        pipeline.zscore('zF:%s' % story_feed_id, story_hash)
+        indexed, story_timestamp = pipeline.execute()
+        if indexed and story_timestamp is not None:
+            r.zadd('zU:%s' % user_id, story_hash, story_timestamp)
+    
+    @classmethod
+    def update_subscription(cls, user_id, feed_id, mark_read_date, active=True, r=None):
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        read_dates_key = 'zUR:%s' % user_id
+        if not r.exists(read_dates_key):
+            return
+        
+        if not active:
+            return cls.remove_feed(user_id, feed_id, r=r)
+        if not r.hexists(read_dates_key, feed_id):
+            return cls.add_feed(user_id, feed_id, mark_read_date, r=r)
+        r.hset(read_dates_key, feed_id, int(mark_read_date.strftime('%s')))
+    
+    @classmethod
+    def update_read_dates(cls, feed_id, read_dates, r=None):
+        """Bulk version of `update_subscription` for one feed, `read_dates` by user_id."""
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        user_ids = r.smembers('zUF:%s' % feed_id)
+        if not user_ids:
+            return
+        
+        pipeline = r.pipeline()
+        for user_id, mark_read_date in read_dates.items():
+            if str(user_id) not in user_ids:
+                continue
+            pipeline.hset('zUR:%s' % user_id, feed_id, int(mark_read_date.strftime('%s')))
+        pipeline.execute()
+    
+    @classmethod
+    def remove_feed(cls, user_id, feed_id, r=None):
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        pipeline = r.pipeline()
+        pipeline.hdel('zUR:%s' % user_id, feed_id)
+        pipeline.srem('zUF:%s' % feed_id, user_id)
+        pipeline.execute()
+        story_hashes = r.zrange('zU:%s' % user_id, 0, -1)
+        stale_story_hashes = [h for h in story_hashes if h.split(':', 1)[0] == str(feed_id)]
+        if stale_story_hashes:
+            r.zrem('zU:%s' % user_id, *stale_story_hashes)
+    
+    @classmethod
+    def delete(cls, user_id, r=None):
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        feed_ids = r.hkeys('zUR:%s' % user_id)
+        pipeline = r.pipeline()
+        for feed_id in feed_ids:
+            pipeline.srem('zUF:%s' % feed_id, user_id)
+        pipeline.delete('zU:%s' % user_id)
+        pipeline.delete('zUR:%s' % user_id)
+        pipeline.execute()
+        
+
+class RUserFeedList:
+    """
+    A user's subscriptions as load_feeds serves them, so app starts don't have
+    to join and serialize every subscription, and clients that send the version
+    they last loaded only get back what changed since.
+    
+        LF:<user_id>   hash of feed_id -> the subscription's canonical, without favicon
+        LFC:<user_id>  sorted set of feed_ids and 'folders', scored by when they last
+                       changed. '_since' is when changes started being kept.
+    
+    Versions are millisecond timestamps. Changes to the feeds themselves come
+    from their recorded canonical state (see `Feed.save_canonical_state`).
+    """
+    
+    EXPIRE = 14*24*60*60
+    
+    @staticmethod
+    def now():
+        return int(time.time() * 1000)
+    
+    @classmethod
+    def mark_changed(cls, user_id, feed_id=None, folders=False, r=None, pipeline=None):
+        """Pass a `pipeline` to queue the change on it, for the caller to execute."""
+        changes_key = 'LFC:%s' % user_id
+        changes = {}
+        if feed_id:
+            changes[str(feed_id)] = cls.now()
+        if folders:
+            changes['folders'] = cls.now()
+        
+        execute = not pipeline
+        if not pipeline:
+            if not r:
+                r = redis.Redis(connection_pool=settings.REDIS_POOL)
+            pipeline = r.pipeline()
+        if feed_id:
+            pipeline.hdel('LF:%s' % user_id, feed_id)
+        pipeline.zadd(changes_key, **changes)
+        pipeline.expire(changes_key, cls.EXPIRE)
+        if execute:
+            pipeline.execute()
+    
+    @classmethod
+    def load(cls, user_id, since=None, update_counts=False, r=None):
+        """
+        The user's subscriptions, recalculating counts first if asked. With a
+        `since` version this recent, only feeds changed after it are returned,
+        along with the feeds unsubscribed from and whether folders changed.
+        """
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        now = cls.now()
+        list_key = 'LF:%s' % user_id
+        changes_key = 'LFC:%s' % user_id
+        
+        usersubs = UserSubscription.objects.filter(user=user_id)\
+                                           .values('feed', 'active', 'needs_unread_recalc')
+        feed_ids = [sub['feed'] for sub in usersubs]
+        if update_counts:
+            recalc_feed_ids = [sub['feed'] for sub in usersubs if sub['needs_unread_recalc']]
+            if recalc_feed_ids:
+                for sub in UserSubscription.objects.select_related('feed')\
+                                                   .filter(user=user_id, feed__in=recalc_feed_ids):
+                    sub.calculate_feed_scores(silent=True)
+        
+        pipeline = r.pipeline()
+        pipeline.hgetall(list_key)
+        pipeline.zrange(changes_key, 0, -1, withscores=True)
+        cached_feeds, changes = pipeline.execute()
+        changes = dict((member, int(score)) for member, score in changes)
+        states = Feed.canonical_states(feed_ids)
+        
+        feeds = {}
+        stale_feed_ids = []
+        for feed_id in feed_ids:
+            feed = json.decode(cached_feeds.get(str(feed_id)))
+            state = states.get(feed_id)
+            if (not feed or not state or
+                max(state[0], changes.get(str(feed_id), 0)) > feed['_cached']):
+                stale_feed_ids.append(feed_id)
+            else:
+                feeds[feed_id] = feed
+        
+        pipeline = r.pipeline()
+        if stale_feed_ids:
+            for sub in UserSubscription.objects.select_related('feed')\
+                                               .filter(user=user_id, feed__in=stale_feed_ids):
+                feed = sub.canonical(include_favicon=False)
+                feed['_cached'] = now
+                if sub.feed_id not in states:
+                    states[sub.feed_id] = sub.feed.save_canonical_state()
+                pipeline.hset(list_key, sub.feed_id, json.encode(feed))
+                feeds[sub.feed_id] = feed
+        
+        unsubscribed_feed_ids = set(cached_feeds.keys()) - set(str(feed_id) for feed_id in feed_ids)
+        if unsubscribed_feed_ids:
+            pipeline.hdel(list_key, *unsubscribed_feed_ids)
+            for feed_id in unsubscribed_feed_ids:
+                changes[feed_id] = now
+            pipeline.zadd(changes_key, **dict((feed_id, now) for feed_id in unsubscribed_feed_ids))
+        
+        # Changes older than the lists are kept for can't be told apart, so
+        # versions from before then get everything.
+        oldest = now - cls.EXPIRE*1000
+        tracked_since = max(changes.get('_since', now), oldest)
+        pipeline.zremrangebyscore(changes_key, 0, oldest - 1)
+        pipeline.zadd(changes_key, _since=tracked_since)
+        pipeline.expire(changes_key, cls.EXPIRE)
+        pipeline.expire(list_key, cls.EXPIRE)
+        pipeline.execute()
+        
+        for feed_id, feed in feeds.items():
+            last_update = states.get(feed_id, (0, 0))[1]
+            last_update = last_update and datetime.datetime.fromtimestamp(last_update)
+            feed['updated'] = relative_timesince(last_update)
+            feed['updated_seconds_ago'] = seconds_timesince(last_update)
+        
+        delta = bool(since and since >= tracked_since)
+        removed_feed_ids = []
+        if delta:
+            feeds = dict((feed_id, feed) for feed_id, feed in feeds.items()
+                         if max(states.get(feed_id, (now, 0))[0],
+                                changes.get(str(feed_id), 0)) > since)
+            subscribed_feed_ids = set(str(feed_id) for feed_id in feed_ids)
+            removed_feed_ids = [int(feed_id) for feed_id, changed in changes.items()
+                                if changed > since and feed_id not in ('_since', 'folders') and
+                                feed_id not in subscribed_feed_ids]
+        for feed in feeds.values():
+            del feed['_cached']
+        
+        return {
+            'version': now,
+            'delta': delta,
+            'feeds': feeds,
+            'removed_feed_ids': removed_feed_ids,
+            'folders_changed': not delta or changes.get('folders', 0) > since,
+            'feed_ids': feed_ids,
+            'active_feed_ids': [sub['feed'] for sub in usersubs if sub['active']],
+        }
+
+
 class UserSubscriptionFolders(models.Model):
     """
     A JSON list of folders and feeds for while a user has subscribed. The list
@@ -1097,6 +1732,11 @@ class UserSubscriptionFolders(models.Model):
         verbose_name_plural = "folders"
         verbose_name = "folder"
     
+    def save(self, *args, **kwargs):
+        super(UserSubscriptionFolders, self).save(*args, **kwargs)
+        if settings.FEED_LIST_CACHE:
+            RUserFeedList.mark_changed(self.user_id, folders=True)
+    
     def compact(self):
         folders = json.decode(self.folders)
         
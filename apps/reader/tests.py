@@ -1,9 +1,16 @@
+import time
+import datetime
+import redis
 from utils import json_functions as json
 from django.test.client import Client
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 from django.conf import settings
 from mongoengine.connection import connect, disconnect
+from apps.reader.models import UserSubscription, RUserStory, RUserUnreadIndex
+from utils.story_functions import StoryDateFormatter
+from utils.story_functions import format_story_link_date__short, format_story_link_date__long
+from vendor.timezones.utilities import localtime_for_timezone
 
 class ReaderTest(TestCase):
     fixtures = ['../../rss_feeds/fixtures/rss_feeds.json', 
@@ -111,4 +118,150 @@ class ReaderTest(TestCase):
         self.assertEquals(len(feed['classifiers']['tags']), 0)
         # self.assert_(connection.queries)
         
-        # settings.DEBUG = False
\ No newline at end of file
+        # settings.DEBUG = False
+
+class JSONEncoderTest(TestCase):
+    
+    def assertSameEncoding(self, data):
+        legacy = json.legacy_json_encode(data)
+        self.assertEquals(json.json_encode(data), legacy)
+        self.assertEquals(''.join(json.json_iterencode(data, chunk_size=16)), legacy)
+        
+    def test_encodes_like_legacy_encoder(self):
+        import datetime
+        from decimal import Decimal
+        from bson.objectid import ObjectId
+        from django.contrib.auth.models import User
+        
+        user = User(pk=42, username=u'j\xfcrgen', email='jurgen@example.com')
+        user.feed_count = 3
+        self.assertSameEncoding({1: 'one', 2: {3: [4, 5]}, 'six': 6, u'seven': 7.5})
+        self.assertSameEncoding({'user': user, 'users': [user, user]})
+        self.assertSameEncoding({'set': set([3, 1, 2]), 'tuple': (1, 'two', None), 'list': [(3, 4)]})
+        self.assertSameEncoding({'price': Decimal('10.50'),
+                                 'id': ObjectId('51c1f8e5e4b0ab5ab5000001')})
+        self.assertEquals(json.json_encode([Decimal('10.50')]), '["10.50"]')
+        self.assertSameEncoding({'datetime': datetime.datetime(2013, 6, 19, 13, 45, 2, 123),
+                                 'date': datetime.date(2013, 6, 19)})
+        self.assertSameEncoding({'title': u'Caf\xe9 \u2603 \U0001f600',
+                                 'escapes': u'"quoted"\n\t\\ </script>'})
+        self.assertSameEncoding([None, True, False, 0, -1, 2**40, 1e100, u'', [], {}])
+
+
+class UnreadIndexTest(TestCase):
+    fixtures = ['../../rss_feeds/fixtures/rss_feeds.json', 'subscriptions.json']
+    
+    def setUp(self):
+        disconnect()
+        settings.MONGODB = connect('test_newsblur')
+        self.unread_index = settings.UNREAD_INDEX
+        settings.UNREAD_INDEX = True
+        self.r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        self.user_id = 1
+        self.feed_ids = [1, 2, 3]
+        self.now = int(time.time())
+        for feed_id in self.feed_ids:
+            for hours in range(1, 6):
+                self.add_story(feed_id, hours)
+        RUserStory.mark_read(self.user_id, 2, '2:story-2')
+        
+    def tearDown(self):
+        settings.UNREAD_INDEX = self.unread_index
+        keys = ['zU:%s' % self.user_id, 'zUR:%s' % self.user_id,
+                'RS:%s' % self.user_id, 'lRS:%s' % self.user_id]
+        for feed_id in self.feed_ids:
+            keys.extend(['F:%s' % feed_id, 'zF:%s' % feed_id, 'zUF:%s' % feed_id,
+                         'RS:%s:%s' % (self.user_id, feed_id)])
+        self.r.delete(*keys)
+        settings.MONGODB.drop_database('test_newsblur')
+    
+    def add_story(self, feed_id, hours_ago):
+        story_hash = '%s:story-%s' % (feed_id, hours_ago)
+        timestamp = self.now - hours_ago*60*60
+        self.r.sadd('F:%s' % feed_id, story_hash)
+        self.r.zadd('zF:%s' % feed_id, story_hash, timestamp)
+        RUserUnreadIndex.add_story(feed_id, story_hash, timestamp)
+    
+    def assertSameUnreads(self):
+        usersubs = UserSubscription.objects.filter(user=self.user_id, feed__in=self.feed_ids)
+        legacy = UserSubscription.story_hashes(self.user_id, usersubs=usersubs, feed_ids=self.feed_ids,
+                                               read_filter='unread')
+        indexed = RUserUnreadIndex.story_hashes(self.user_id, feed_ids=self.feed_ids)
+        self.assertEquals(indexed, legacy)
+        self.assertEquals(RUserUnreadIndex.story_hashes(self.user_id, feed_ids=self.feed_ids,
+                                                        order='oldest'),
+                          UserSubscription.story_hashes(self.user_id, usersubs=usersubs,
+                                                        feed_ids=self.feed_ids,
+                                                        read_filter='unread', order='oldest'))
+    
+    def test_story_hashes_match_legacy(self):
+        usersubs = UserSubscription.objects.filter(user=self.user_id, feed__in=self.feed_ids)
+        RUserUnreadIndex.build(self.user_id, usersubs=usersubs)
+        self.assertSameUnreads()
+        self.assertEquals(len(RUserUnreadIndex.story_hashes(self.user_id)[2]), 4)
+        
+        # New stories, reads and unreads.
+        self.add_story(1, 0)
+        RUserStory.mark_read(self.user_id, 1, '1:story-1')
+        RUserStory.mark_read(self.user_id, 3, '3:story-4')
+        RUserStory.mark_unread(self.user_id, 2, '2:story-2')
+        self.assertSameUnreads()
+        
+        # Moving a subscription's read date.
+        usersub = UserSubscription.objects.get(user=self.user_id, feed=3)
+        usersub.mark_read_date = datetime.datetime.fromtimestamp(self.now - 3.5*60*60)
+        usersub.save()
+        self.assertSameUnreads()
+        self.assertEquals(RUserUnreadIndex.story_hashes(self.user_id)[3],
+                          ['3:story-1', '3:story-2', '3:story-3'])
+    
+    def test_added_subscription_matches_legacy(self):
+        usersubs = UserSubscription.objects.filter(user=self.user_id, feed__in=[1, 2])
+        RUserUnreadIndex.build(self.user_id, usersubs=usersubs)
+        self.assertEquals(sorted(RUserUnreadIndex.story_hashes(self.user_id).keys()), [1, 2])
+        
+        UserSubscription.objects.get(user=self.user_id, feed=3).save()
+        self.assertSameUnreads()
+        self.assertEquals(len(RUserUnreadIndex.story_hashes(self.user_id)[3]), 5)
+    
+    def test_unread_story_hashes_match_legacy(self):
+        usersubs = UserSubscription.objects.filter(user=self.user_id, feed__in=self.feed_ids)
+        RUserUnreadIndex.build(self.user_id, usersubs=usersubs)
+        usersubs.filter(feed__in=[1, 2]).update(unread_count_neutral=5)
+        # Only negative unreads, so neither path returns the feed.
+        usersubs.filter(feed=3).update(unread_count_negative=5)
+        
+        for params in [{}, dict(order='oldest'), dict(include_timestamps=True),
+                       dict(group_by_feed=False), dict(group_by_feed=False, include_timestamps=True)]:
+            settings.UNREAD_INDEX = True
+            indexed = UserSubscription.story_hashes(self.user_id, feed_ids=self.feed_ids, **params)
+            settings.UNREAD_INDEX = False
+            legacy = UserSubscription.story_hashes(self.user_id, feed_ids=self.feed_ids, **params)
+            self.assertEquals(indexed, legacy)
+        
+        settings.UNREAD_INDEX = True
+        story_hashes = UserSubscription.story_hashes(self.user_id, feed_ids=self.feed_ids)
+        self.assertEquals(sorted(story_hashes.keys()), [1, 2])
+        self.assertEquals(len(story_hashes[2]), 4)
+
+
+class StoryDateFormatterTest(TestCase):
+    
+    def test_formats_like_story_link_dates(self):
+        now = datetime.datetime.now()
+        dates = [now, now - datetime.timedelta(minutes=5),
+                 now.replace(day=1, hour=0, minute=0, second=0, microsecond=0),
+                 datetime.datetime(2009, 7, 28, 23, 17, 27),
+                 # Either side of the US spring forward and fall back.
+                 datetime.datetime(2013, 3, 10, 6, 59), datetime.datetime(2013, 3, 10, 7, 1),
+                 datetime.datetime(2013, 11, 3, 5, 30), datetime.datetime(2013, 11, 3, 6, 30)]
+        dates.extend(now - datetime.timedelta(hours=hours) for hours in range(1, 24*40, 7))
+        
+        for timezone in ['America/New_York', 'Asia/Kolkata', 'Pacific/Auckland', settings.TIME_ZONE]:
+            formatter = StoryDateFormatter(timezone, now=now)
+            nowtz = localtime_for_timezone(now, timezone)
+            for date in dates:
+                story_date = localtime_for_timezone(date, timezone)
+                self.assertEquals(formatter.story_dates(date),
+                                  (format_story_link_date__short(story_date, nowtz),
+                                   format_story_link_date__long(story_date, nowtz)))
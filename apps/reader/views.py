@@ -29,9 +29,11 @@ from apps.recommendations.models import RecommendedFeed
 from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
 from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds
 from apps.analyzer.models import apply_classifier_authors, apply_classifier_tags
+from apps.analyzer.models import ClassifierMatcher
 from apps.analyzer.models import get_classifiers_for_user, sort_classifiers_by_feed
 from apps.profile.models import Profile
 from apps.reader.models import UserSubscription, UserSubscriptionFolders, RUserStory, Feature
+from apps.reader.models import RUserFeedList
 from apps.reader.forms import SignupForm, LoginForm, FeatureForm
 from apps.rss_feeds.models import MFeedIcon, MStarredStoryCounts
 from apps.search.models import MUserSearch
@@ -49,8 +51,7 @@ from apps.rss_feeds.tasks import ScheduleImmediateFetches
 from utils import json_functions as json
 from utils.user_functions import get_user, ajax_login_required
 from utils.feed_functions import relative_timesince
-from utils.story_functions import format_story_link_date__short
-from utils.story_functions import format_story_link_date__long
+from utils.story_functions import StoryDateFormatter
 from utils.story_functions import strip_tags
 from utils import log as logging
 from utils.view_functions import get_argument_or_404, render_to, is_true
@@ -227,6 +228,7 @@ def load_feeds(request):
     flat             = request.REQUEST.get('flat', False)
     update_counts    = request.REQUEST.get('update_counts', False)
     version          = int(request.REQUEST.get('v', 1))
+    since            = int(request.REQUEST.get('since', 0) or 0)
     
     if include_favicons == 'false': include_favicons = False
     if update_counts == 'false': update_counts = False
@@ -243,23 +245,36 @@ def load_feeds(request):
         UserSubscriptionFolders.objects.filter(user=user)[1:].delete()
         folders = UserSubscriptionFolders.objects.get(user=user)
     
-    user_subs = UserSubscription.objects.select_related('feed').filter(user=user)
-    
     day_ago = datetime.datetime.now() - datetime.timedelta(days=1)
     scheduled_feeds = []
-    for sub in user_subs:
-        pk = sub.feed_id
-        if update_counts and sub.needs_unread_recalc:
-            sub.calculate_feed_scores(silent=True)
-        feeds[pk] = sub.canonical(include_favicon=include_favicons)
-        
-        if not sub.active: continue
-        if not sub.feed.active and not sub.feed.has_feed_exception:
-            scheduled_feeds.append(sub.feed.pk)
-        elif sub.feed.active_subscribers <= 0:
-            scheduled_feeds.append(sub.feed.pk)
-        elif sub.feed.next_scheduled_update < day_ago:
-            scheduled_feeds.append(sub.feed.pk)
+    feed_list = None
+    if settings.FEED_LIST_CACHE:
+        feed_list = RUserFeedList.load(user.pk, since=since, update_counts=update_counts)
+        feeds = feed_list['feeds']
+        user_subs = feed_list['feed_ids']
+        if include_favicons and feeds:
+            for feed_icon in MFeedIcon.objects(feed_id__in=feeds.keys()).only('feed_id', 'data'):
+                feeds[feed_icon.feed_id]['favicon'] = feed_icon.data
+        if feed_list['active_feed_ids']:
+            scheduled_feeds = list(Feed.objects.filter(pk__in=feed_list['active_feed_ids']).filter(
+                Q(active=False, has_feed_exception=False) |
+                Q(active_subscribers__lte=0) |
+                Q(next_scheduled_update__lt=day_ago)).values_list('pk', flat=True))
+    else:
+        user_subs = UserSubscription.objects.select_related('feed').filter(user=user)
+        for sub in user_subs:
+            pk = sub.feed_id
+            if update_counts and sub.needs_unread_recalc:
+                sub.calculate_feed_scores(silent=True)
+            feeds[pk] = sub.canonical(include_favicon=include_favicons)
+            
+            if not sub.active: continue
+            if not sub.feed.active and not sub.feed.has_feed_exception:
+                scheduled_feeds.append(sub.feed.pk)
+            elif sub.feed.active_subscribers <= 0:
+                scheduled_feeds.append(sub.feed.pk)
+            elif sub.feed.next_scheduled_update < day_ago:
+                scheduled_feeds.append(sub.feed.pk)
     
     if len(scheduled_feeds) > 0 and request.user.is_authenticated():
         logging.user(request, "~SN~FMTasking the scheduling immediate fetch of ~SB%s~SN feeds..." % 
@@ -297,6 +312,13 @@ def load_feeds(request):
         'starred_counts': starred_counts,
         'categories': categories
     }
+    if feed_list:
+        data['version'] = feed_list['version']
+        if feed_list['delta']:
+            data['delta'] = True
+            data['removed_feeds'] = feed_list['removed_feed_ids']
+        if not feed_list['folders_changed']:
+            del data['folders']
     return data
 
 @json.json_view
@@ -525,7 +547,7 @@ def load_single_feed(request, feed_id):
     
     dupe_feed_id = None
     user_profiles = []
-    now = localtime_for_timezone(datetime.datetime.now(), user.profile.timezone)
+    dates = StoryDateFormatter(user.profile.timezone)
     if not feed_id: raise Http404
 
     feed_address = request.REQUEST.get('feed_address')
@@ -617,10 +639,9 @@ def load_single_feed(request, feed_id):
     for story in stories:
         if not include_story_content:
             del story['story_content']
-        story_date = localtime_for_timezone(story['story_date'], user.profile.timezone)
-        nowtz = localtime_for_timezone(now, user.profile.timezone)
-        story['short_parsed_date'] = format_story_link_date__short(story_date, nowtz)
-        story['long_parsed_date'] = format_story_link_date__long(story_date, nowtz)
+        story_date = dates.localtime(story['story_date'])
+        story['short_parsed_date'] = dates.short(story_date)
+        story['long_parsed_date'] = dates.long(story_date)
         if usersub:
             story['read_status'] = 1
             if (read_filter == 'all' or query) and usersub:
@@ -629,16 +650,14 @@ def load_single_feed(request, feed_id):
                 story['read_status'] = 0
             if story['story_hash'] in starred_stories:
                 story['starred'] = True
-                starred_date = localtime_for_timezone(starred_stories[story['story_hash']]['starred_date'],
-                                                      user.profile.timezone)
-                story['starred_date'] = format_story_link_date__long(starred_date, now)
+                starred_date = dates.localtime(starred_stories[story['story_hash']]['starred_date'])
+                story['starred_date'] = dates.long(starred_date)
                 story['starred_timestamp'] = starred_date.strftime('%s')
                 story['user_tags'] = starred_stories[story['story_hash']]['user_tags']
             if story['story_hash'] in shared_stories:
                 story['shared'] = True
-                shared_date = localtime_for_timezone(shared_stories[story['story_hash']]['shared_date'],
-                                                     user.profile.timezone)
-                story['shared_date'] = format_story_link_date__long(shared_date, now)
+                shared_date = dates.localtime(shared_stories[story['story_hash']]['shared_date'])
+                story['shared_date'] = dates.long(shared_date)
                 story['shared_comments'] = strip_tags(shared_stories[story['story_hash']]['comments'])
         else:
             story['read_status'] = 1
@@ -760,7 +779,7 @@ def load_starred_stories(request):
     tag          = request.REQUEST.get('tag')
     story_hashes = request.REQUEST.getlist('h')[:100]
     version      = int(request.REQUEST.get('v', 1))
-    now          = localtime_for_timezone(datetime.datetime.now(), user.profile.timezone)
+    dates        = StoryDateFormatter(user.profile.timezone)
     message      = None
     order_by     = '-' if order == "newest" else ""
     if page: offset = limit * (page - 1)
@@ -815,13 +834,12 @@ def load_starred_stories(request):
                                                    comments=story.comments))
                            for story in shared_stories])
 
-    nowtz = localtime_for_timezone(now, user.profile.timezone)
     for story in stories:
-        story_date                 = localtime_for_timezone(story['story_date'], user.profile.timezone)
-        story['short_parsed_date'] = format_story_link_date__short(story_date, nowtz)
-        story['long_parsed_date']  = format_story_link_date__long(story_date, nowtz)
-        starred_date               = localtime_for_timezone(story['starred_date'], user.profile.timezone)
-        story['starred_date']      = format_story_link_date__long(starred_date, nowtz)
+        story_date                 = dates.localtime(story['story_date'])
+        story['short_parsed_date'] = dates.short(story_date)
+        story['long_parsed_date']  = dates.long(story_date)
+        starred_date               = dates.localtime(story['starred_date'])
+        story['starred_date']      = dates.long(starred_date)
         story['starred_timestamp'] = starred_date.strftime('%s')
         story['read_status']       = 1
         story['starred']           = True
@@ -933,7 +951,7 @@ def load_read_stories(request):
     page   = int(request.REQUEST.get('page', 0))
     order  = request.REQUEST.get('order', 'newest')
     query  = request.REQUEST.get('query')
-    now    = localtime_for_timezone(datetime.datetime.now(), user.profile.timezone)
+    dates  = StoryDateFormatter(user.profile.timezone)
     message = None
     if page: offset = limit * (page - 1)
     
@@ -974,11 +992,10 @@ def load_read_stories(request):
     starred_stories = dict([(story.story_hash, story.starred_date) 
                             for story in starred_stories])
     
-    nowtz = localtime_for_timezone(now, user.profile.timezone)
     for story in stories:
-        story_date                 = localtime_for_timezone(story['story_date'], user.profile.timezone)
-        story['short_parsed_date'] = format_story_link_date__short(story_date, nowtz)
-        story['long_parsed_date']  = format_story_link_date__long(story_date, nowtz)
+        story_date                 = dates.localtime(story['story_date'])
+        story['short_parsed_date'] = dates.short(story_date)
+        story['long_parsed_date']  = dates.long(story_date)
         story['read_status']       = 1
         story['intelligence']      = {
             'feed':   1,
@@ -988,9 +1005,8 @@ def load_read_stories(request):
         }
         if story['story_hash'] in starred_stories:
             story['starred'] = True
-            starred_date = localtime_for_timezone(starred_stories[story['story_hash']],
-                                                  user.profile.timezone)
-            story['starred_date'] = format_story_link_date__long(starred_date, now)
+            starred_date = dates.localtime(starred_stories[story['story_hash']])
+            story['starred_date'] = dates.long(starred_date)
             story['starred_timestamp'] = starred_date.strftime('%s')
         if story['story_hash'] in shared_stories:
             story['shared'] = True
@@ -1021,19 +1037,19 @@ def load_river_stories__redis(request):
     order             = request.REQUEST.get('order', 'newest')
     read_filter       = request.REQUEST.get('read_filter', 'unread')
     query             = request.REQUEST.get('query')
-    now               = localtime_for_timezone(datetime.datetime.now(), user.profile.timezone)
+    dates             = StoryDateFormatter(user.profile.timezone)
     usersubs          = []
     code              = 1
     user_search       = None
     offset = (page-1) * limit
     limit = page * limit
-    story_date_order = "%sstory_date" % ('' if order == 'oldest' else '-')
+    story_date_order = [('story_date', 1 if order == 'oldest' else -1)]
     
     if story_hashes:
         unread_feed_story_hashes = None
         read_filter = 'unread'
-        mstories = MStory.objects(story_hash__in=story_hashes).order_by(story_date_order)
-        stories = Feed.format_stories(mstories)
+        mstories = list(MStory.raw_stories(story_hashes, sort=story_date_order))
+        stories = Feed.format_raw_stories(mstories)
     elif query:
         if user.profile.is_premium:
             user_search = MUserSearch.get_user(user.pk)
@@ -1041,7 +1057,8 @@ def load_river_stories__redis(request):
             usersubs = UserSubscription.subs_for_feeds(user.pk, feed_ids=feed_ids,
                                                        read_filter='all')
             feed_ids = [sub.feed_id for sub in usersubs]
-            stories = Feed.find_feed_stories(feed_ids, query, order=order, offset=offset, limit=limit)
+            stories = Feed.find_feed_stories(feed_ids, query, order=order, offset=offset, limit=limit,
+                                             user_id=user.pk)
             mstories = stories
             unread_feed_story_hashes = UserSubscription.story_hashes(user.pk, feed_ids=feed_ids, 
                                                                      read_filter="unread", order=order, 
@@ -1079,8 +1096,8 @@ def load_river_stories__redis(request):
             story_hashes = []
             unread_feed_story_hashes = []
 
-        mstories = MStory.objects(story_hash__in=story_hashes).order_by(story_date_order)
-        stories = Feed.format_stories(mstories)
+        mstories = list(MStory.raw_stories(story_hashes, sort=story_date_order))
+        stories = Feed.format_raw_stories(mstories)
     
     found_feed_ids = list(set([story['story_feed_id'] for story in stories]))
     stories, user_profiles = MSharedStory.stories_with_comments_and_profiles(stories, user.pk)
@@ -1127,9 +1144,12 @@ def load_river_stories__redis(request):
                                            classifier_authors=classifier_authors,
                                            classifier_titles=classifier_titles,
                                            classifier_tags=classifier_tags)
+    classifier_matcher = ClassifierMatcher(classifier_feeds=classifier_feeds,
+                                           classifier_authors=classifier_authors,
+                                           classifier_titles=classifier_titles,
+                                           classifier_tags=classifier_tags)
     
     # Just need to format stories
-    nowtz = localtime_for_timezone(now, user.profile.timezone)
     for story in stories:
         if read_filter == 'starred':
             story['read_status'] = 1
@@ -1139,22 +1159,16 @@ def load_river_stories__redis(request):
             if (unread_feed_story_hashes is not None and 
                 story['story_hash'] not in unread_feed_story_hashes):
                 story['read_status'] = 1
-        story_date = localtime_for_timezone(story['story_date'], user.profile.timezone)
-        story['short_parsed_date'] = format_story_link_date__short(story_date, nowtz)
-        story['long_parsed_date']  = format_story_link_date__long(story_date, nowtz)
+        story_date = dates.localtime(story['story_date'])
+        story['short_parsed_date'] = dates.short(story_date)
+        story['long_parsed_date']  = dates.long(story_date)
         if story['story_hash'] in starred_stories:
             story['starred'] = True
-            starred_date = localtime_for_timezone(starred_stories[story['story_hash']]['starred_date'],
-                                                  user.profile.timezone)
-            story['starred_date'] = format_story_link_date__long(starred_date, now)
+            starred_date = dates.localtime(starred_stories[story['story_hash']]['starred_date'])
+            story['starred_date'] = dates.long(starred_date)
             story['starred_timestamp'] = starred_date.strftime('%s')
             story['user_tags'] = starred_stories[story['story_hash']]['user_tags']
-        story['intelligence'] = {
-            'feed':   apply_classifier_feeds(classifier_feeds, story['story_feed_id']),
-            'author': apply_classifier_authors(classifier_authors, story),
-            'tags':   apply_classifier_tags(classifier_tags, story),
-            'title':  apply_classifier_titles(classifier_titles, story),
-        }
+        story['intelligence'] = classifier_matcher.intelligence(story)
     
     if not user.profile.is_premium:
         message = "The full River of News is a premium feature."
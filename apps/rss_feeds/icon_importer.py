@@ -1,9 +1,8 @@
 import urllib2
 import lxml.html
 import numpy
-import scipy
-import scipy.misc
-import scipy.cluster
+import redis
+import hashlib
 import urlparse
 import struct
 import operator
@@ -40,14 +39,14 @@ class IconImporter(object):
 
         if image:
             image     = self.normalize_image(image)
-            try:
-                color     = self.determine_dominant_color_in_image(image)
-            except IndexError:
-                return
             try:
                 image_str = self.string_from_image(image)
             except TypeError:
                 return
+            try:
+                color     = self.dominant_color(image, image_str)
+            except IndexError:
+                return
             
             if len(image_str) > 500000:
                 image = None
@@ -274,48 +273,52 @@ class IconImporter(object):
         
         return image
 
+    def dominant_color(self, image, image_str):
+        """
+        Cached by the normalized icon, since lots of feeds share the same
+        default icons (Blogger, WordPress, Tumblr, ...).
+        """
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        color_key = 'FIC:%s' % hashlib.sha1(image_str).hexdigest()
+        color = r.get(color_key)
+        if not color:
+            color = self.determine_dominant_color_in_image(image)
+            r.set(color_key, color)
+            r.expire(color_key, 60*60*24*30)
+        
+        return color
+    
     def determine_dominant_color_in_image(self, image):
-        NUM_CLUSTERS = 5
+        SAMPLE_SIZE = 32
         
-        # Convert image into array of values for each point.
-        if image.mode == '1':
-            image.convert('L')
+        # Nearest neighbor keeps the icon's own colors instead of blending them.
+        if image.size[0] * image.size[1] > SAMPLE_SIZE * SAMPLE_SIZE:
+            image = image.resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.NEAREST)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
         ar = numpy.array(image)
-        # ar = scipy.misc.fromimage(image)
-        shape = ar.shape
+        pixels = ar.reshape(ar.shape[0] * ar.shape[1], ar.shape[2])[:, :3].astype(numpy.int32)
         
-        # Reshape array of values to merge color bands. [[R], [G], [B], [A]] => [R, G, B, A]
-        if len(shape) > 2:
-            ar = ar.reshape(scipy.product(shape[:2]), shape[2])
-            
-        # Get NUM_CLUSTERS worth of centroids.
-        codes, _ = scipy.cluster.vq.kmeans(ar, NUM_CLUSTERS)
+        # Bucket every pixel into an 8x8x8 palette, and use the average color of
+        # each bucket, rather than the bucket's corner, as its color.
+        buckets = (pixels[:, 0] >> 5) * 64 + (pixels[:, 1] >> 5) * 8 + (pixels[:, 2] >> 5)
+        counts = numpy.bincount(buckets, minlength=512)
+        used = numpy.nonzero(counts)[0]
+        colors = numpy.column_stack([numpy.bincount(buckets, weights=pixels[:, band], minlength=512)[used]
+                                     for band in range(3)]) / counts[used][:, numpy.newaxis]
+        counts = counts[used]
         
-        # Pare centroids, removing blacks and whites and shades of really dark and really light.
-        original_codes = codes
+        # Pare colors, removing blacks and whites and shades of really dark and really light.
         for low, hi in [(60, 200), (35, 230), (10, 250)]:
-            codes = scipy.array([code for code in codes 
-                                 if not ((code[0] < low and code[1] < low and code[2] < low) or
-                                         (code[0] > hi and code[1] > hi and code[2] > hi))])
-            if not len(codes): codes = original_codes
-            else: break
-    
-        # Assign codes (vector quantization). Each vector is compared to the centroids
-        # and assigned the nearest one.
-        vecs, _ = scipy.cluster.vq.vq(ar, codes)
-        
-        # Count occurences of each clustered vector.
-        counts, bins = scipy.histogram(vecs, len(codes))
-
-        # Show colors for each code in its hex value.
-        # colors = [''.join(chr(c) for c in code).encode('hex') for code in codes]
-        # total = scipy.sum(counts)
-        # print dict(zip(colors, [count/float(total) for count in counts]))
+            keep = ~((colors < low).all(axis=1) | (colors > hi).all(axis=1))
+            if keep.any():
+                break
+        else:
+            keep = numpy.ones(len(colors), dtype=bool)
         
         # Find the most frequent color, based on the counts.
-        index_max = scipy.argmax(counts)
-        peak = codes[index_max]
-        color = ''.join(chr(c) for c in peak).encode('hex')
+        peak = colors[keep][numpy.argmax(counts[keep])]
+        color = ''.join(chr(int(c)) for c in peak).encode('hex')
         
         return color[:6]
 
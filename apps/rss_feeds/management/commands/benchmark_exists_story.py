@@ -0,0 +1,185 @@
+import time
+import zlib
+import random
+import difflib
+import datetime
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.models import Feed, MStory
+from utils.feed_functions import levenshtein_distance
+
+
+def legacy_exists_story(feed, story, story_content, existing_stories, new_story_hashes):
+    """The per-pair scan Feed._exists_story used before it had an index, kept
+       here as the reference its decisions are checked against."""
+    story_in_system = None
+    story_has_changed = False
+    story_link = feed.get_permalink(story)
+    existing_stories_hashes = existing_stories.keys()
+    story_pub_date = story.get('published')
+
+    for existing_story in existing_stories.values():
+        content_ratio = 0
+        if story.get('story_hash') == existing_story.story_hash:
+            story_in_system = existing_story
+        elif (story.get('story_hash') in existing_stories_hashes and
+            story.get('story_hash') != existing_story.story_hash):
+            continue
+        elif (existing_story.story_hash in new_story_hashes and
+              story.get('story_hash') != existing_story.story_hash):
+            continue
+
+        if 'story_latest_content_z' in existing_story:
+            existing_story_content = unicode(zlib.decompress(existing_story.story_latest_content_z))
+        elif 'story_content_z' in existing_story:
+            existing_story_content = unicode(zlib.decompress(existing_story.story_content_z))
+        else:
+            existing_story_content = u''
+
+        story_title_difference = abs(levenshtein_distance(story.get('title'),
+                                                          existing_story.story_title))
+        title_ratio = difflib.SequenceMatcher(None, story.get('title', ""),
+                                              existing_story.story_title).ratio()
+        if title_ratio < .75: continue
+
+        story_timedelta = existing_story.story_date - story_pub_date
+        if abs(story_timedelta.days) >= 1: continue
+
+        seq = difflib.SequenceMatcher(None, story_content, existing_story_content)
+
+        similiar_length_min = 1000
+        if (existing_story.story_permalink == story_link and
+            existing_story.story_title == story.get('title')):
+            similiar_length_min = 20
+
+        if (seq
+            and story_content
+            and len(story_content) > similiar_length_min
+            and existing_story_content
+            and seq.real_quick_ratio() > .9
+            and seq.quick_ratio() > .95):
+            content_ratio = seq.ratio()
+
+        if story_title_difference > 0 and content_ratio > .98:
+            story_in_system = existing_story
+            story_has_changed = True
+            break
+
+        if not story_in_system and content_ratio > .98:
+            story_in_system = existing_story
+            story_has_changed = True
+            break
+
+        if story_in_system and not story_has_changed:
+            if story_content != existing_story_content:
+                story_has_changed = True
+            if story_link != existing_story.story_permalink:
+                story_has_changed = True
+            break
+
+    return story_in_system, story_has_changed
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--stories', type='int', default=100,
+            help='Entries in the synthetic feed, and existing stories to check against.'),
+        make_option('-r', '--rounds', type='int', default=3,
+            help='Times to run each implementation over the feed.'),
+    )
+
+    def handle(self, *args, **options):
+        random.seed(1)
+        feed = Feed(pk=1, feed_title="Benchmark feed", feed_address="http://example.com/rss")
+        stories, existing_stories = self.synthetic_feed(feed, options['stories'])
+        new_story_hashes = [s['story_hash'] for s in stories]
+
+        def run(exists_story, index_stories=None):
+            decisions = []
+            start = time.time()
+            for _ in range(options['rounds']):
+                decisions = []
+                # Built once per fetch, as add_update_stories does.
+                kwargs = {}
+                if index_stories:
+                    kwargs['index'] = index_stories(existing_stories, new_story_hashes)
+                for story in stories:
+                    existing_story, changed = exists_story(story, story['story_content'],
+                                                           existing_stories, new_story_hashes,
+                                                           **kwargs)
+                    decisions.append((existing_story and existing_story.story_hash, changed))
+            return decisions, (time.time() - start) / options['rounds']
+
+        legacy_decisions, legacy_time = run(lambda *a: legacy_exists_story(feed, *a))
+        indexed_decisions, indexed_time = run(feed._exists_story, feed._index_existing_stories)
+
+        mismatches = [(story['story_hash'], legacy, indexed) for story, legacy, indexed
+                      in zip(stories, legacy_decisions, indexed_decisions) if legacy != indexed]
+
+        print " ---> %s entries against %s existing stories (%s matched, %s changed)" % (
+            len(stories), len(existing_stories),
+            len([d for d in legacy_decisions if d[0]]),
+            len([d for d in legacy_decisions if d[1]]))
+        print " ---> Legacy scan:   %.4f sec/feed" % legacy_time
+        print " ---> Indexed:       %.4f sec/feed (%.1fx)" % (indexed_time,
+                                                             legacy_time / max(indexed_time, .000001))
+        if mismatches:
+            print " ***> %s decisions changed:" % len(mismatches)
+            for mismatch in mismatches:
+                print "      %s: %s -> %s" % mismatch
+        else:
+            print " ---> All %s decisions identical." % len(stories)
+
+    def synthetic_feed(self, feed, count):
+        now = datetime.datetime.utcnow()
+        words = ["apple", "bridge", "cloud", "delta", "engine", "forest", "garden", "harbor",
+                 "island", "jungle", "kettle", "lantern", "meadow", "needle", "orchard"]
+
+        def paragraph(length):
+            return "<p>%s</p>" % " ".join(random.choice(words) for _ in range(length))
+
+        stories = []
+        existing_stories = {}
+        for i in range(count):
+            guid = "http://example.com/story/%s" % i
+            title = "Story number %s about %s" % (i, random.choice(words))
+            content = "".join(paragraph(60) for _ in range(random.randint(4, 12)))
+            published = now - datetime.timedelta(hours=i)
+            story = {
+                'title': title,
+                'guid': guid,
+                'link': guid,
+                'published': published,
+                'story_content': content,
+                'story_hash': MStory.feed_guid_hash_unsaved(feed.pk, guid),
+            }
+            kind = i % 10
+            existing_guid, existing_title, existing_content = guid, title, content
+            if kind in (0, 1, 2, 3, 4):
+                pass                                                # Unchanged
+            elif kind == 5:
+                existing_content = content + paragraph(3)           # Small edit
+            elif kind == 6:
+                existing_title = title + " (updated)"               # Retitled
+            elif kind == 7:
+                existing_guid = guid + "?rev=1"                     # New guid, same story
+            elif kind == 8:
+                existing_guid = "http://example.com/old/%s" % i     # Old, unrelated story
+                existing_title = "Older story %s" % i
+                existing_content = paragraph(200)
+                published = now - datetime.timedelta(days=30 + i)
+            else:
+                existing_guid = None                                # Brand new story
+            stories.append(story)
+
+            if existing_guid:
+                existing_story = MStory(story_feed_id=feed.pk,
+                                        story_date=published,
+                                        story_title=existing_title,
+                                        story_content_z=zlib.compress(existing_content),
+                                        story_permalink=existing_guid,
+                                        story_guid=existing_guid,
+                                        story_hash=MStory.feed_guid_hash_unsaved(feed.pk, existing_guid))
+                existing_stories[existing_story.story_hash] = existing_story
+
+        return stories, existing_stories
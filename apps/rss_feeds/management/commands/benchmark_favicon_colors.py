@@ -0,0 +1,108 @@
+import time
+import numpy
+import scipy
+import scipy.cluster
+import scipy.cluster.vq
+from StringIO import StringIO
+from PIL import Image
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.models import Feed, MFeedIcon
+from apps.rss_feeds.icon_importer import IconImporter
+
+
+def legacy_dominant_color(image):
+    """The kmeans clustering IconImporter used before, kept here as the reference
+       the palette histogram's colors are checked against."""
+    NUM_CLUSTERS = 5
+
+    if image.mode == '1':
+        image.convert('L')
+    ar = numpy.array(image)
+    shape = ar.shape
+    if len(shape) > 2:
+        ar = ar.reshape(scipy.product(shape[:2]), shape[2])
+
+    codes, _ = scipy.cluster.vq.kmeans(ar, NUM_CLUSTERS)
+
+    original_codes = codes
+    for low, hi in [(60, 200), (35, 230), (10, 250)]:
+        codes = scipy.array([code for code in codes
+                             if not ((code[0] < low and code[1] < low and code[2] < low) or
+                                     (code[0] > hi and code[1] > hi and code[2] > hi))])
+        if not len(codes): codes = original_codes
+        else: break
+
+    vecs, _ = scipy.cluster.vq.vq(ar, codes)
+    counts, bins = scipy.histogram(vecs, len(codes))
+    index_max = scipy.argmax(counts)
+    peak = codes[index_max]
+    color = ''.join(chr(c) for c in peak).encode('hex')
+
+    return color[:6]
+
+
+def color_distance(color_a, color_b):
+    rgb_a = [int(color_a[i:i+2], 16) for i in (0, 2, 4)]
+    rgb_b = [int(color_b[i:i+2], 16) for i in (0, 2, 4)]
+    return sum((a - b) ** 2 for a, b in zip(rgb_a, rgb_b)) ** .5
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--icons', type='int', default=1000,
+            help='Stored favicons to compare colors on.'),
+        make_option('-d', '--distance', type='int', default=48,
+            help='RGB distance under which two colors count as the same choice.'),
+        make_option('-V', '--verbose', action='store_true', default=False),
+    )
+
+    def handle(self, *args, **options):
+        feed_icons = MFeedIcon.objects(not_found=False, data__ne=None).limit(options['icons'])
+        images = []
+        for feed_icon in feed_icons:
+            try:
+                image = Image.open(StringIO(feed_icon.data.decode('base64')))
+                image.load()
+            except (IOError, ValueError):
+                continue
+            images.append((feed_icon.feed_id, image))
+        if not images:
+            print " ---> No stored favicons to compare."
+            return
+
+        importer = IconImporter(Feed(pk=images[0][0]))
+        images = [(feed_id, importer.normalize_image(icon)) for feed_id, icon in images]
+
+        def run(dominant_color):
+            colors = []
+            start = time.time()
+            for _, image in images:
+                try:
+                    colors.append(dominant_color(image.copy()))
+                except IndexError:
+                    colors.append(None)
+            return colors, time.time() - start
+
+        legacy_colors, legacy_time = run(legacy_dominant_color)
+        palette_colors, palette_time = run(importer.determine_dominant_color_in_image)
+
+        same = close = 0
+        far = []
+        for (feed_id, _), legacy, palette in zip(images, legacy_colors, palette_colors):
+            if legacy == palette:
+                same += 1
+            elif legacy and palette and color_distance(legacy, palette) < options['distance']:
+                close += 1
+            else:
+                far.append((feed_id, legacy, palette))
+
+        print " ---> %s favicons" % len(images)
+        print " ---> kmeans:  %.2f ms/icon" % (1000 * legacy_time / len(images))
+        print " ---> Palette: %.2f ms/icon (%.1fx)" % (1000 * palette_time / len(images),
+                                                    legacy_time / max(palette_time, .000001))
+        print " ---> %s identical, %s within %s, %s different (%.1f%% matching)" % (
+            same, close, options['distance'], len(far), 100.0 * (same + close) / len(images))
+        if options['verbose']:
+            for feed_id, legacy, palette in far:
+                print "      Feed %s: #%s -> #%s" % (feed_id, legacy, palette)
@@ -0,0 +1,54 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from apps.rss_feeds.models import Feed, MStory
+from apps.reader.models import UserSubscription
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-f", "--feed", dest="feed", type='int', help="Feed id to recount (pick a popular one)."),
+        make_option("-s", "--subscribers", dest="subscribers", type='int', default=5000,
+                    help="Most recently read subscribers to recount."),
+        make_option("-V", "--verbose", dest="verbose", action="store_true", default=False),
+    )
+
+    def handle(self, *args, **options):
+        settings.LOG_TO_STREAM = options['verbose']
+        feed = Feed.get_by_id(options['feed'])
+
+        def subscribers():
+            return list(UserSubscription.objects.filter(feed=feed, active=True)
+                        .select_related('user__profile')
+                        .order_by('-last_read_date')[:options['subscribers']])
+
+        stories = MStory.objects(story_feed_id=feed.pk, story_date__gte=feed.unread_cutoff)
+        stories = Feed.format_stories(stories, feed.pk)
+
+        user_subs = subscribers()
+        start = time.time()
+        for sub in user_subs:
+            sub.calculate_feed_scores(silent=True, stories=stories)
+        legacy_time = time.time() - start
+        legacy_counts = self.counts(subscribers())
+
+        user_subs = subscribers()
+        start = time.time()
+        UserSubscription.calculate_feed_scores_for_subscribers(feed, user_subs, stories=stories)
+        bulk_time = time.time() - start
+        bulk_counts = self.counts(subscribers())
+
+        print " ---> %s: %s stories, %s subscribers" % (feed, len(stories), len(user_subs))
+        print " ---> Per subscription: %.3f sec/feed" % legacy_time
+        print " ---> Bulk:             %.3f sec/feed (%.1fx)" % (bulk_time, legacy_time / max(bulk_time, .000001))
+        mismatches = [sub_id for sub_id in legacy_counts if legacy_counts[sub_id] != bulk_counts.get(sub_id)]
+        if mismatches:
+            print " ***> %s subscriptions counted differently: %s" % (len(mismatches), mismatches[:20])
+        else:
+            print " ---> All %s unread counts identical." % len(legacy_counts)
+
+    def counts(self, user_subs):
+        return dict((sub.pk, (sub.unread_count_negative, sub.unread_count_neutral,
+                              sub.unread_count_positive, sub.is_trained))
+                    for sub in user_subs)
@@ -0,0 +1,60 @@
+import time
+from bson import BSON
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.models import Feed, MStory
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-n", "--stories", dest="stories", type='int', default=1000),
+        make_option("-f", "--feed", dest="feed", type='int', help="Only stories from this feed."),
+    )
+
+    def handle(self, *args, **options):
+        spec = {}
+        if options['feed']:
+            spec['story_feed_id'] = options['feed']
+        story_hashes = [s['story_hash'] for s in
+                        MStory.raw_stories(fields=['story_hash'], sort=[('story_date', -1)],
+                                           limit=options['stories'], **spec)]
+
+        start = time.time()
+        stories_db = MStory.objects(story_hash__in=story_hashes).order_by('-story_date')
+        stories = Feed.format_stories(stories_db)
+        format_time = time.time() - start
+
+        start = time.time()
+        raw_stories = Feed.format_raw_stories(MStory.raw_stories(story_hashes, sort=[('story_date', -1)]))
+        raw_time = time.time() - start
+
+        start = time.time()
+        Feed.format_raw_stories(MStory.raw_stories(story_hashes, sort=[('story_date', -1)],
+                                                   content=False), content=False)
+        raw_no_content_time = time.time() - start
+
+        start = time.time()
+        scoring_stats = {}
+        list(MStory.scoring_stories(story_hashes, stats=scoring_stats, sort=[('story_date', -1)]))
+        scoring_time = time.time() - start
+
+        full_bytes = sum(len(BSON.encode(doc)) for doc in
+                         MStory._get_collection().find({'story_hash': {'$in': story_hashes}}))
+        format_bytes = sum(len(BSON.encode(doc)) for doc in MStory.raw_stories(story_hashes))
+
+        print " ---> %s stories" % len(stories)
+        print " ---> format_stories:                  %.4f sec" % format_time
+        print " ---> format_raw_stories:              %.4f sec (%.1fx)" % (
+            raw_time, format_time / max(raw_time, .000001))
+        print " ---> format_raw_stories, no content:  %.4f sec (%.1fx)" % (
+            raw_no_content_time, format_time / max(raw_no_content_time, .000001))
+        print " ---> scoring_stories:                 %.4f sec (%.1fx)" % (
+            scoring_time, format_time / max(scoring_time, .000001))
+        print " ---> Bytes read: %.1fKB full documents, %.1fKB formatted fields, %.1fKB scoring fields" % (
+            full_bytes / 1024.0, format_bytes / 1024.0, scoring_stats.get('bytes', 0) / 1024.0)
+        mismatches = [story['story_hash'] for story, raw_story in zip(stories, raw_stories)
+                      if story != raw_story]
+        if mismatches or len(stories) != len(raw_stories):
+            print " ***> %s stories formatted differently: %s" % (len(mismatches), mismatches[:10])
+        else:
+            print " ---> All %s stories identical." % len(stories)
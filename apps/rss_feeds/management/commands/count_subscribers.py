@@ -8,9 +8,20 @@ class Command(BaseCommand):
         make_option("-t", "--title", dest="title", default=None),
         make_option("-V", "--verbose", dest="verbose", action="store_true"),
         make_option("-D", "--delete", dest="delete", action="store_true"),
+        make_option("-b", "--bulk", dest="bulk", action="store_true",
+                    help="Recount with grouped queries, a chunk of feeds at a time."),
     )
 
     def handle(self, *args, **options):
+        if options['bulk']:
+            if options['feed']:
+                feed_ids = [int(f) for f in options['feed'].split(',')]
+            else:
+                feed_ids = Feed.objects.values_list('pk', flat=True)
+            counted, changed = Feed.count_subscribers_for_feeds(feed_ids, verbose=True)
+            print " ---> Recounted %s feeds, %s changed" % (counted, changed)
+            return
+        
         if options['title']:
             feeds = Feed.objects.filter(feed_title__icontains=options['title'])
         elif options['feed']:
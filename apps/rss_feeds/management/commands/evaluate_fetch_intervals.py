@@ -0,0 +1,113 @@
+import random
+import datetime
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from apps.rss_feeds.models import Feed, MStory, MFetchHistory
+from apps.rss_feeds.scheduler import PublishingRhythm
+from utils import json_functions as json
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-f", "--feed", dest="feed", type='int', help="Evaluate a single feed id."),
+        make_option("-n", "--feeds", dest="feeds", type='int', default=100,
+                    help="Active feeds with stories last month to sample."),
+        make_option("-t", "--train", dest="train", type='int', default=42,
+                    help="Days of stories the rhythm is learned from."),
+        make_option("-d", "--days", dest="days", type='int', default=14,
+                    help="Days after that, replayed against both schedules."),
+        make_option("-V", "--verbose", dest="verbose", action="store_true", default=False),
+    )
+
+    def handle(self, *args, **options):
+        random.seed(1)
+        # The baseline is the subscriber and story count schedule on its own.
+        settings.ADAPTIVE_FETCH_INTERVALS = False
+
+        if options['feed']:
+            feeds = [Feed.get_by_id(options['feed'])]
+        else:
+            feeds = Feed.objects.filter(active=True, active_subscribers__gte=1,
+                                        stories_last_month__gte=1).order_by('?')[:options['feeds']]
+
+        now = datetime.datetime.utcnow()
+        split = now - datetime.timedelta(days=options['days'])
+        totals = {'baseline': [0, 0, []], 'adaptive': [0, 0, []]}
+        recent_fetches = recent_unchanged = 0
+
+        for feed in feeds:
+            story_dates = sorted(s['story_date'] for s in MStory.raw_stories(
+                fields=['story_date'],
+                story_feed_id=feed.pk,
+                story_date={'$gte': split - datetime.timedelta(days=options['train']), '$lte': now}))
+            trained_dates = [d for d in story_dates if d < split]
+            replayed_dates = [d for d in story_dates if d >= split]
+            monthly_counts = feed.data.story_count_history and json.decode(feed.data.story_count_history)
+            if isinstance(monthly_counts, dict):
+                monthly_counts = monthly_counts['months']
+            rhythm = PublishingRhythm.from_story_dates(trained_dates, now=split, days=options['train'],
+                                                       monthly_counts=monthly_counts)
+            baseline = feed.get_next_scheduled_update(force=True, verbose=False)
+            subs = (feed.active_premium_subscribers +
+                    ((feed.active_subscribers - feed.active_premium_subscribers) / 10.0))
+
+            def adaptive(fetch_date):
+                if rhythm.story_count < PublishingRhythm.MIN_STORIES:
+                    return baseline
+                return rhythm.fetch_interval(fetch_date, subs, baseline)
+
+            results = {
+                'baseline': self.replay(replayed_dates, split, now, lambda d: baseline),
+                'adaptive': self.replay(replayed_dates, split, now, adaptive),
+            }
+            for policy, (fetches, empty, delays) in results.items():
+                totals[policy][0] += fetches
+                totals[policy][1] += empty
+                totals[policy][2].extend(delays)
+
+            # The few most recent real fetches, for how often the live schedule comes up empty.
+            history = MFetchHistory.objects(feed_id=feed.pk).first()
+            for fetch in (history and history.feed_fetch_history) or []:
+                recent_fetches += 1
+                if fetch[1] in (208, 304):
+                    recent_unchanged += 1
+
+            if options['verbose']:
+                print " ---> %-30s %3s stories: %s" % (unicode(feed)[:30], len(replayed_dates), ", ".join(
+                    "%s %s fetches (%s empty, %.0f min delay)" % (
+                        policy, fetches, empty, sum(delays) / max(1, len(delays)))
+                    for policy, (fetches, empty, delays) in sorted(results.items())))
+
+        print " ---> Trained on %s days, replayed %s days of %s feeds" % (
+            options['train'], options['days'], len(feeds))
+        for policy in ('baseline', 'adaptive'):
+            fetches, empty, delays = totals[policy]
+            delays = sorted(delays)
+            print " ---> %-8s: %6s fetches, %5.1f%% empty, story delay %5.1f min avg / %5.1f min p90" % (
+                policy, fetches, 100.0 * empty / max(1, fetches),
+                sum(delays) / max(1, len(delays)),
+                delays[int(.9 * (len(delays) - 1))] if delays else 0)
+        print " ---> Recent real fetches: %s, %.1f%% unchanged (only the last 5 per feed are kept)" % (
+            recent_fetches, 100.0 * recent_unchanged / max(1, recent_fetches))
+
+    def replay(self, story_dates, start, end, interval):
+        """Fetch on `interval` from `start` to `end`, with the same jitter as
+           `Feed.set_next_scheduled_update`, and see when each story is picked up."""
+        fetches = empty = 0
+        delays = []
+        fetch_date = start
+        s = 0
+        while fetch_date < end:
+            minutes = max(1, int(interval(fetch_date)))
+            fetch_date += datetime.timedelta(minutes=minutes + random.randint(0, minutes) / 4)
+            fetches += 1
+            new_stories = 0
+            while s < len(story_dates) and story_dates[s] <= fetch_date:
+                delays.append((fetch_date - story_dates[s]).total_seconds() / 60)
+                new_stories += 1
+                s += 1
+            if not new_stories:
+                empty += 1
+
+        return fetches, empty, delays
@@ -26,6 +26,11 @@ class Command(BaseCommand):
             dest='skip', default=0, help='Skip stories per month < #.'),
         make_option('-w', '--workerthreads', type='int', default=4,
             help='Worker threads that will fetch feeds in parallel.'),
+        make_option('-m', '--fetch_mode', type='choice', choices=['serial', 'concurrent'],
+            dest='fetch_mode', default='serial',
+            help='serial fetches one feed at a time per worker, concurrent prefetches many.'),
+        make_option('-c', '--concurrency', type='int', default=100,
+            help='Requests kept in flight per worker in concurrent fetch mode.'),
     )
 
     def handle(self, *args, **options):
@@ -6,6 +6,8 @@ import gc
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option("-f", "--feed", dest="feed", default=None),
+        make_option("-d", "--dryrun", dest="dryrun", action="store_true", default=False,
+                    help="Report the stories and bytes that would be deleted, without deleting."),
     )
 
     def handle(self, *args, **options):
@@ -18,8 +20,15 @@ class Command(BaseCommand):
         else:
             feeds = Feed.objects.filter(feed_id=options['feed'])
 
+        stats = {}
         for f in queryset_iterator(feeds):
-            f.trim_feed(verbose=True)
+            f.trim_feed(verbose=True, dryrun=options['dryrun'], stats=stats)
+        
+        if options['dryrun']:
+            print " ---> Would delete %s stories (%.1f MB)" % (stats.get('stories', 0),
+                                                             stats.get('bytes', 0) / (1024.0*1024))
+        else:
+            print " ---> Deleted %s stories" % stats.get('stories', 0)
         
 
 def queryset_iterator(queryset, chunksize=100):
@@ -12,6 +12,7 @@ import pymongo
 import HTMLParser
 from collections import defaultdict
 from operator import itemgetter
+from bson import BSON, SON
 from bson.objectid import ObjectId
 from BeautifulSoup import BeautifulSoup
 from pyes.exceptions import NotFoundException
@@ -19,6 +20,7 @@ from pyes.exceptions import NotFoundException
 from django.db import models
 from django.db import IntegrityError
 from django.conf import settings
+from django.db.models import Count
 from django.db.models.query import QuerySet
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
@@ -29,19 +31,20 @@ from mongoengine.base import ValidationError
 from vendor.timezones.utilities import localtime_for_timezone
 from apps.rss_feeds.tasks import UpdateFeeds, PushFeeds, ScheduleCountTagsForUser
 from apps.rss_feeds.text_importer import TextImporter
-from apps.search.models import SearchStory, SearchFeed
+from apps.rss_feeds.scheduler import FeedScheduler, PublishingRhythm
+from apps.search.models import SearchStory, SearchFeed, BulkStoryIndexer, search_document
+from apps.search.autocomplete import FeedPrefixIndex
 from apps.statistics.rstats import RStats
 from utils import json_functions as json
 from utils import feedfinder, feedparser
 from utils import urlnorm
 from utils import log as logging
 from utils.fields import AutoOneToOneField
-from utils.feed_functions import levenshtein_distance
+from utils.feed_functions import levenshtein_distance, chunks
 from utils.feed_functions import timelimit, TimeoutError
 from utils.feed_functions import relative_timesince
 from utils.feed_functions import seconds_timesince
 from utils.story_functions import strip_tags, htmldiff, strip_comments, strip_comments__lxml
-from utils.story_functions import prep_for_search
 
 ENTRY_NEW, ENTRY_UPDATED, ENTRY_SAME, ENTRY_ERR = range(4)
 
@@ -194,6 +197,50 @@ class Feed(models.Model):
             
         return feed
     
+    def save_canonical_state(self, r=None):
+        """
+        Records when this feed's `canonical()` last changed, so the per-user feed
+        lists load_feeds caches (see RUserFeedList) know when to rebuild it. The
+        last update changes on every fetch, so it's kept alongside rather than
+        counted as a change, and filled in when the cached feed is served.
+        
+            FLC  hash of feed_id -> "<changed ms>:<last update>:<fingerprint>"
+        """
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        
+        feed = self.canonical(include_favicon=False)
+        del feed['updated'], feed['updated_seconds_ago']
+        fingerprint = hashlib.sha1(json.encode(feed)).hexdigest()[:12]
+        last_update = int(time.mktime(self.last_update.timetuple())) if self.last_update else 0
+        changed = int(time.time() * 1000)
+        
+        state = r.hget('FLC', self.pk)
+        if state:
+            last_changed, _, last_fingerprint = state.split(':')
+            if last_fingerprint == fingerprint:
+                changed = int(last_changed)
+        r.hset('FLC', self.pk, "%s:%s:%s" % (changed, last_update, fingerprint))
+        
+        return changed, last_update
+    
+    @classmethod
+    def canonical_states(cls, feed_ids, r=None):
+        """When each feed's canonical last changed and when it was last updated,
+           for feeds with a recorded state."""
+        if not feed_ids:
+            return {}
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        
+        states = {}
+        for feed_id, state in zip(feed_ids, r.hmget('FLC', feed_ids)):
+            if state:
+                changed, last_update, _ = state.split(':')
+                states[feed_id] = (int(changed), int(last_update))
+        
+        return states
+    
     def save(self, *args, **kwargs):
         if not self.last_update:
             self.last_update = datetime.datetime.utcnow()
@@ -215,8 +262,13 @@ class Feed(models.Model):
         if len(feed_link) > max_feed_link:
             self.feed_link = feed_link[:max_feed_link]
         
+        created = not self.pk
         try:
             super(Feed, self).save(*args, **kwargs)
+            if settings.FEED_LIST_CACHE:
+                self.save_canonical_state()
+            if created:
+                FeedPrefixIndex.feed_changed(self.pk)
         except IntegrityError, e:
             logging.debug(" ---> ~FRFeed save collision (%s), checking dupe..." % e)
             duplicate_feeds = Feed.objects.filter(feed_address=self.feed_address,
@@ -267,10 +319,29 @@ class Feed(models.Model):
 
         self.search_indexed = True
         self.save()
+        
+        BulkStoryIndexer([self.pk]).run()
+    
+    @classmethod
+    def index_feeds_stories_for_search(cls, feed_ids, checkpoint=None, workers=1):
+        """Indexes the stories of every feed in `feed_ids` that isn't indexed yet,
+           together in bulk requests. Resuming an interrupted `checkpoint` also
+           takes up the feeds it had already marked as indexed."""
+        resuming = BulkStoryIndexer.resuming(checkpoint)
+        unindexed_feed_ids = []
+        for feed_id in feed_ids:
+            feed = cls.get_by_id(feed_id)
+            if not feed: continue
+            if feed.search_indexed and not resuming: continue
             
-        stories = MStory.objects(story_feed_id=self.pk)
-        for story in stories:
-            story.index_story_for_search()
+            if not feed.search_indexed:
+                feed.search_indexed = True
+                feed.save()
+            unindexed_feed_ids.append(feed.pk)
+        
+        if not unindexed_feed_ids: return
+        
+        return BulkStoryIndexer(unindexed_feed_ids, checkpoint=checkpoint, workers=workers).run()
     
     def sync_redis(self):
         return MStory.sync_feed_redis(self.pk)
@@ -288,6 +359,11 @@ class Feed(models.Model):
     
     @classmethod
     def autocomplete(self, prefix, limit=5):
+        if settings.FEED_AUTOCOMPLETE:
+            feed_index = FeedPrefixIndex.shared()
+            if feed_index:
+                return feed_index.lookup(prefix, limit=limit)
+        
         results = SearchFeed.query(prefix)
         feed_ids = [result.feed_id for result in results[:5]]
 
@@ -429,7 +505,7 @@ class Feed(models.Model):
         if isinstance(feeds, QuerySet):
             feeds = [f.pk for f in feeds]
         
-        r.srem('queued_feeds', *feeds)
+        r.zrem('queued_feeds', *feeds)
         now = datetime.datetime.now().strftime("%s")
         p = r.pipeline()
         for feed_id in feeds:
@@ -444,18 +520,22 @@ class Feed(models.Model):
     def drain_task_feeds(cls):
         r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
 
+        now = int(datetime.datetime.utcnow().strftime("%s"))
         tasked_feeds = r.zrange('tasked_feeds', 0, -1)
         logging.debug(" ---> ~FRDraining %s tasked feeds..." % len(tasked_feeds))
-        r.sadd('queued_feeds', *tasked_feeds)
+        if tasked_feeds:
+            r.zadd('queued_feeds', **dict((feed_id, now) for feed_id in tasked_feeds))
         r.zremrangebyrank('tasked_feeds', 0, -1)
 
         errored_feeds = r.zrange('error_feeds', 0, -1)
         logging.debug(" ---> ~FRDraining %s errored feeds..." % len(errored_feeds))
-        r.sadd('queued_feeds', *errored_feeds)
+        if errored_feeds:
+            r.zadd('queued_feeds', **dict((feed_id, now) for feed_id in errored_feeds))
         r.zremrangebyrank('error_feeds', 0, -1)
         
     def update_all_statistics(self, full=True, force=False):
-        self.count_subscribers()
+        if force or settings.COUNT_SUBSCRIBERS_ON_FETCH:
+            self.count_subscribers()
         self.calculate_last_story_date()
         
         count_extra = False
@@ -464,6 +544,8 @@ class Feed(models.Model):
         
         if force or full:
             self.save_feed_stories_last_month()
+            if settings.ADAPTIVE_FETCH_INTERVALS:
+                self.save_publishing_rhythm()
 
         if force or (full and count_extra):
             self.save_popular_authors()
@@ -553,15 +635,15 @@ class Feed(models.Model):
         return bool(feed_address), feed
 
     def save_feed_history(self, status_code, message, exception=None):
-        fetch_history = MFetchHistory.add(feed_id=self.pk, 
-                                          fetch_type='feed',
-                                          code=int(status_code),
-                                          message=message,
-                                          exception=exception)
+        MFetchHistory.add(feed_id=self.pk, 
+                          fetch_type='feed',
+                          code=int(status_code),
+                          message=message,
+                          exception=exception)
             
-        if status_code not in (200, 304):
+        if status_code not in (200, 208, 304):
             self.errors_since_good += 1
-            self.count_errors_in_history('feed', status_code, fetch_history=fetch_history)
+            self.count_errors_in_history('feed', status_code)
             self.set_next_scheduled_update()
         elif self.has_feed_exception or self.errors_since_good:
             self.errors_since_good = 0
@@ -570,14 +652,14 @@ class Feed(models.Model):
             self.save()
         
     def save_page_history(self, status_code, message, exception=None):
-        fetch_history = MFetchHistory.add(feed_id=self.pk, 
-                                          fetch_type='page',
-                                          code=int(status_code),
-                                          message=message,
-                                          exception=exception)
+        MFetchHistory.add(feed_id=self.pk, 
+                          fetch_type='page',
+                          code=int(status_code),
+                          message=message,
+                          exception=exception)
             
-        if status_code not in (200, 304):
-            self.count_errors_in_history('page', status_code, fetch_history=fetch_history)
+        if status_code not in (200, 208, 304):
+            self.count_errors_in_history('page', status_code)
         elif self.has_page_exception or not self.has_page:
             self.has_page_exception = False
             self.has_page = True
@@ -589,8 +671,8 @@ class Feed(models.Model):
         if not fetch_history:
             fetch_history = MFetchHistory.feed(self.pk)
         fh = fetch_history[exception_type + '_fetch_history']
-        non_errors = [h for h in fh if h['status_code'] and int(h['status_code'])     in (200, 304)]
-        errors     = [h for h in fh if h['status_code'] and int(h['status_code']) not in (200, 304)]
+        non_errors = [h for h in fh if h['status_code'] and int(h['status_code'])     in (200, 208, 304)]
+        errors     = [h for h in fh if h['status_code'] and int(h['status_code']) not in (200, 208, 304)]
         
         if len(non_errors) == 0 and len(errors) > 1:
             self.active = True
@@ -662,6 +744,65 @@ class Feed(models.Model):
                     self.feed_title,
                 ),
 
+    @classmethod
+    def count_subscribers_for_feeds(cls, feed_ids, chunk_size=1000, verbose=False):
+        """
+        Recounts subscribers for many feeds at once, with four grouped counts for
+        each chunk of feeds instead of four counts for every feed. Branched feeds
+        share their original feed's counts, like `count_subscribers`. Only feeds
+        whose counts changed are written, a query per distinct set of counts.
+        """
+        SUBSCRIBER_EXPIRE = datetime.datetime.now() - datetime.timedelta(days=settings.SUBSCRIBER_EXPIRE)
+        from apps.reader.models import UserSubscription
+        
+        count_fields = ['num_subscribers', 'active_subscribers',
+                        'premium_subscribers', 'active_premium_subscribers']
+        count_filters = [
+            {},
+            dict(active=True, user__profile__last_seen_on__gte=SUBSCRIBER_EXPIRE),
+            dict(active=True, user__profile__is_premium=True),
+            dict(active=True, user__profile__is_premium=True,
+                 user__profile__last_seen_on__gte=SUBSCRIBER_EXPIRE),
+        ]
+        counted = changed = 0
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        
+        for feed_ids_chunk in chunks(sorted(set(int(f) for f in feed_ids)), chunk_size):
+            feeds = Feed.objects.filter(pk__in=feed_ids_chunk).values('id', 'branch_from_feed', *count_fields)
+            originals = dict((f['id'], f['branch_from_feed'] or f['id']) for f in feeds)
+            family = dict((original_id, original_id) for original_id in originals.values())
+            for branch in Feed.objects.filter(branch_from_feed__in=set(originals.values()))\
+                                      .values('id', 'branch_from_feed'):
+                family[branch['id']] = branch['branch_from_feed']
+            
+            counts = defaultdict(lambda: [0] * len(count_fields))
+            subs = UserSubscription.objects.filter(feed__in=family.keys())
+            for c, count_filter in enumerate(count_filters):
+                for row in subs.filter(**count_filter).values('feed').annotate(subs=Count('id')).order_by():
+                    counts[family[row['feed']]][c] += row['subs']
+            
+            feeds_by_counts = defaultdict(list)
+            for feed in feeds:
+                feed_counts = tuple(counts[originals[feed['id']]])
+                if feed_counts != tuple(feed[field] for field in count_fields):
+                    feeds_by_counts[feed_counts].append(feed['id'])
+            changed_feed_ids = []
+            for feed_counts, feed_ids_with_counts in feeds_by_counts.items():
+                Feed.objects.filter(pk__in=feed_ids_with_counts).update(**dict(zip(count_fields, feed_counts)))
+                changed_feed_ids.extend(feed_ids_with_counts)
+            # The updates skip save(), so the cached feed lists are told here.
+            if settings.FEED_LIST_CACHE and changed_feed_ids:
+                for feed in Feed.objects.filter(pk__in=changed_feed_ids):
+                    feed.save_canonical_state(r=r)
+            changed += len(changed_feed_ids)
+            counted += len(feeds)
+            
+            if verbose:
+                logging.debug(" ---> ~SN~FBRecounted subscribers for ~SB%s~SN feeds, ~SB%s~SN changed" % (
+                              counted, changed))
+        
+        return counted, changed
+    
     def _split_favicon_color(self):
         color = self.favicon_color
         if color:
@@ -747,6 +888,10 @@ class Feed(models.Model):
         
         Save format: [('YYYY-MM, #), ...]
         Example output: [(2010-12, 123), (2011-01, 146)]
+        
+        Months since the history was last saved come from the counters kept as
+        stories are saved (see `count_new_stories`), and the current month is
+        recounted. Only a feed without any history is counted in full.
         """
         now = datetime.datetime.utcnow()
         min_year = now.year
@@ -758,30 +903,24 @@ class Feed(models.Model):
         if isinstance(current_counts, dict):
             current_counts = current_counts['months']
 
-        if not current_counts:
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        counted_months = r.hgetall('SH:%s' % self.pk)
+        this_month = u'%s-%s' % (now.year, now.month)
+        
+        if current_counts:
+            dates = dict((month, int(count)) for month, count in counted_months.items())
+            month_start = datetime.datetime(now.year, now.month, 1)
+            next_month_start = datetime.datetime(now.year + now.month / 12, now.month % 12 + 1, 1)
+            stories_this_month = MStory.objects(story_feed_id=self.pk,
+                                                story_date__gte=month_start,
+                                                story_date__lt=next_month_start).count()
+            dates[this_month] = max(dates.get(this_month, 0), stories_this_month)
+        else:
             current_counts = []
-
-        # Count stories, aggregate by year and month. Map Reduce!
-        map_f = """
-            function() {
-                var date = (this.story_date.getFullYear()) + "-" + (this.story_date.getMonth()+1);
-                emit(date, 1);
-            }
-        """
-        reduce_f = """
-            function(key, values) {
-                var total = 0;
-                for (var i=0; i < values.length; i++) {
-                    total += values[i];
-                }
-                return total;
-            }
-        """
-        dates = {}
-        res = MStory.objects(story_feed_id=self.pk).map_reduce(map_f, reduce_f, output='inline')
-        for r in res:
-            dates[r.key] = r.value
-            year = int(re.findall(r"(\d{4})-\d{1,2}", r.key)[0])
+            dates = self.count_stories_by_month()
+        
+        for month in dates.keys():
+            year = int(re.findall(r"(\d{4})-\d{1,2}", month)[0])
             if year < min_year and year > 2000:
                 min_year = year
                 
@@ -816,6 +955,73 @@ class Feed(models.Model):
             self.average_stories_per_month = int(round(total / float(month_count)))
         self.save()
         
+        # Earlier months are in the saved history now.
+        saved_months = [month for month in counted_months.keys() if month != this_month]
+        if saved_months:
+            r.hdel('SH:%s' % self.pk, *saved_months)
+    
+    def count_stories_by_month(self):
+        # Count stories, aggregate by year and month. Map Reduce!
+        map_f = """
+            function() {
+                var date = (this.story_date.getFullYear()) + "-" + (this.story_date.getMonth()+1);
+                emit(date, 1);
+            }
+        """
+        reduce_f = """
+            function(key, values) {
+                var total = 0;
+                for (var i=0; i < values.length; i++) {
+                    total += values[i];
+                }
+                return total;
+            }
+        """
+        dates = {}
+        res = MStory.objects(story_feed_id=self.pk).map_reduce(map_f, reduce_f, output='inline')
+        for r in res:
+            dates[r.key] = r.value
+        
+        return dates
+    
+    def count_new_stories(self, story_dates):
+        """Adds newly saved stories to this feed's monthly counters (SH:<feed_id>)."""
+        months = defaultdict(int)
+        for story_date in story_dates:
+            if story_date:
+                months[u'%s-%s' % (story_date.year, story_date.month)] += 1
+        
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        pipeline = r.pipeline()
+        for month, count in months.items():
+            pipeline.hincrby('SH:%s' % self.pk, month, count)
+        pipeline.execute()
+        
+    def save_publishing_rhythm(self, days=60):
+        now = datetime.datetime.utcnow()
+        story_dates = [s['story_date'] for s in MStory.raw_stories(
+            fields=['story_date'],
+            story_feed_id=self.pk,
+            story_date={'$gte': now - datetime.timedelta(days=days)})]
+        monthly_counts = self.data.story_count_history and json.decode(self.data.story_count_history)
+        if isinstance(monthly_counts, dict):
+            monthly_counts = monthly_counts['months']
+        rhythm = PublishingRhythm.from_story_dates(story_dates, now=now, days=days,
+                                                   monthly_counts=monthly_counts)
+
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        r.set('PR:%s' % self.pk, rhythm.to_json())
+        r.expire('PR:%s' % self.pk, 60*60*24*7)
+
+        return rhythm
+
+    @property
+    def publishing_rhythm(self):
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        rhythm = r.get('PR:%s' % self.pk)
+        if rhythm:
+            return PublishingRhythm.from_json(rhythm)
+
         
     def save_classifier_counts(self):
         from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
@@ -890,6 +1096,9 @@ class Feed(models.Model):
             'debug': kwargs.get('debug'),
             'fpf': kwargs.get('fpf'),
             'feed_xml': kwargs.get('feed_xml'),
+            'fetch_mode': kwargs.get('fetch_mode'),
+            'concurrency': kwargs.get('concurrency'),
+            'prefetcher': kwargs.get('prefetcher'),
         }
         disp = feed_fetcher.Dispatcher(options, 1)        
         disp.add_jobs([[self.pk]])
@@ -929,8 +1138,12 @@ class Feed(models.Model):
     
     @classmethod
     def get_by_name(cls, query, limit=1):
-        results = SearchFeed.query(query)
-        feed_ids = [result.feed_id for result in results]
+        feed_index = settings.FEED_AUTOCOMPLETE and FeedPrefixIndex.shared()
+        if feed_index:
+            feed_ids = feed_index.lookup(query, limit=max(limit, 5))
+        else:
+            results = SearchFeed.query(query)
+            feed_ids = [result.feed_id for result in results]
         
         if limit == 1:
             return Feed.get_by_id(feed_ids[0])
@@ -941,16 +1154,20 @@ class Feed(models.Model):
         ret_values = dict(new=0, updated=0, same=0, error=0)
         error_count = self.error_count
         new_story_hashes = [s.get('story_hash') for s in stories]
+        new_stories = []
         
         if settings.DEBUG or verbose:
             logging.debug("   ---> [%-30s] ~FBChecking ~SB%s~SN new/updated against ~SB%s~SN stories" % (
                           self.title[:30],
                           len(stories),
                           len(existing_stories.keys())))
+        existing_story_index = self._index_existing_stories(existing_stories, new_story_hashes)
+        
         @timelimit(2)
         def _1(story, story_content, existing_stories, new_story_hashes):
             existing_story, story_has_changed = self._exists_story(story, story_content, 
-                                                                   existing_stories, new_story_hashes)
+                                                                   existing_stories, new_story_hashes,
+                                                                   index=existing_story_index)
             return existing_story, story_has_changed
         
         for story in stories:
@@ -993,15 +1210,7 @@ class Feed(models.Model):
                        story_tags = story_tags
                 )
                 s.extract_image_urls()
-                try:
-                    s.save()
-                    ret_values['new'] += 1
-                except (IntegrityError, OperationError), e:
-                    ret_values['error'] += 1
-                    if settings.DEBUG:
-                        logging.info('   ---> [%-30s] ~SN~FRIntegrityError on new story: %s - %s' % (self.feed_title[:30], story.get('guid'), e))
-                if self.search_indexed:
-                    s.index_story_for_search()
+                new_stories.append(s)
             elif existing_story and story_has_changed and not updates_off and ret_values['updated'] < 3:
                 # update story
                 original_content = None
@@ -1075,8 +1284,31 @@ class Feed(models.Model):
                 if verbose:
                     logging.debug("Unchanged story (%s): %s / %s " % (story.get('story_hash'), story.get('guid'), story.get('title')))
         
+        if new_stories:
+            self.save_new_stories(new_stories, ret_values)
+        
         return ret_values
     
+    def save_new_stories(self, new_stories, ret_values):
+        """
+        Inserts all of a fetch's new stories at once, with one search request for
+        them, counting each story as new or as an error just like saving them
+        one at a time.
+        """
+        saved_stories = MStory.insert_stories(new_stories)
+        ret_values['new'] += len(saved_stories)
+        ret_values['error'] += len(new_stories) - len(saved_stories)
+        if settings.DEBUG and len(saved_stories) < len(new_stories):
+            saved_hashes = set(s.story_hash for s in saved_stories)
+            for s in new_stories:
+                if s.story_hash not in saved_hashes:
+                    logging.info('   ---> [%-30s] ~SN~FRIntegrityError on new story: %s' % (self.feed_title[:30], s.story_guid))
+        
+        if saved_stories:
+            self.count_new_stories([s.story_date for s in saved_stories])
+            if self.search_indexed:
+                MStory.index_stories_for_search(saved_stories)
+    
     def update_story_with_new_guid(self, existing_story, new_story_guid):
         from apps.reader.models import RUserStory
         from apps.social.models import MSharedStory
@@ -1148,7 +1380,7 @@ class Feed(models.Model):
         now = datetime.datetime.now()
         month_ago = now - datetime.timedelta(days=settings.DAYS_OF_STORY_HASHES)
         feed_count = Feed.objects.latest('pk').pk
-        total = 0
+        stats = {}
         for feed_id in xrange(start, feed_count):
             if feed_id % 1000 == 0:
                 print "\n\n -------------------------- %s --------------------------\n\n" % feed_id
@@ -1165,10 +1397,14 @@ class Feed(models.Model):
                 cutoff = max(1, 6 - months_ago)
                 if dryrun:
                     print " DRYRUN: %s cutoff - %s" % (cutoff, feed)
-                else:
-                    total += MStory.trim_feed(feed=feed, cutoff=cutoff, verbose=verbose)
+                MStory.trim_feed(feed=feed, cutoff=cutoff, verbose=verbose,
+                                 dryrun=dryrun, stats=stats)
                     
-        print " ---> Deleted %s stories in total." % total
+        if dryrun:
+            print " ---> Would delete %s stories in total (%.1f MB)." % (stats.get('stories', 0),
+                                                                     stats.get('bytes', 0) / (1024.0*1024))
+        else:
+            print " ---> Deleted %s stories in total." % stats.get('stories', 0)
     
     @property
     def story_cutoff(self):
@@ -1195,10 +1431,10 @@ class Feed(models.Model):
         
         return cutoff
                 
-    def trim_feed(self, verbose=False, cutoff=None):
+    def trim_feed(self, verbose=False, cutoff=None, dryrun=False, stats=None):
         if not cutoff:
             cutoff = self.story_cutoff
-        MStory.trim_feed(feed=self, cutoff=cutoff, verbose=verbose)
+        return MStory.trim_feed(feed=self, cutoff=cutoff, verbose=verbose, dryrun=dryrun, stats=stats)
 
     # @staticmethod
     # def clean_invalid_ids():
@@ -1213,15 +1449,16 @@ class Feed(models.Model):
 
         
     def get_stories(self, offset=0, limit=25, force=False):
-        stories_db = MStory.objects(story_feed_id=self.pk)[offset:offset+limit]
-        stories = self.format_stories(stories_db, self.pk)
+        stories_db = MStory.raw_stories(story_feed_id=self.pk, sort=[('story_date', -1)],
+                                        skip=offset, limit=limit)
+        stories = self.format_raw_stories(stories_db, self.pk)
         
         return stories
     
     @classmethod
-    def find_feed_stories(cls, feed_ids, query, order="newest", offset=0, limit=25):
+    def find_feed_stories(cls, feed_ids, query, order="newest", offset=0, limit=25, user_id=None):
         story_ids = SearchStory.query(feed_ids=feed_ids, query=query, order=order, 
-                                      offset=offset, limit=limit)
+                                      offset=offset, limit=limit, user_id=user_id)
         stories_db = MStory.objects(
             story_hash__in=story_ids
         ).order_by('-story_date' if order == "newest" else 'story_date')
@@ -1298,6 +1535,49 @@ class Feed(models.Model):
         
         return story
     
+    @classmethod
+    def format_raw_stories(cls, story_docs, feed_id=None, content=True):
+        """
+        The lean counterpart to `format_stories`, for raw pymongo documents from
+        `MStory.raw_stories`. Fields left out of the projection are left out of
+        the story, and content is only decompressed when it's asked for.
+        """
+        return [cls.format_raw_story(story_doc, feed_id, content=content)
+                for story_doc in story_docs]
+    
+    @classmethod
+    def format_raw_story(cls, story_doc, feed_id=None, content=True):
+        story_date                = story_doc['story_date']
+        story_guid                = story_doc.get('story_guid')
+        story                     = {}
+        story['story_hash']       = story_doc.get('story_hash')
+        story['story_tags']       = story_doc.get('story_tags') or []
+        story['story_date']       = story_date.replace(tzinfo=None)
+        story['story_timestamp']  = '%d' % time.mktime(story_date.timetuple())
+        story['story_authors']    = story_doc.get('story_author_name') or ""
+        story['story_title']      = story_doc.get('story_title')
+        story['story_permalink']  = story_doc.get('story_permalink')
+        story['image_urls']       = story_doc.get('image_urls', [])
+        story['story_feed_id']    = feed_id or story_doc.get('story_feed_id')
+        story['comment_count']    = story_doc.get('comment_count')
+        story['comment_user_ids'] = story_doc.get('comment_user_ids', [])
+        story['share_count']      = story_doc.get('share_count')
+        story['share_user_ids']   = story_doc.get('share_user_ids', [])
+        try:
+            story['guid_hash']    = hashlib.sha1(story_guid).hexdigest()[:6]
+        except (TypeError, UnicodeEncodeError):
+            story['guid_hash']    = None
+        story['id']               = story_guid or story_date
+        if content:
+            story_content_z = story_doc.get('story_content_z')
+            if isinstance(story_content_z, unicode):
+                story_content_z = story_content_z.decode('base64')
+            story['story_content'] = story_content_z and zlib.decompress(story_content_z) or ''
+            if '<ins' in story['story_content'] or '<del' in story['story_content']:
+                story['has_modifications'] = True
+        
+        return story
+    
     def get_tags(self, entry):
         fcat = []
         if entry.has_key('tags'):
@@ -1335,86 +1615,110 @@ class Feed(models.Model):
             link = entry.get('id')
         return link
     
-    def _exists_story(self, story, story_content, existing_stories, new_story_hashes):
+    def _index_existing_stories(self, existing_stories, new_story_hashes):
+        """
+        Built once per batch so each incoming story only looks at the existing
+        stories that can still match it: the one with its own hash, or else the
+        ones that aren't about to be matched by another story in this batch.
+        """
+        new_story_hashes = set(new_story_hashes)
+        unmatched_stories = []
+        for existing_story in existing_stories.values():
+            if isinstance(existing_story.id, unicode):
+                # Correcting a MongoDB bug
+                existing_story.story_guid = existing_story.id
+            if existing_story.story_hash not in new_story_hashes:
+                unmatched_stories.append(existing_story)
+        
+        return {
+            'unmatched_stories': unmatched_stories,
+            'contents': {},
+        }
+    
+    def _existing_story_content(self, existing_story, index):
+        key = id(existing_story)
+        if key in index['contents']:
+            return index['contents'][key]
+        
+        if 'story_latest_content_z' in existing_story:
+            existing_story_content = unicode(zlib.decompress(existing_story.story_latest_content_z))
+        elif 'story_latest_content' in existing_story:
+            existing_story_content = existing_story.story_latest_content
+        elif 'story_content_z' in existing_story:
+            existing_story_content = unicode(zlib.decompress(existing_story.story_content_z))
+        elif 'story_content' in existing_story:
+            existing_story_content = existing_story.story_content
+        else:
+            existing_story_content = u''
+        index['contents'][key] = existing_story_content
+        
+        return existing_story_content
+        
+    def _exists_story(self, story, story_content, existing_stories, new_story_hashes, index=None):
         story_in_system = None
         story_has_changed = False
         story_link = self.get_permalink(story)
-        existing_stories_hashes = existing_stories.keys()
+        story_hash = story.get('story_hash')
+        story_title = story.get('title')
         story_pub_date = story.get('published')
-        # story_published_now = story.get('published_now', False)
-        # start_date = story_pub_date - datetime.timedelta(hours=8)
-        # end_date = story_pub_date + datetime.timedelta(hours=8)
+        if index is None:
+            index = self._index_existing_stories(existing_stories, new_story_hashes)
+        
+        if story_hash in existing_stories:
+            # Any other existing story would be skipped, so only compare the one with this hash.
+            candidate_stories = [existing_stories[story_hash]]
+        else:
+            candidate_stories = index['unmatched_stories']
 
-        for existing_story in existing_stories.values():
+        for existing_story in candidate_stories:
             content_ratio = 0
-            # existing_story_pub_date = existing_story.story_date
-            # print 'Story pub date: %s %s' % (story_published_now, story_pub_date)
-
-            if isinstance(existing_story.id, unicode):
-                # Correcting a MongoDB bug
-                existing_story.story_guid = existing_story.id
             
-            if story.get('story_hash') == existing_story.story_hash:
+            if existing_story.story_hash == story_hash:
                 story_in_system = existing_story
-            elif (story.get('story_hash') in existing_stories_hashes and 
-                story.get('story_hash') != existing_story.story_hash):
-                # Story already exists but is not this one
-                continue
-            elif (existing_story.story_hash in new_story_hashes and
-                  story.get('story_hash') != existing_story.story_hash):
-                  # Story coming up later
-                continue
-
-            if 'story_latest_content_z' in existing_story:
-                existing_story_content = unicode(zlib.decompress(existing_story.story_latest_content_z))
-            elif 'story_latest_content' in existing_story:
-                existing_story_content = existing_story.story_latest_content
-            elif 'story_content_z' in existing_story:
-                existing_story_content = unicode(zlib.decompress(existing_story.story_content_z))
-            elif 'story_content' in existing_story:
-                existing_story_content = existing_story.story_content
-            else:
-                existing_story_content = u''
-                
-                  
-            # Title distance + content distance, checking if story changed
-            story_title_difference = abs(levenshtein_distance(story.get('title'),
-                                                              existing_story.story_title))
-            
-            title_ratio = difflib.SequenceMatcher(None, story.get('title', ""),
-                                                  existing_story.story_title).ratio()
-            if title_ratio < .75: continue
             
+            # Cheapest necessary conditions first, they don't depend on each other.
             story_timedelta = existing_story.story_date - story_pub_date
             if abs(story_timedelta.days) >= 1: continue
             
-            seq = difflib.SequenceMatcher(None, story_content, existing_story_content)
+            # Title distance + content distance, checking if story changed
+            story_title_changed = story_title != existing_story.story_title
+            if story_title_changed:
+                title_ratio = difflib.SequenceMatcher(None, story.get('title', ""),
+                                                      existing_story.story_title).ratio()
+                if title_ratio < .75: continue
+            
+            existing_story_content = self._existing_story_content(existing_story, index)
             
             similiar_length_min = 1000
             if (existing_story.story_permalink == story_link and 
-                existing_story.story_title == story.get('title')):
+                not story_title_changed):
                 similiar_length_min = 20
             
-            if (seq
-                and story_content
+            if (story_content
                 and len(story_content) > similiar_length_min
-                and existing_story_content
-                and seq.real_quick_ratio() > .9 
-                and seq.quick_ratio() > .95):
-                content_ratio = seq.ratio()
+                and existing_story_content):
+                if story_content == existing_story_content:
+                    content_ratio = 1.0
+                else:
+                    # Same bound as SequenceMatcher.real_quick_ratio(), without indexing the content.
+                    total_length = len(story_content) + len(existing_story_content)
+                    length_ratio = 2.0 * min(len(story_content), len(existing_story_content)) / total_length
+                    if length_ratio > .9:
+                        seq = difflib.SequenceMatcher(None, story_content, existing_story_content)
+                        if seq.quick_ratio() > .95:
+                            content_ratio = seq.ratio()
                 
-            if story_title_difference > 0 and content_ratio > .98:
+            if story_title_changed and content_ratio > .98:
                 story_in_system = existing_story
-                if story_title_difference > 0 or content_ratio < 1.0:
-                    if settings.DEBUG:
-                        logging.debug(" ---> Title difference - %s/%s (%s): %s" % (story.get('title'), existing_story.story_title, story_title_difference, content_ratio))
-                    story_has_changed = True
-                    break
+                if settings.DEBUG:
+                    logging.debug(" ---> Title difference - %s/%s (%s): %s" % (story.get('title'), existing_story.story_title, levenshtein_distance(story_title, existing_story.story_title), content_ratio))
+                story_has_changed = True
+                break
             
             # More restrictive content distance, still no story match
             if not story_in_system and content_ratio > .98:
                 if settings.DEBUG:
-                    logging.debug(" ---> Content difference - %s/%s (%s): %s" % (story.get('title'), existing_story.story_title, story_title_difference, content_ratio))
+                    logging.debug(" ---> Content difference - %s/%s (%s): %s" % (story.get('title'), existing_story.story_title, story_title_changed, content_ratio))
                 story_in_system = existing_story
                 story_has_changed = True
                 break
@@ -1428,13 +1732,8 @@ class Feed(models.Model):
                     if settings.DEBUG:
                         logging.debug(" ---> Permalink difference - %s/%s" % (story_link, existing_story.story_permalink))
                     story_has_changed = True
-                # if story_pub_date != existing_story.story_date:
-                #     story_has_changed = True
                 break
                 
-        
-        # if story_has_changed or not story_in_system:
-        #     print 'New/updated story: %s' % (story), 
         return story_in_system, story_has_changed
     
     def get_next_scheduled_update(self, force=False, verbose=True, premium_speed=False):
@@ -1487,6 +1786,12 @@ class Feed(models.Model):
         #     subscriber_bonus /= min(self.active_subscribers+self.premium_subscribers, 5)
         # subscriber_bonus = int(subscriber_bonus)
 
+        # Fetch around when this feed usually publishes, rather than on the hour.
+        if settings.ADAPTIVE_FETCH_INTERVALS and upd > 0:
+            rhythm = self.publishing_rhythm
+            if rhythm and rhythm.story_count >= PublishingRhythm.MIN_STORIES:
+                total = rhythm.fetch_interval(datetime.datetime.utcnow(), subs, total)
+
         if self.is_push:
             fetch_history = MFetchHistory.feed(self.pk)
             if len(fetch_history['push_history']):
@@ -1528,8 +1833,9 @@ class Feed(models.Model):
             self.next_scheduled_update = next_scheduled_update
             if self.active_subscribers >= 1:
                 r.zadd('scheduled_updates', self.pk, self.next_scheduled_update.strftime('%s'))
+                FeedScheduler(r).set_priority(self)
             r.zrem('tasked_feeds', self.pk)
-            r.srem('queued_feeds', self.pk)
+            r.zrem('queued_feeds', self.pk)
             
         self.save()
         
@@ -1753,12 +2059,71 @@ class MStory(mongo.Document):
     def feed_guid_hash_unsaved(cls, feed_id, guid):
         return "%s:%s" % (feed_id, cls.guid_hash_unsaved(guid))
     
+    FORMAT_FIELDS = ['story_hash', 'story_feed_id', 'story_date', 'story_title', 'story_author_name',
+                     'story_tags', 'story_permalink', 'story_guid', 'image_urls', 'comment_count',
+                     'comment_user_ids', 'share_count', 'share_user_ids']
+    
+    @classmethod
+    def raw_stories(cls, story_hashes=None, content=True, fields=None, read_preference=None,
+                    sort=None, skip=0, limit=0, **spec):
+        """
+        Fetches stories as plain pymongo documents, for `Feed.format_raw_stories`,
+        with only the fields a formatted story needs (or just `fields`) and
+        without building MongoEngine documents.
+        """
+        if story_hashes is not None:
+            spec['story_hash'] = {'$in': list(story_hashes)}
+        if fields is None:
+            fields = cls.FORMAT_FIELDS + (['story_content_z'] if content else [])
+        projection = dict((field, 1) for field in fields)
+        projection['_id'] = 0
+        
+        params = dict(fields=projection, skip=skip, limit=limit)
+        if sort is not None:
+            params['sort'] = sort
+        if read_preference is not None:
+            params['read_preference'] = read_preference
+        
+        return cls._get_collection().find(spec, **params)
+    
+    SCORING_FIELDS = ['story_hash', 'story_feed_id', 'story_date', 'story_title',
+                      'story_author_name', 'story_tags']
+    
+    @classmethod
+    def scoring_stories(cls, story_hashes=None, feed_id=None, stats=None, **params):
+        """
+        Streams just what unread counting and the classifiers read from each story,
+        none of the compressed content. Pass a `stats` dict to have the stories
+        and BSON bytes read from Mongo added to it.
+        """
+        for story_doc in cls.raw_stories(story_hashes, fields=cls.SCORING_FIELDS, **params):
+            if stats is not None:
+                stats['stories'] = stats.get('stories', 0) + 1
+                stats['bytes'] = stats.get('bytes', 0) + len(BSON.encode(story_doc))
+            yield {
+                'story_hash': story_doc.get('story_hash'),
+                'story_feed_id': feed_id or story_doc.get('story_feed_id'),
+                'story_date': story_doc['story_date'].replace(tzinfo=None),
+                'story_title': story_doc.get('story_title'),
+                'story_authors': story_doc.get('story_author_name') or "",
+                'story_tags': story_doc.get('story_tags') or [],
+            }
+    
     @property
     def decoded_story_title(self):
         h = HTMLParser.HTMLParser()
         return h.unescape(self.story_title)
 
     def save(self, *args, **kwargs):
+        self.prepare_for_save()
+        
+        super(MStory, self).save(*args, **kwargs)
+        
+        self.sync_redis()
+        
+        return self
+    
+    def prepare_for_save(self):
         story_title_max = MStory._fields['story_title'].max_length
         story_content_type_max = MStory._fields['story_content_type'].max_length
         self.story_hash = self.feed_guid_hash
@@ -1776,12 +2141,46 @@ class MStory(mongo.Document):
             self.story_title = self.story_title[:story_title_max]
         if self.story_content_type and len(self.story_content_type) > story_content_type_max:
             self.story_content_type = self.story_content_type[:story_content_type_max]
+    
+    @classmethod
+    def insert_stories(cls, stories):
+        """
+        Saves many new stories with a single insert, then syncs them all to redis
+        in one pipeline. Returns the stories that were inserted. A story that
+        can't be inserted (a duplicate story hash) or doesn't validate is left
+        out, and doesn't stop the rest.
+        """
+        valid_stories = []
+        for story in stories:
+            story.prepare_for_save()
+            try:
+                story.validate()
+            except ValidationError, e:
+                logging.debug('   ---> ~SN~FRValidationError on new story: %s - %s' % (
+                              story.story_guid, e))
+                continue
+            valid_stories.append(story)
+        stories = valid_stories
+        docs = [story.to_mongo() for story in stories]
+        if not docs:
+            return []
         
-        super(MStory, self).save(*args, **kwargs)
+        collection = cls._get_collection()
+        try:
+            collection.insert(docs, continue_on_error=True)
+            inserted_ids = set(doc['_id'] for doc in docs)
+        except pymongo.errors.OperationFailure:
+            inserted_ids = set(doc['_id'] for doc in collection.find(
+                {'_id': {'$in': [doc['_id'] for doc in docs if '_id' in doc]}}, {'_id': 1}))
         
-        self.sync_redis()
+        inserted_stories = []
+        for story, doc in zip(stories, docs):
+            if doc.get('_id') in inserted_ids:
+                story.id = doc['_id']
+                inserted_stories.append(story)
+        cls.sync_stories_redis(inserted_stories)
         
-        return self
+        return inserted_stories
     
     def delete(self, *args, **kwargs):
         self.remove_from_redis()
@@ -1790,33 +2189,27 @@ class MStory(mongo.Document):
         super(MStory, self).delete(*args, **kwargs)
 
     @classmethod
-    def index_all_for_search(cls, offset=0):
-        if not offset:
+    def index_all_for_search(cls, offset=0, workers=1, checkpoint="all"):
+        if not offset and not BulkStoryIndexer.resuming(checkpoint):
             SearchStory.create_elasticsearch_mapping(delete=True)
         
-        last_pk = Feed.objects.latest('pk').pk
-        for f in xrange(offset, last_pk, 1000):
-            print " ---> %s / %s (%.2s%%)" % (f, last_pk, float(f)/last_pk*100)
-            feeds = Feed.objects.filter(pk__in=range(f, f+1000), 
-                                        active=True,
-                                        active_subscribers__gte=1)\
-                                .values_list('pk')
-            for feed_id, in feeds:
-                stories = cls.objects.filter(story_feed_id=feed_id)
-                for story in stories:
-                    story.index_story_for_search()
+        feed_ids = Feed.objects.filter(pk__gte=offset,
+                                       active=True,
+                                       active_subscribers__gte=1)\
+                               .order_by('pk').values_list('pk', flat=True)
+        
+        return BulkStoryIndexer(list(feed_ids), checkpoint=checkpoint, workers=workers,
+                                verbose=True).run()
 
     def index_story_for_search(self):
-        story_content = self.story_content or ""
-        if self.story_content_z:
-            story_content = zlib.decompress(self.story_content_z)
-        SearchStory.index(story_hash=self.story_hash, 
-                          story_title=self.story_title, 
-                          story_content=prep_for_search(story_content), 
-                          story_tags=self.story_tags, 
-                          story_author=self.story_author_name, 
-                          story_feed_id=self.story_feed_id, 
-                          story_date=self.story_date)
+        SearchStory.index(**self.search_document())
+    
+    @classmethod
+    def index_stories_for_search(cls, stories):
+        SearchStory.index_stories([story.search_document() for story in stories])
+    
+    def search_document(self):
+        return search_document(self.to_mongo())
     
     def remove_from_search_index(self):
         try:
@@ -1825,7 +2218,14 @@ class MStory(mongo.Document):
             pass
         
     @classmethod
-    def trim_feed(cls, cutoff, feed_id=None, feed=None, verbose=True):
+    def trim_feed(cls, cutoff, feed_id=None, feed=None, verbose=True, dryrun=False, stats=None):
+        """
+        Deletes all but the newest `cutoff` stories of a feed, except shared stories.
+        The stories are picked with one projected query, deleted with one remove, and
+        then cleared from redis in one pipeline and from search in one bulk request.
+        With `dryrun` nothing is deleted. Pass a `stats` dict to have the stories
+        and BSON bytes that are (or would be) reclaimed added to it.
+        """
         extra_stories_count = 0
         if not feed_id and not feed:
             return extra_stories_count
@@ -1835,34 +2235,52 @@ class MStory(mongo.Document):
         if not feed:
             feed = feed_id
         
-        stories = cls.objects(
-            story_feed_id=feed_id
-        ).only('story_date').order_by('-story_date')
-                
-        if stories.count() > cutoff:
-            logging.debug('   ---> [%-30s] ~FMFound %s stories. Trimming to ~SB%s~SN...' %
-                          (unicode(feed)[:30], stories.count(), cutoff))
-            try:
-                story_trim_date = stories[cutoff].story_date
-            except IndexError, e:
-                logging.debug(' ***> [%-30s] ~BRError trimming feed: %s' % (unicode(feed)[:30], e))
-                return extra_stories_count
-                
-            extra_stories = cls.objects(story_feed_id=feed_id, 
-                                        story_date__lte=story_trim_date)
-            extra_stories_count = extra_stories.count()
-            shared_story_count = 0
-            for story in extra_stories:
-                if story.share_count: 
-                    shared_story_count += 1
-                    continue
-                story.delete()
-            if verbose:
-                existing_story_count = cls.objects(story_feed_id=feed_id).count()
-                logging.debug("   ---> Deleted %s stories, %s (%s shared) left." % (
-                                extra_stories_count,
-                                existing_story_count,
-                                shared_story_count))
+        collection = cls._get_collection()
+        trim_story = collection.find_one({'story_feed_id': feed_id}, {'story_date': 1, '_id': 0},
+                                         sort=[('story_date', -1)], skip=cutoff)
+        if not trim_story:
+            return extra_stories_count
+        story_trim_date = trim_story['story_date']
+        logging.debug('   ---> [%-30s] ~FMTrimming to ~SB%s~SN stories, from %s...' %
+                      (unicode(feed)[:30], cutoff, story_trim_date))
+        
+        # The whole story is only read to measure what a dry run would reclaim.
+        fields = None if dryrun else {'story_hash': 1, 'share_count': 1}
+        extra_stories = collection.find({'story_feed_id': feed_id,
+                                         'story_date': {'$lte': story_trim_date}}, fields)
+        shared_story_count = 0
+        story_ids = []
+        story_hashes = []
+        story_bytes = 0
+        for story in extra_stories:
+            extra_stories_count += 1
+            if story.get('share_count'):
+                shared_story_count += 1
+                continue
+            story_ids.append(story['_id'])
+            if story.get('story_hash'):
+                story_hashes.append(story['story_hash'])
+            if dryrun:
+                story_bytes += len(BSON.encode(story))
+        
+        if stats is not None:
+            stats['stories'] = stats.get('stories', 0) + len(story_ids)
+            stats['bytes'] = stats.get('bytes', 0) + story_bytes
+        if dryrun:
+            logging.debug("   ---> DRYRUN: Would delete %s stories (%.1f KB), keeping %s shared." % (
+                          len(story_ids), story_bytes / 1024.0, shared_story_count))
+            return extra_stories_count
+        
+        if story_ids:
+            collection.remove({'_id': {'$in': story_ids}})
+            cls.remove_stories_from_redis(feed_id, story_hashes)
+            SearchStory.remove_stories(story_hashes)
+        if verbose:
+            existing_story_count = cls.objects(story_feed_id=feed_id).count()
+            logging.debug("   ---> Deleted %s stories, %s (%s shared) left." % (
+                            len(story_ids),
+                            existing_story_count,
+                            shared_story_count))
 
         return extra_stories_count
         
@@ -1960,7 +2378,7 @@ class MStory(mongo.Document):
         
         return story_hashes
     
-    def sync_redis(self, r=None):
+    def sync_redis(self, r=None, unread_index=True):
         if not r:
             r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
         # if not r2:
@@ -1978,6 +2396,31 @@ class MStory(mongo.Document):
             r.expire('z' + feed_key, settings.DAYS_OF_STORY_HASHES*24*60*60)
             # r2.zadd('z' + feed_key, self.story_hash, time.mktime(self.story_date.timetuple()))
             # r2.expire('z' + feed_key, settings.DAYS_OF_STORY_HASHES*24*60*60)
+            
+            if unread_index and settings.UNREAD_INDEX:
+                from apps.reader.models import RUserUnreadIndex
+                RUserUnreadIndex.add_story(self.story_feed_id, self.story_hash,
+                                           time.mktime(self.story_date.timetuple()), r=r)
+    
+    @classmethod
+    def sync_stories_redis(cls, stories, r=None):
+        """`sync_redis` for many stories, in one pipeline."""
+        from apps.reader.models import RUserUnreadIndex
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        UNREAD_CUTOFF = datetime.datetime.now() - datetime.timedelta(days=settings.DAYS_OF_STORY_HASHES)
+        
+        pipeline = r.pipeline()
+        unread_stories = defaultdict(list)
+        for story in stories:
+            story.sync_redis(r=pipeline, unread_index=False)
+            if story.id and story.story_date > UNREAD_CUTOFF:
+                unread_stories[story.story_feed_id].append((story.story_hash,
+                                                            time.mktime(story.story_date.timetuple())))
+        if settings.UNREAD_INDEX:
+            for story_feed_id, feed_stories in unread_stories.items():
+                RUserUnreadIndex.add_stories(story_feed_id, feed_stories, r=pipeline)
+        pipeline.execute()
     
     def remove_from_redis(self, r=None):
         if not r:
@@ -1989,6 +2432,27 @@ class MStory(mongo.Document):
             # r2.srem('F:%s' % self.story_feed_id, self.story_hash)
             r.zrem('zF:%s' % self.story_feed_id, self.story_hash)
             # r2.zrem('zF:%s' % self.story_feed_id, self.story_hash)
+            
+            if settings.UNREAD_INDEX:
+                from apps.reader.models import RUserUnreadIndex
+                RUserUnreadIndex.remove_story(self.story_feed_id, self.story_hash, r=r)
+    
+    @classmethod
+    def remove_stories_from_redis(cls, story_feed_id, story_hashes, r=None):
+        """`remove_from_redis` for many stories of one feed, in one pipeline."""
+        from apps.reader.models import RUserUnreadIndex
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        if not story_hashes:
+            return
+        
+        pipeline = r.pipeline()
+        for story_hashes_chunk in chunks(story_hashes, 1000):
+            pipeline.srem('F:%s' % story_feed_id, *story_hashes_chunk)
+            pipeline.zrem('zF:%s' % story_feed_id, *story_hashes_chunk)
+            if settings.UNREAD_INDEX:
+                RUserUnreadIndex.remove_stories(story_feed_id, story_hashes_chunk, r=pipeline)
+        pipeline.execute()
 
     @classmethod
     def sync_feed_redis(cls, story_feed_id):
@@ -2003,12 +2467,7 @@ class MStory(mongo.Document):
         # r2.delete('zF:%s' % story_feed_id)
 
         logging.info("   ---> [%-30s] ~FMSyncing ~SB%s~SN stories to redis" % (feed and feed.title[:30] or story_feed_id, stories.count()))
-        p = r.pipeline()
-        # p2 = r2.pipeline()
-        for story in stories:
-            story.sync_redis(r=p)
-        p.execute()
-        # p2.execute()
+        cls.sync_stories_redis(stories, r=r)
         
     def count_comments(self):
         from apps.social.models import MSharedStory
@@ -2334,12 +2793,24 @@ class MFetchHistory(mongo.Document):
     feed_fetch_history = mongo.DynamicField()
     page_fetch_history = mongo.DynamicField()
     push_history = mongo.DynamicField()
+    page_uploads_avoided = mongo.IntField()
+    page_bytes_avoided = mongo.IntField()
     
     meta = {
         'db_alias': 'nbanalytics',
         'collection': 'fetch_history',
         'allow_inheritance': False,
     }
+    
+    HISTORY_FIELDS = {
+        'feed': 'feed_fetch_history',
+        'page': 'page_fetch_history',
+        'push': 'push_history',
+    }
+    # Fetches held back for one update command, while a fetch worker is batching.
+    _batch = None
+    # Whether the server takes $position, looked up once per process.
+    _push_position = None
 
     @classmethod
     def feed(cls, feed_id, timezone=None, fetch_history=None):
@@ -2363,44 +2834,105 @@ class MFetchHistory(mongo.Document):
                     'status_code': fetch[1],
                     'message': fetch[2]
                 }
+        history['page_uploads_avoided'] = fetch_history.page_uploads_avoided or 0
+        history['page_bytes_avoided'] = fetch_history.page_bytes_avoided or 0
         return history
     
+    @classmethod
+    def add_page_upload_avoided(cls, feed_id, page_bytes):
+        cls.objects(feed_id=feed_id).update_one(inc__page_uploads_avoided=1,
+                                                inc__page_bytes_avoided=page_bytes,
+                                                upsert=True)
+    
     @classmethod
     def add(cls, feed_id, fetch_type, date=None, message=None, code=None, exception=None):
+        """
+        Puts a fetch at the front of a feed's history with one upserting $push,
+        trimmed to the last 5, or the last 50 when this fetch failed. Nothing is
+        read back. While a fetch worker is batching, successful fetches wait for
+        `flush_batch`. Failures flush the batch and are written straight away,
+        since they're counted from the stored history. Servers older than
+        MongoDB 2.6 have no $position, so there the history is read, prepended
+        to and saved, as it used to be.
+        """
         if not date:
             date = datetime.datetime.now()
+        history_field = cls.HISTORY_FIELDS[fetch_type]
+        failed = code and code >= 400
+        
+        if not cls.supports_push_position():
+            cls.add_by_saving(feed_id, history_field, [date, code, message], 50 if failed else 5)
+            if fetch_type == 'feed':
+                RStats.add('feed_fetch')
+            return
+        
+        update = {
+            '$push': {
+                history_field: {
+                    '$each': [[date, code, message]],
+                    '$position': 0,
+                    '$slice': 50 if failed else 5,
+                }
+            }
+        }
+        
+        if cls._batch is not None and code in (200, 208, 304):
+            cls._batch.append((feed_id, update))
+        else:
+            if cls._batch:
+                cls.flush_batch(stop=False)
+            cls._get_collection().update({'feed_id': feed_id}, update, upsert=True)
+        
+        if fetch_type == 'feed':
+            RStats.add('feed_fetch')
+    
+    @classmethod
+    def add_by_saving(cls, feed_id, history_field, fetch, limit):
         try:
             fetch_history = cls.objects.read_preference(pymongo.ReadPreference.PRIMARY)\
                                        .get(feed_id=feed_id)
         except cls.DoesNotExist:
             fetch_history = cls.objects.create(feed_id=feed_id)
         
-        if fetch_type == 'feed':
-            history = fetch_history.feed_fetch_history or []
-        elif fetch_type == 'page':
-            history = fetch_history.page_fetch_history or []
-        elif fetch_type == 'push':
-            history = fetch_history.push_history or []
-
-        history = [[date, code, message]] + history
-        if code and code >= 400:
-            history = history[:50]
-        else:
-            history = history[:5]
-
-        if fetch_type == 'feed':
-            fetch_history.feed_fetch_history = history
-        elif fetch_type == 'page':
-            fetch_history.page_fetch_history = history
-        elif fetch_type == 'push':
-            fetch_history.push_history = history
-        
+        history = [fetch] + (getattr(fetch_history, history_field) or [])
+        setattr(fetch_history, history_field, history[:limit])
         fetch_history.save()
-        
-        if fetch_type == 'feed':
-            RStats.add('feed_fetch')
-        
-        return cls.feed(feed_id, fetch_history=fetch_history)
+    
+    @classmethod
+    def supports_push_position(cls):
+        """$position, and the update command batches are sent with, are new in MongoDB 2.6."""
+        if cls._push_position is None:
+            server_info = cls._get_db().connection.server_info()
+            cls._push_position = server_info.get('versionArray', [0])[:2] >= [2, 6]
+        return cls._push_position
+    
+    @classmethod
+    def start_batch(cls):
+        if cls._batch is None and cls.supports_push_position():
+            cls._batch = []
+    
+    @classmethod
+    def flush_batch(cls, stop=True):
+        """Writes the batched fetches in one update command, in the order they were made."""
+        updates = cls._batch or []
+        cls._batch = None if stop else []
+        if not updates:
+            return 0
+        
+        collection = cls._get_collection()
+        for batch in chunks(updates, 1000):
+            result = collection.database.command(SON([
+                ('update', collection.name),
+                ('updates', [{'q': {'feed_id': feed_id}, 'u': update, 'upsert': True}
+                             for feed_id, update in batch]),
+                ('ordered', True),
+            ]))
+            if result.get('writeErrors'):
+                logging.debug(" ***> ~FRFailed to write ~SB%s~SN fetch histories: %s" % (
+                              len(batch) - result['writeErrors'][0]['index'],
+                              result['writeErrors'][0].get('errmsg')))
+        
+        return len(updates)
 
 
 class DuplicateFeed(models.Model):
@@ -2510,6 +3042,7 @@ def merge_feeds(original_feed_id, duplicate_feed_id, force=False):
     original_feed.save()
     logging.debug(' ---> Now original subscribers: %s' %
                   (original_feed.num_subscribers))
+    FeedPrefixIndex.feed_changed(original_feed.pk, duplicate_feed.pk)
                   
           
     MSharedStory.switch_feed(original_feed_id, duplicate_feed_id)
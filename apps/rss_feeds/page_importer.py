@@ -1,5 +1,7 @@
 import requests
 import re
+import redis
+import hashlib
 import urlparse
 import traceback
 import feedparser
@@ -11,7 +13,7 @@ from boto.s3.key import Key
 from django.conf import settings
 from django.utils.text import compress_string
 from utils import log as logging
-from apps.rss_feeds.models import MFeedPage
+from apps.rss_feeds.models import MFeedPage, MFetchHistory
 from utils.feed_functions import timelimit
 from OpenSSL.SSL import Error as OpenSSLError
 from pyasn1.error import PyAsn1Error
@@ -54,13 +56,30 @@ class PageImporter(object):
             ),
         }
     
+    @property
+    def page_cache_key(self):
+        return 'FP:%s' % self.feed.pk
+    
+    def conditional_headers(self, page_cache):
+        headers = self.headers
+        if page_cache.get('etag'):
+            headers['If-None-Match'] = page_cache['etag']
+        if page_cache.get('last_modified'):
+            headers['If-Modified-Since'] = page_cache['last_modified']
+        
+        return headers
+    
     @timelimit(15)
     def fetch_page(self, urllib_fallback=False, requests_exception=None):
         html = None
+        response = None
         feed_link = self.feed.feed_link
         if not feed_link:
             self.save_no_page()
             return
+        
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        page_cache = r.hgetall(self.page_cache_key)
             
         if feed_link.startswith('www'):
             self.feed.feed_link = 'http://' + feed_link
@@ -79,7 +98,7 @@ class PageImporter(object):
                     data = response.read()
                 else:
                     try:
-                        response = requests.get(feed_link, headers=self.headers)
+                        response = requests.get(feed_link, headers=self.conditional_headers(page_cache))
                         response.connection.close()
                     except requests.exceptions.TooManyRedirects:
                         response = requests.get(feed_link)
@@ -87,6 +106,9 @@ class PageImporter(object):
                         logging.debug('   ***> [%-30s] Page fetch failed using requests: %s' % (self.feed, e))
                         self.save_no_page()
                         return
+                    if response.status_code == 304:
+                        self.save_page_unchanged(304, "Not modified", int(page_cache.get('size', 0)))
+                        return
                     try:
                         data = response.text
                     except (LookupError, TypeError):
@@ -106,7 +128,15 @@ class PageImporter(object):
                     return
             if data:
                 html = self.rewrite_page(data)
+                page_hash = hashlib.sha1(html.encode('utf-8') if isinstance(html, unicode)
+                                         else html).hexdigest()
+                if page_hash == page_cache.get('hash'):
+                    self.save_page_unchanged(208, "Unchanged page", len(html))
+                    # Keeps the cache from expiring and picks up new validators.
+                    self.save_page_cache(r, page_hash, len(html), response)
+                    return html
                 self.save_page(html)
+                self.save_page_cache(r, page_hash, len(html), response)
             else:
                 self.save_no_page()
                 return
@@ -142,6 +172,26 @@ class PageImporter(object):
         
         return html
         
+    def save_page_cache(self, r, page_hash, page_size, response=None):
+        page_cache = {
+            'hash': page_hash,
+            'size': page_size,
+        }
+        headers = getattr(response, 'headers', None) or {}
+        if headers.get('etag'):
+            page_cache['etag'] = headers['etag']
+        if headers.get('last-modified'):
+            page_cache['last_modified'] = headers['last-modified']
+        r.delete(self.page_cache_key)
+        r.hmset(self.page_cache_key, page_cache)
+        r.expire(self.page_cache_key, 60*60*24*14)
+    
+    def save_page_unchanged(self, status_code, message, page_size):
+        logging.debug('   ---> [%-30s] ~FYPage unchanged (%s), not saving ~SB%s~SN bytes' % (
+                      self.feed, status_code, page_size))
+        self.feed.save_page_history(status_code, message)
+        MFetchHistory.add_page_upload_avoided(self.feed.pk, page_size)
+    
     def save_no_page(self):
         logging.debug('   ---> [%-30s] ~FYNo original page: %s' % (self.feed, self.feed.feed_link))
         self.feed.has_page = False
@@ -0,0 +1,224 @@
+import math
+import time
+import datetime
+import redis
+from django.conf import settings
+from utils import json_functions as json
+from utils import log as logging
+from utils.feed_functions import chunks
+
+
+class FeedScheduler(object):
+    """
+    Decides which due feeds get tasked, and how many.
+
+    Due feeds move from `scheduled_updates` into the `queued_feeds` sorted set,
+    scored by when they were due, less a boost for feeds with premium readers
+    and lots of stories. The most overdue feeds are tasked first. The number
+    tasked is the measured fetch throughput over the last few minutes,
+    topped up to keep a few minutes of work in `tasked_feeds`.
+    """
+
+    # Minutes of measured throughput to keep tasked ahead of the workers.
+    BACKLOG_MINUTES = 5
+    # Minutes of fetches throughput is measured over.
+    THROUGHPUT_MINUTES = 10
+    # Lower bound on the backlog, so an idle or restarted fleet can get going.
+    MIN_BACKLOG = 1000
+    MAX_BATCH = 10000
+    # The most a feed can jump ahead of feeds that were due before it.
+    MAX_BOOST = 60*60
+
+    def __init__(self, r=None):
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        self.r = r
+
+    @classmethod
+    def priority_boost(cls, feed):
+        """Seconds a feed is treated as more overdue than it is."""
+        premium_subscribers = max(0, feed.active_premium_subscribers)
+        stories_last_month = max(0, feed.stories_last_month)
+        boost = 5*60 * (math.log(1 + premium_subscribers, 2) +
+                        .5 * math.log(1 + stories_last_month, 2))
+
+        return int(min(cls.MAX_BOOST, boost))
+
+    def set_priority(self, feed):
+        self.r.hset('feed_priority', feed.pk, self.priority_boost(feed))
+
+    def queue_due_feeds(self, now_timestamp):
+        r = self.r
+        if r.type('queued_feeds') == 'set':
+            # Queued before feeds were prioritized, so treat them as due now.
+            old_queued_feeds = r.smembers('queued_feeds')
+            r.delete('queued_feeds')
+            for feed_ids in chunks(list(old_queued_feeds), 1000):
+                r.zadd('queued_feeds', **dict((feed_id, now_timestamp) for feed_id in feed_ids))
+
+        due_feeds = r.zrangebyscore('scheduled_updates', 0, now_timestamp, withscores=True)
+        r.zremrangebyscore('scheduled_updates', 0, now_timestamp)
+
+        for due_feeds_group in chunks(due_feeds, 1000):
+            feed_ids = [feed_id for feed_id, _ in due_feeds_group]
+            boosts = r.hmget('feed_priority', feed_ids)
+            priorities = {}
+            for (feed_id, due_timestamp), boost in zip(due_feeds_group, boosts):
+                priorities[feed_id] = int(due_timestamp) - int(boost or 0)
+            r.zadd('queued_feeds', **priorities)
+
+        return len(due_feeds)
+
+    def throughput(self, now_timestamp):
+        """Feeds fetched per minute, recently."""
+        since = now_timestamp - self.THROUGHPUT_MINUTES*60
+        fetched = self.r.zcount('fetched_feeds_last_hour', since, now_timestamp)
+
+        return fetched / float(self.THROUGHPUT_MINUTES)
+
+    def capacity(self, now_timestamp, tasked_feeds_size):
+        backlog = max(self.MIN_BACKLOG, self.throughput(now_timestamp) * self.BACKLOG_MINUTES)
+
+        return int(max(0, min(self.MAX_BATCH, backlog - tasked_feeds_size)))
+
+    def next_feeds(self, count, now_timestamp):
+        """The `count` most overdue queued feeds, and how late each one is in seconds."""
+        if count <= 0:
+            return [], []
+        queued_feeds = self.r.zrange('queued_feeds', 0, count - 1, withscores=True)
+        feed_ids = [feed_id for feed_id, _ in queued_feeds]
+        if not feed_ids:
+            return [], []
+        boosts = self.r.hmget('feed_priority', feed_ids)
+        lags = [max(0, now_timestamp - (int(priority) + int(boost or 0)))
+                for (_, priority), boost in zip(queued_feeds, boosts)]
+
+        return feed_ids, lags
+
+    def record_lag(self, lags):
+        percentiles = self.percentiles(lags)
+        backlog = self.r.zcard('queued_feeds')
+        lag = dict(('p%s' % p, v) for p, v in percentiles.items())
+        lag['backlog'] = backlog
+        lag['tasked'] = len(lags)
+        lag['timestamp'] = int(time.time())
+        self.r.hmset('feed_queue_lag', lag)
+
+        if lags:
+            logging.debug(" ---> ~SN~FBQueue lag: ~SB%ss~SN p50, ~SB%ss~SN p90, ~SB%ss~SN p99 (%s tasked, %s still queued)" % (
+                          percentiles[50], percentiles[90], percentiles[99], len(lags), backlog))
+        return lag
+
+    def queue_lag(self):
+        return self.r.hgetall('feed_queue_lag')
+
+    @staticmethod
+    def percentiles(values, percentiles=(50, 90, 99)):
+        if not values:
+            return dict((p, 0) for p in percentiles)
+        values = sorted(values)
+        return dict((p, values[min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1)])
+                    for p in percentiles)
+
+
+class PublishingRhythm(object):
+    """
+    When in the week a feed tends to publish, and how much. Built from recent
+    story dates, weighted towards the latest weeks, and falling back to the
+    monthly story counts for the overall rate when there are few recent stories.
+    Predicts how long until the next story is likely, so fetches can bunch up
+    around a feed's busy hours and spread out over its quiet ones.
+    """
+
+    HOURS_IN_WEEK = 24*7
+    HALF_LIFE_DAYS = 14
+    # Below this many recent stories, the monthly counts give the rate.
+    MIN_STORIES = 10
+    # Share of the weekly pattern spread evenly, for hours that happen to be empty.
+    UNIFORM_SHARE = .1
+    # How far the interval may move from the subscriber-based one, either way.
+    MAX_SPEEDUP = 4
+    MAX_SLOWDOWN = 4
+    MIN_INTERVAL = 5
+
+    def __init__(self, hour_shares, stories_per_day, story_count=0):
+        self.hour_shares = hour_shares
+        self.stories_per_day = stories_per_day
+        self.story_count = story_count
+
+    @classmethod
+    def hour_of_week(cls, date):
+        return date.weekday() * 24 + date.hour
+
+    @classmethod
+    def from_story_dates(cls, story_dates, now=None, monthly_counts=None, days=60):
+        if not now:
+            now = datetime.datetime.utcnow()
+        cutoff = now - datetime.timedelta(days=days)
+        story_dates = [d for d in story_dates if cutoff <= d <= now]
+
+        weights = [0.0] * cls.HOURS_IN_WEEK
+        for story_date in story_dates:
+            age_days = (now - story_date).total_seconds() / (60*60*24)
+            weights[cls.hour_of_week(story_date)] += .5 ** (age_days / cls.HALF_LIFE_DAYS)
+        total_weight = sum(weights)
+        if total_weight:
+            uniform = cls.UNIFORM_SHARE / cls.HOURS_IN_WEEK
+            hour_shares = [(1 - cls.UNIFORM_SHARE) * w / total_weight + uniform for w in weights]
+        else:
+            hour_shares = [1.0 / cls.HOURS_IN_WEEK] * cls.HOURS_IN_WEEK
+
+        recent_stories = len([d for d in story_dates if d >= now - datetime.timedelta(days=30)])
+        if recent_stories >= cls.MIN_STORIES or not monthly_counts:
+            stories_per_day = recent_stories / 30.0
+        else:
+            # Last few complete months, skipping the current one.
+            counts = [count for _, count in monthly_counts[-4:-1]] or [monthly_counts[-1][1]]
+            stories_per_day = max(recent_stories / 30.0, sum(counts) / (30.0 * len(counts)))
+
+        return cls(hour_shares, stories_per_day, story_count=len(story_dates))
+
+    @classmethod
+    def from_json(cls, data):
+        data = json.decode(data)
+        return cls(data['hour_shares'], data['stories_per_day'], data.get('story_count', 0))
+
+    def to_json(self):
+        return json.encode({
+            'hour_shares': [round(s, 5) for s in self.hour_shares],
+            'stories_per_day': round(self.stories_per_day, 4),
+            'story_count': self.story_count,
+        })
+
+    def minutes_until(self, start, expected_stories, max_minutes):
+        """Minutes from `start` until `expected_stories` stories are expected to be published."""
+        stories_per_week = self.stories_per_day * 7
+        if stories_per_week <= 0:
+            return max_minutes
+        minutes = 0.0
+        expected = 0.0
+        current = start
+        while minutes < max_minutes:
+            minutes_left_in_hour = 60 - current.minute - current.second / 60.0
+            rate = stories_per_week * self.hour_shares[self.hour_of_week(current)]
+            if rate > 0 and expected + rate * minutes_left_in_hour / 60.0 >= expected_stories:
+                minutes += (expected_stories - expected) / rate * 60.0
+                break
+            expected += rate * minutes_left_in_hour / 60.0
+            minutes += minutes_left_in_hour
+            current += datetime.timedelta(minutes=minutes_left_in_hour)
+
+        return min(minutes, max_minutes)
+
+    def fetch_interval(self, now, subscribers, baseline_minutes):
+        """
+        Minutes until the next fetch: roughly when the next story is due (half a story
+        for feeds with several readers), kept within a factor of the baseline
+        interval so subscriber counts still set the overall budget.
+        """
+        expected_stories = .5 if subscribers > 1 else 1.0
+        min_minutes = max(self.MIN_INTERVAL, baseline_minutes / float(self.MAX_SPEEDUP))
+        max_minutes = baseline_minutes * self.MAX_SLOWDOWN
+        minutes = self.minutes_until(now, expected_stories, max_minutes)
+
+        return int(max(min_minutes, min(max_minutes, minutes)))
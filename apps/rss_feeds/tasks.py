@@ -13,6 +13,7 @@ class TaskFeeds(Task):
 
     def run(self, **kwargs):
         from apps.rss_feeds.models import Feed        
+        from apps.rss_feeds.scheduler import FeedScheduler
         settings.LOG_TO_STREAM = True
         now = datetime.datetime.utcnow()
         start = time.time()
@@ -23,22 +24,24 @@ class TaskFeeds(Task):
         r.zremrangebyscore('fetched_feeds_last_hour', 0, int(hour_ago.strftime('%s')))
         
         now_timestamp = int(now.strftime("%s"))
-        queued_feeds = r.zrangebyscore('scheduled_updates', 0, now_timestamp)
-        r.zremrangebyscore('scheduled_updates', 0, now_timestamp)
-        r.sadd('queued_feeds', *queued_feeds)
+        scheduler = FeedScheduler(r)
+        queued_count = scheduler.queue_due_feeds(now_timestamp)
         logging.debug(" ---> ~SN~FBQueuing ~SB%s~SN stale feeds (~SB%s~SN/~FG%s~FB~SN/%s tasked/queued/scheduled)" % (
-                        len(queued_feeds),
+                        queued_count,
                         r.zcard('tasked_feeds'),
-                        r.scard('queued_feeds'),
+                        r.zcard('queued_feeds'),
                         r.zcard('scheduled_updates')))
         
-        # Regular feeds
-        if tasked_feeds_size < 10000:
-            feeds = r.srandmember('queued_feeds', 10000)
+        # Regular feeds, most overdue first, as many as the workers are keeping up with
+        capacity = scheduler.capacity(now_timestamp, tasked_feeds_size)
+        if capacity:
+            feeds, lags = scheduler.next_feeds(capacity, now_timestamp)
             Feed.task_feeds(feeds, verbose=True)
+            scheduler.record_lag(lags)
             active_count = len(feeds)
         else:
-            logging.debug(" ---> ~SN~FBToo many tasked feeds. ~SB%s~SN tasked." % tasked_feeds_size)
+            logging.debug(" ---> ~SN~FBWorkers are behind. ~SB%s~SN tasked at ~SB%.0f~SN feeds/min." % (
+                          tasked_feeds_size, scheduler.throughput(now_timestamp)))
             active_count = 0
         cp1 = time.time()
         
@@ -64,7 +67,7 @@ class TaskFeeds(Task):
                 feed.set_next_scheduled_update()
             logging.debug(" ---> ~SN~FBRe-queuing ~SB%s~SN dropped feeds (~SB%s/%s~SN queued/tasked)" % (
                             inactive_count,
-                            r.scard('queued_feeds'),
+                            r.zcard('queued_feeds'),
                             r.zcard('tasked_feeds')))
         cp3 = time.time()
         
@@ -93,7 +96,7 @@ class TaskFeeds(Task):
         logging.debug(" ---> ~SN~FBTasking took ~SB%s~SN seconds (~SB%s~SN/~FG%s~FB~SN/%s tasked/queued/scheduled)" % (
                         int((time.time() - start)),
                         r.zcard('tasked_feeds'),
-                        r.scard('queued_feeds'),
+                        r.zcard('queued_feeds'),
                         r.zcard('scheduled_updates')))
 
         
@@ -105,6 +108,7 @@ class UpdateFeeds(Task):
     def run(self, feed_pks, **kwargs):
         from apps.rss_feeds.models import Feed
         from apps.statistics.models import MStatistics
+        from utils.feed_fetcher import FeedPrefetcher
         r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
 
         mongodb_replication_lag = int(MStatistics.get('mongodb_replication_lag', 0))
@@ -115,10 +119,15 @@ class UpdateFeeds(Task):
             'updates_off': MStatistics.get('updates_off', False),
             'compute_scores': compute_scores,
             'mongodb_replication_lag': mongodb_replication_lag,
+            'fetch_mode': kwargs.get('fetch_mode') or MStatistics.get('fetch_mode', 'serial'),
+            'concurrency': kwargs.get('concurrency', 100),
         }
         
         if not isinstance(feed_pks, list):
             feed_pks = [feed_pks]
+        
+        if options['fetch_mode'] == 'concurrent' and len(feed_pks) > 1:
+            options['prefetcher'] = FeedPrefetcher([int(f) for f in feed_pks], options).start()
             
         for feed_pk in feed_pks:
             feed = Feed.get_by_id(feed_pk)
@@ -217,6 +226,26 @@ class SchedulePremiumSetup(Task):
         
         Feed.setup_feeds_for_premium_subscribers(feed_ids)
         
+class CountSubscribers(Task):
+    name = 'count-subscribers'
+    max_retries = 0
+    ignore_result = True
+    
+    def run(self, feed_ids=None, **kwargs):
+        from apps.rss_feeds.models import Feed
+        from utils.feed_functions import chunks
+        
+        if feed_ids:
+            Feed.count_subscribers_for_feeds(feed_ids)
+            return
+        if settings.COUNT_SUBSCRIBERS_ON_FETCH:
+            return
+        
+        feed_ids = list(Feed.objects.filter(num_subscribers__gte=1).values_list('pk', flat=True))
+        logging.debug(" ---> ~SN~FBTasking subscriber recounts for ~SB%s~SN feeds..." % len(feed_ids))
+        for feed_ids_chunk in chunks(feed_ids, 10000):
+            CountSubscribers.apply_async(kwargs=dict(feed_ids=feed_ids_chunk))
+
 class ScheduleCountTagsForUser(Task):
     
     def run(self, user_id):
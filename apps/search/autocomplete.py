@@ -0,0 +1,339 @@
+import os
+import re
+import time
+import array
+import bisect
+import marshal
+import threading
+import redis
+from django.conf import settings
+from utils import log as logging
+
+NORMALIZE_RE = re.compile(r"[\W_]+", re.UNICODE)
+ADDRESS_RE = re.compile(r"^[a-z]+://(www\.)?")
+
+
+def normalize(value):
+    if not value:
+        return u""
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'ignore')
+    return NORMALIZE_RE.sub(u" ", value.lower()).strip()
+
+def normalize_address(value):
+    if not value:
+        return u""
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'ignore')
+    return normalize(ADDRESS_RE.sub(u"", value.lower()))
+
+
+class FeedPrefixIndex:
+    """
+    Feed autocomplete from a sorted array of normalized titles and addresses,
+    held in-process. Every word of a title starts a key, as does the address
+    and the link's host, so "fire" finds Daring Fireball. Keys are one utf-8
+    string with an offsets array, found by binary search, and each key points
+    at its feed's rank by `num_subscribers`, so a prefix's best feeds are the
+    smallest ranks in its range. Prefixes of up to PRECOMPUTED_LENGTH bytes,
+    whose ranges are the longest, have their top ranks stored.
+
+    Built from the feeds table and snapshotted to FEED_AUTOCOMPLETE_SNAPSHOT,
+    which workers load instead of rebuilding. Feeds created or merged since
+    are queued in redis (FAU) and replayed by every worker within
+    SYNC_SECONDS, overriding their entries in the arrays with a small sorted
+    overlay of their keys, searched the same way.
+    """
+
+    SNAPSHOT_VERSION = 1
+    MAX_KEY_LENGTH = 48
+    MAX_TITLE_WORDS = 6
+    PRECOMPUTED_LENGTH = 2
+    TOP_K = 20
+    SYNC_SECONDS = 10
+    MAX_UPDATES = 10000
+
+    _shared = None
+    _building = threading.Lock()
+
+    def __init__(self, blob, offsets, ranks, feed_ids, subscribers, top, updates=0, built=None):
+        self.blob = blob
+        self.offsets = offsets
+        self.ranks = ranks
+        self.feed_ids = feed_ids
+        self.subscribers = subscribers
+        self.top = top
+        self.updates = updates
+        self.built = built or time.time()
+        self.changed_feeds = {}
+        self.changed_keys = []
+        self.changed_key_feeds = []
+        self.snapshot_mtime = 0
+        self.next_sync = 0
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def feed_keys(cls, title, address, link):
+        keys = set()
+        title = normalize(title)
+        if title:
+            starts = [0] + [m.end() for m in re.finditer(u" ", title)][:cls.MAX_TITLE_WORDS-1]
+            keys.update(title[start:start+cls.MAX_KEY_LENGTH] for start in starts)
+        for url in (address, link):
+            url = normalize_address(url)
+            if url:
+                keys.add(url[:cls.MAX_KEY_LENGTH])
+
+        return [key.encode('utf-8') for key in keys if key]
+
+    @classmethod
+    def build(cls, feeds, updates=0):
+        """Builds the index from (feed_id, title, address, link, num_subscribers) rows."""
+        feeds = sorted(feeds, key=lambda f: (-(f[4] or 0), f[0]))
+        entries = []
+        for rank, (feed_id, title, address, link, _) in enumerate(feeds):
+            entries.extend((key, rank) for key in cls.feed_keys(title, address, link))
+        entries.sort()
+
+        offsets = array.array('I', [0])
+        for key, _ in entries:
+            offsets.append(offsets[-1] + len(key) + 1)
+        index = cls(blob=''.join(key + '\0' for key, _ in entries),
+                    offsets=offsets,
+                    ranks=array.array('I', [rank for _, rank in entries]),
+                    feed_ids=array.array('i', [f[0] for f in feeds]),
+                    subscribers=array.array('i', [f[4] or 0 for f in feeds]),
+                    top={},
+                    updates=updates)
+
+        prefixes = set(key[:length] for key, _ in entries
+                       for length in range(1, cls.PRECOMPUTED_LENGTH+1))
+        for prefix in prefixes:
+            top_ranks = index.range_ranks(prefix)[:cls.TOP_K]
+            index.top[prefix] = array.array('I', top_ranks)
+
+        return index
+
+    @classmethod
+    def build_from_feeds(cls):
+        from apps.rss_feeds.models import Feed
+        r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        # Counted first, so changes made while the feeds are read are replayed after.
+        updates = int(r.get('FAU:n') or 0)
+        feeds = Feed.objects.filter(num_subscribers__gt=1, branch_from_feed__isnull=True)\
+                            .values_list('pk', 'feed_title', 'feed_address', 'feed_link',
+                                         'num_subscribers')
+
+        return cls.build(feeds.iterator(), updates=updates)
+
+    def key(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i+1]-1]
+
+    def bisect(self, prefix):
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range_ranks(self, prefix):
+        lo = self.bisect(prefix)
+        hi = self.bisect(prefix + '\xff')
+        return sorted(set(self.ranks[lo:hi]))
+
+    def lookup(self, prefix, limit=5):
+        """Ids of the `limit` most subscribed feeds with a key starting with `prefix`."""
+        prefix = normalize(prefix).encode('utf-8')
+        if not prefix:
+            return []
+
+        if len(prefix) <= self.PRECOMPUTED_LENGTH:
+            ranks = self.top.get(prefix, ())
+            results = self.ranked_feeds(ranks, limit)
+            if len(results) < limit and len(ranks) >= self.TOP_K:
+                # Changed feeds took up too many of the stored ranks.
+                results = self.ranked_feeds(self.range_ranks(prefix), limit)
+        else:
+            results = self.ranked_feeds(self.range_ranks(prefix), limit)
+
+        lo = bisect.bisect_left(self.changed_keys, prefix)
+        hi = bisect.bisect_left(self.changed_keys, prefix + '\xff')
+        for feed_id in set(self.changed_key_feeds[lo:hi]):
+            results.append((-self.changed_feeds[feed_id][0], feed_id))
+
+        return [feed_id for _, feed_id in sorted(results)[:limit]]
+
+    def ranked_feeds(self, ranks, limit):
+        results = []
+        for rank in ranks:
+            feed_id = self.feed_ids[rank]
+            if feed_id in self.changed_feeds:
+                continue
+            results.append((-self.subscribers[rank], feed_id))
+            if len(results) >= limit:
+                break
+
+        return results
+
+    def apply_changes(self, feed_ids):
+        """Overrides the entries of feeds changed since the build with how they are now.
+           Feeds that are gone, branched, or that the build would leave out, are left
+           out of results."""
+        from apps.rss_feeds.models import Feed
+        feeds = Feed.objects.filter(pk__in=feed_ids, num_subscribers__gt=1,
+                                    branch_from_feed__isnull=True)\
+                            .values_list('pk', 'feed_title', 'feed_address', 'feed_link',
+                                         'num_subscribers')
+        for feed_id in feed_ids:
+            self.changed_feeds[feed_id] = None
+        for feed_id, title, address, link, num_subscribers in feeds:
+            self.changed_feeds[feed_id] = (num_subscribers or 0,
+                                           self.feed_keys(title, address, link))
+        
+        changed_keys = sorted((key, feed_id) for feed_id, changed in self.changed_feeds.iteritems()
+                              if changed for key in changed[1])
+        self.changed_keys = [key for key, _ in changed_keys]
+        self.changed_key_feeds = [feed_id for _, feed_id in changed_keys]
+
+    def sync(self, force=False):
+        now = time.time()
+        if not force and now < self.next_sync:
+            return
+        self.next_sync = now + self.SYNC_SECONDS
+
+        r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        count = int(r.get('FAU:n') or 0)
+        if count <= self.updates:
+            return
+
+        # More changes than are queued means some were trimmed, so replay all there are.
+        queued = r.lrange('FAU', -min(count - self.updates, self.MAX_UPDATES), -1)
+        self.updates = count
+        self.apply_changes(set(int(feed_id) for feed_id in queued))
+
+    @classmethod
+    def feed_changed(cls, *feed_ids):
+        if not settings.FEED_AUTOCOMPLETE:
+            return
+
+        r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        pipe = r.pipeline()
+        pipe.rpush('FAU', *feed_ids)
+        pipe.ltrim('FAU', -cls.MAX_UPDATES, -1)
+        pipe.incr('FAU:n', len(feed_ids))
+        pipe.execute()
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        snapshot = {
+            'version': self.SNAPSHOT_VERSION,
+            'built': self.built,
+            'updates': self.updates,
+            'blob': self.blob,
+            'offsets': self.offsets.tostring(),
+            'ranks': self.ranks.tostring(),
+            'feed_ids': self.feed_ids.tostring(),
+            'subscribers': self.subscribers.tostring(),
+            'top': dict((prefix, ranks.tostring()) for prefix, ranks in self.top.iteritems()),
+        }
+        temp_path = "%s.%s" % (path, os.getpid())
+        with open(temp_path, 'wb') as snapshot_file:
+            marshal.dump(snapshot, snapshot_file)
+        os.rename(temp_path, path)
+        self.snapshot_mtime = os.path.getmtime(path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as snapshot_file:
+            snapshot_mtime = os.fstat(snapshot_file.fileno()).st_mtime
+            snapshot = marshal.load(snapshot_file)
+        if snapshot.get('version') != cls.SNAPSHOT_VERSION:
+            return
+
+        def unpack(typecode, data):
+            values = array.array(typecode)
+            values.fromstring(data)
+            return values
+
+        index = cls(blob=snapshot['blob'],
+                    offsets=unpack('I', snapshot['offsets']),
+                    ranks=unpack('I', snapshot['ranks']),
+                    feed_ids=unpack('i', snapshot['feed_ids']),
+                    subscribers=unpack('i', snapshot['subscribers']),
+                    top=dict((prefix, unpack('I', ranks))
+                             for prefix, ranks in snapshot['top'].iteritems()),
+                    updates=snapshot['updates'],
+                    built=snapshot['built'])
+        index.snapshot_mtime = snapshot_mtime
+        
+        return index
+
+    @classmethod
+    def rebuild(cls):
+        start = time.time()
+        index = cls.build_from_feeds()
+        index.save(settings.FEED_AUTOCOMPLETE_SNAPSHOT)
+        logging.info(" ---> ~FCBuilt feed autocomplete: ~SB%s keys~SN for %s feeds in ~SB%.1f~SN sec" % (
+                     len(index), len(index.feed_ids), time.time() - start))
+
+        return index
+
+    @classmethod
+    def shared(cls):
+        """This process's index, loaded from the snapshot the first time. A missing or
+           stale snapshot is rebuilt in the background, and until there is one, None
+           is returned so callers search the way they did before."""
+        index = cls._shared
+        if index and time.time() < index.next_sync:
+            return index
+
+        path = settings.FEED_AUTOCOMPLETE_SNAPSHOT
+        try:
+            # Only a snapshot saved since this index was loaded or saved is reloaded.
+            if os.path.exists(path) and (not index or os.path.getmtime(path) > index.snapshot_mtime):
+                loaded = cls.load(path)
+                if loaded:
+                    index = cls._shared = loaded
+        except (IOError, OSError, ValueError, EOFError, KeyError), e:
+            logging.debug(" ***> ~FRCouldn't load feed autocomplete snapshot: %s" % e)
+
+        if (not index or time.time() - index.built > settings.FEED_AUTOCOMPLETE_REBUILD*60*60):
+            if cls._building.acquire(False):
+                thread = threading.Thread(target=cls.rebuild_in_background)
+                thread.daemon = True
+                thread.start()
+
+        if index:
+            index.sync()
+
+        return index
+
+    @classmethod
+    def rebuild_in_background(cls):
+        # One process per host rebuilds, the others load its snapshot when it's saved.
+        lock_path = "%s.lock" % settings.FEED_AUTOCOMPLETE_SNAPSHOT
+        try:
+            if os.path.exists(lock_path) and time.time() - os.path.getmtime(lock_path) > 60*60:
+                os.remove(lock_path)
+            directory = os.path.dirname(lock_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL))
+        except OSError:
+            cls._building.release()
+            return
+
+        try:
+            cls._shared = cls.rebuild()
+        except Exception, e:
+            logging.debug(" ***> ~FRCouldn't build feed autocomplete: %s" % e)
+        finally:
+            os.remove(lock_path)
+            cls._building.release()
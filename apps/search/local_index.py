@@ -0,0 +1,259 @@
+import os
+import re
+import calendar
+import datetime
+import threading
+import sqlite3
+from collections import defaultdict, namedtuple
+from django.conf import settings
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+QUERY_RE = re.compile(r'(-?)(?:(\w+):)?(?:"([^"]*)"|(\S+))', re.UNICODE)
+MAX_TERM_LENGTH = 64
+SQLITE_MAX_VARIABLES = 500
+
+
+def text(value):
+    if not value:
+        return u""
+    if isinstance(value, str):
+        return value.decode('utf-8', 'ignore')
+    return unicode(value)
+
+def words(value):
+    return [word for word in WORD_RE.findall(text(value).lower()) if len(word) <= MAX_TERM_LENGTH]
+
+def stem(word):
+    """A light English suffix stemmer, standing in for Elasticsearch's snowball
+       analyzer closely enough that plurals and verb forms find each other."""
+    for suffix, replacement in (('ies', 'y'), ('sses', 'ss'), ('ing', ''), ('edly', ''),
+                                ('ed', ''), ('ly', ''), ('s', '')):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            if suffix == 's' and word.endswith(('ss', 'us', 'is')):
+                return word
+            return word[:-len(suffix)] + replacement
+    return word
+
+def epoch(date):
+    if isinstance(date, datetime.datetime):
+        return calendar.timegm(date.utctimetuple())
+    return int(date or 0)
+
+
+class LocalIndex(object):
+    """
+    An inverted index kept in a SQLite file under `SEARCH_LOCAL_INDEX_DIR`, one
+    connection per process and thread. Postings are (term, doc, weight) rows, so
+    a term's documents are a range scan of one index. It's on this host's disk,
+    so each host that searches it has to be one that indexes into it.
+    """
+
+    NAME = None
+    SCHEMA = []
+    _local = threading.local()
+
+    @classmethod
+    def path(cls):
+        return os.path.join(settings.SEARCH_LOCAL_INDEX_DIR, "%s.db" % cls.NAME)
+
+    @classmethod
+    def db(cls):
+        connections = getattr(cls._local, 'connections', None)
+        if connections is None or cls._local.pid != os.getpid():
+            connections = cls._local.connections = {}
+            cls._local.pid = os.getpid()
+
+        path = cls.path()
+        db = connections.get(path)
+        if db is None:
+            if not os.path.exists(settings.SEARCH_LOCAL_INDEX_DIR):
+                os.makedirs(settings.SEARCH_LOCAL_INDEX_DIR)
+            db = sqlite3.connect(path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA cache_size=-65536")
+            for statement in cls.SCHEMA:
+                db.execute(statement)
+            db.commit()
+            connections[path] = db
+
+        return db
+
+    @classmethod
+    def drop(cls):
+        connections = getattr(cls._local, 'connections', None) or {}
+        db = connections.pop(cls.path(), None)
+        if db:
+            db.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(cls.path() + suffix):
+                os.remove(cls.path() + suffix)
+
+
+class LocalStoryIndex(LocalIndex):
+    """
+    Stories, searchable by the same fields and boosts as the Elasticsearch
+    mapping. Bare words search every field, like Elasticsearch's _all field,
+    and `title:`, `content:`, `tags:` and `author:` search one. Every word is
+    required, `-word` excludes, and quoted phrases match their words anywhere.
+    """
+
+    NAME = "stories"
+    BOOSTS = {
+        'title': 3.0,
+        'content': 1.0,
+        'tags': 2.0,
+        'author': 1.0,
+    }
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS stories (doc INTEGER PRIMARY KEY, story_hash TEXT UNIQUE, "
+        "feed_id INTEGER, date INTEGER)",
+        "CREATE INDEX IF NOT EXISTS stories_feed_date ON stories (feed_id, date)",
+        "CREATE TABLE IF NOT EXISTS postings (term TEXT, doc INTEGER, weight REAL)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS postings_term_doc ON postings (term, doc, weight)",
+        "CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc)",
+    ]
+
+    @classmethod
+    def story_terms(cls, story):
+        terms = defaultdict(float)
+        fields = (('title', story.get('story_title')),
+                  ('content', story.get('story_content')),
+                  ('tags', u', '.join(text(tag) for tag in story.get('story_tags') or [])),
+                  ('author', story.get('story_author')))
+        for field, value in fields:
+            boost = cls.BOOSTS[field]
+            field_words = set(words(value))
+            for word in field_words:
+                terms[word] += boost
+                if field != 'author':
+                    terms[u"%s:%s" % (field, stem(word))] = boost
+            if field == 'author' and value:
+                terms[u"author:%s" % text(value)[:MAX_TERM_LENGTH]] = boost
+
+        return terms
+
+    @classmethod
+    def query_terms(cls, field, value):
+        if field == 'author':
+            return [u"author:%s" % text(value)]
+        if field in cls.BOOSTS:
+            return [u"%s:%s" % (field, stem(word)) for word in words(value)]
+        if field:
+            value = u"%s %s" % (field, value)
+        return words(value)
+
+    @classmethod
+    def parse_query(cls, query):
+        required = set()
+        excluded = set()
+        for negate, field, phrase, word in QUERY_RE.findall(text(query)):
+            if not field and word in ('AND', 'OR', '&&', '||'):
+                continue
+            terms = cls.query_terms(field, phrase or word)
+            (excluded if negate else required).update(terms)
+
+        return required, excluded
+
+    @classmethod
+    def index_stories(cls, stories):
+        db = cls.db()
+        with db:
+            cls._remove(db, [story['story_hash'] for story in stories])
+            for story in stories:
+                cursor = db.execute("INSERT INTO stories (story_hash, feed_id, date) VALUES (?, ?, ?)",
+                                    (story['story_hash'], story['story_feed_id'],
+                                     epoch(story.get('story_date'))))
+                doc = cursor.lastrowid
+                db.executemany("INSERT INTO postings (term, doc, weight) VALUES (?, ?, ?)",
+                               [(term, doc, weight) for term, weight
+                                in cls.story_terms(story).iteritems()])
+
+    @classmethod
+    def remove_stories(cls, story_hashes):
+        db = cls.db()
+        with db:
+            cls._remove(db, story_hashes)
+
+    @classmethod
+    def _remove(cls, db, story_hashes):
+        for i in range(0, len(story_hashes), SQLITE_MAX_VARIABLES):
+            chunk = story_hashes[i:i+SQLITE_MAX_VARIABLES]
+            placeholders = ','.join('?' * len(chunk))
+            db.execute("DELETE FROM postings WHERE doc IN "
+                       "(SELECT doc FROM stories WHERE story_hash IN (%s))" % placeholders, chunk)
+            db.execute("DELETE FROM stories WHERE story_hash IN (%s)" % placeholders, chunk)
+
+    @classmethod
+    def query(cls, feed_ids, query, order, offset, limit):
+        required, excluded = cls.parse_query(query)
+        if not required or not feed_ids:
+            return []
+
+        required = list(required)
+        excluded = list(excluded)
+        sql = ["SELECT s.story_hash FROM stories s JOIN postings p ON p.doc = s.doc",
+               "WHERE p.term IN (%s)" % ','.join('?' * len(required)),
+               "AND s.feed_id IN (%s)" % ','.join(str(int(feed_id)) for feed_id in feed_ids)]
+        if excluded:
+            sql.append("AND s.doc NOT IN (SELECT doc FROM postings WHERE term IN (%s))" %
+                       ','.join('?' * len(excluded)))
+        sql.append("GROUP BY s.doc HAVING COUNT(*) = ?")
+        sql.append("ORDER BY s.date %s, SUM(p.weight) DESC" % ('DESC' if order == "newest" else 'ASC'))
+        sql.append("LIMIT ? OFFSET ?")
+        params = required + excluded + [len(required), limit, offset]
+
+        return [story_hash for story_hash, in cls.db().execute(' '.join(sql), params)]
+
+
+LocalFeedResult = namedtuple('LocalFeedResult', ['feed_id', 'num_subscribers'])
+
+
+class LocalFeedIndex(LocalIndex):
+    """
+    Feeds by the words of their address, title and link. Query words match as
+    prefixes, as with the edge ngrams in the Elasticsearch mapping, and the
+    most subscribed feeds come first.
+    """
+
+    NAME = "feeds"
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS feeds (feed_id INTEGER PRIMARY KEY, num_subscribers INTEGER)",
+        "CREATE TABLE IF NOT EXISTS feed_terms (term TEXT, feed_id INTEGER)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS feed_terms_term ON feed_terms (term, feed_id)",
+        "CREATE INDEX IF NOT EXISTS feed_terms_feed ON feed_terms (feed_id)",
+    ]
+
+    @classmethod
+    def index(cls, feed_id, title, address, link, num_subscribers):
+        terms = set()
+        for field, value in (('address', address), ('title', title), ('link', link)):
+            terms.update(u"%s:%s" % (field, word) for word in words(value))
+
+        db = cls.db()
+        with db:
+            db.execute("DELETE FROM feed_terms WHERE feed_id = ?", (feed_id,))
+            db.execute("INSERT OR REPLACE INTO feeds (feed_id, num_subscribers) VALUES (?, ?)",
+                       (feed_id, num_subscribers))
+            db.executemany("INSERT INTO feed_terms (term, feed_id) VALUES (?, ?)",
+                           [(term, feed_id) for term in terms])
+
+    @classmethod
+    def query(cls, text, size=5):
+        """Searches addresses, then titles, then links, like `SearchFeed.query`."""
+        for field in ('address', 'title', 'link'):
+            prefixes = [u"%s:%s" % (field, word) for word in words(text)]
+            if not prefixes:
+                return []
+            sql = ["SELECT f.feed_id, f.num_subscribers FROM feeds f WHERE"]
+            sql.append(" AND ".join(["f.feed_id IN (SELECT feed_id FROM feed_terms "
+                                     "WHERE term >= ? AND term < ?)"] * len(prefixes)))
+            sql.append("ORDER BY f.num_subscribers DESC LIMIT ?")
+            params = []
+            for prefix in prefixes:
+                params.extend([prefix, prefix + u"\uffff"])
+            results = [LocalFeedResult(*row) for row in cls.db().execute(' '.join(sql), params + [size])]
+            if results:
+                return results
+
+        return []
@@ -0,0 +1,106 @@
+import time
+import random
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from apps.rss_feeds.models import MStory
+from apps.reader.models import UserSubscription
+from apps.search.models import SearchStory, BulkStoryIndexer, search_document
+from apps.search.local_index import LocalStoryIndex, words
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-u", "--username", dest="username",
+                    help="Search across this user's feeds."),
+        make_option("-q", "--queries", dest="queries",
+                    help="Comma separated queries. Defaults to words sampled from story titles."),
+        make_option("-s", "--sample", dest="sample", type='int', default=20,
+                    help="Title words to sample as queries."),
+        make_option("-n", "--repeat", dest="repeat", type='int', default=5,
+                    help="Times each query is run on each backend."),
+        make_option("-b", "--build", dest="build", action="store_true", default=False,
+                    help="First index the user's stories into the local index."),
+    )
+
+    def handle(self, *args, **options):
+        random.seed(1)
+        user = User.objects.get(username=options['username'])
+        feed_ids = [sub.feed_id for sub in UserSubscription.objects.filter(user=user, active=True)]
+        print " ---> %s feeds" % len(feed_ids)
+
+        if options['build']:
+            self.build(feed_ids)
+
+        if options['queries']:
+            queries = [q.strip() for q in options['queries'].split(',') if q.strip()]
+        else:
+            titles = MStory.raw_stories(fields=['story_title'], story_feed_id={'$in': feed_ids},
+                                        limit=1000)
+            title_words = sorted(set(word for story in titles
+                                     for word in words(story.get('story_title'))
+                                     if len(word) >= 5 and not word.isdigit()))
+            queries = random.sample(title_words, min(options['sample'], len(title_words)))
+        if not queries:
+            print " ---> No queries to run."
+            return
+
+        engines = (
+            ('elasticsearch', lambda q: SearchStory.query_elasticsearch(feed_ids, q, "newest", 0, 25,
+                                                                        user_id=user.pk)),
+            ('local', lambda q: LocalStoryIndex.query(feed_ids, q, "newest", 0, 25)),
+        )
+        latencies = dict((engine, []) for engine, _ in engines)
+        overlaps = []
+        for query in queries:
+            results = {}
+            for engine, search in engines:
+                start = time.time()
+                for _ in range(options['repeat']):
+                    results[engine] = search(query)
+                if results[engine] is None:
+                    continue
+                latencies[engine].append(1000 * (time.time() - start) / options['repeat'])
+
+            line = " ---> %-20s" % query[:20]
+            for engine, _ in engines:
+                if results[engine] is None:
+                    line += " %s unavailable," % engine
+                else:
+                    line += " %s %6.1f ms (%2s)," % (engine, latencies[engine][-1], len(results[engine]))
+            if results['elasticsearch']:
+                same = set(results['elasticsearch']) & set(results['local'])
+                overlaps.append(float(len(same)) / len(results['elasticsearch']))
+                line += " %3.0f%% same stories" % (100 * overlaps[-1])
+            print line.rstrip(',')
+
+        for engine, _ in engines:
+            engine_latencies = sorted(latencies[engine])
+            if not engine_latencies:
+                print " ---> %-13s unavailable" % engine
+                continue
+            print " ---> %-13s %6.1f ms mean, %6.1f ms p50, %6.1f ms p90 over %s queries" % (
+                engine, sum(engine_latencies) / len(engine_latencies),
+                engine_latencies[len(engine_latencies) / 2],
+                engine_latencies[int(.9 * (len(engine_latencies) - 1))], len(engine_latencies))
+        if overlaps:
+            print " ---> Local results share %.0f%% of Elasticsearch's first page" % (
+                100 * sum(overlaps) / len(overlaps))
+
+    def build(self, feed_ids):
+        start = time.time()
+        batch = []
+        indexed = 0
+        for story in MStory.raw_stories(fields=BulkStoryIndexer.FIELDS,
+                                        story_feed_id={'$in': feed_ids}):
+            batch.append(search_document(story))
+            if len(batch) >= 400:
+                LocalStoryIndex.index_stories(batch)
+                indexed += len(batch)
+                batch = []
+        if batch:
+            LocalStoryIndex.index_stories(batch)
+            indexed += len(batch)
+        duration = time.time() - start
+        print " ---> Indexed %s stories locally in %.1f sec (%.0f stories/sec)" % (
+            indexed, duration, indexed / max(duration, .001))
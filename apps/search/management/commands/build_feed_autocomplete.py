@@ -0,0 +1,19 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from apps.search.autocomplete import FeedPrefixIndex
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-q", "--query", dest="queries", action="append", default=[],
+                    help="Look up a prefix in the new index. Can be given more than once."),
+    )
+
+    def handle(self, *args, **options):
+        index = FeedPrefixIndex.rebuild()
+        
+        for query in options['queries']:
+            start = time.time()
+            feed_ids = index.lookup(query)
+            print " ---> %s: %s (%.3f ms)" % (query, feed_ids, (time.time() - start) * 1000)
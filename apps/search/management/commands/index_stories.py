@@ -1,16 +1,29 @@
 import re
 from django.core.management.base import BaseCommand
 from django.contrib.auth.models import User
-from apps.rss_feeds.models import Feed
+from apps.rss_feeds.models import Feed, MStory
 from apps.reader.models import UserSubscription
 from optparse import make_option
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option("-u", "--user", dest="user", nargs=1, help="Specify user id or username"),
+        make_option("-a", "--all", dest="all", action="store_true", default=False,
+                    help="Index the stories of every active feed."),
+        make_option("-o", "--offset", dest="offset", type="int", default=0,
+                    help="With --all, the feed id to start at."),
+        make_option("-w", "--workers", dest="workers", type="int", default=1,
+                    help="Processes preparing stories for the index."),
+        make_option("-c", "--checkpoint", dest="checkpoint",
+                    help="Name of the checkpoint an interrupted run resumes from."),
     )
 
     def handle(self, *args, **options):
+        if options['all']:
+            MStory.index_all_for_search(offset=options['offset'], workers=options['workers'],
+                                        checkpoint=options['checkpoint'] or "all")
+            return
+        
         if re.match(r"([0-9]+)", options['user']):
             user = User.objects.get(pk=int(options['user']))
         else:
@@ -19,9 +32,6 @@ class Command(BaseCommand):
         subscriptions = UserSubscription.objects.filter(user=user)
         print " ---> Indexing %s feeds..." % subscriptions.count()
         
-        for sub in subscriptions:
-            try:
-                sub.feed.index_stories_for_search()
-            except Feed.DoesNotExist:
-                print " ***> Couldn't find %s" % sub.feed_id
-        
\ No newline at end of file
+        feed_ids = [sub.feed_id for sub in subscriptions]
+        Feed.index_feeds_stories_for_search(feed_ids, workers=options['workers'],
+                                            checkpoint=options['checkpoint'] or "user:%s" % user.pk)
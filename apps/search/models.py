@@ -1,5 +1,9 @@
 import time
+import zlib
 import datetime
+import hashlib
+import multiprocessing
+import sqlite3
 import pymongo
 import pyes
 import redis
@@ -11,8 +15,17 @@ from django.contrib.auth.models import User
 from apps.search.tasks import IndexSubscriptionsForSearch
 from apps.search.tasks import IndexSubscriptionsChunkForSearch
 from apps.search.tasks import IndexFeedsForSearch
+from apps.search.local_index import LocalStoryIndex, LocalFeedIndex
+from apps.statistics.rstats import RStats
 from utils import log as logging
 from utils.feed_functions import chunks
+from utils.story_functions import prep_for_search
+
+def using_elasticsearch():
+    return settings.SEARCH_BACKEND == 'elasticsearch'
+
+def using_local_index():
+    return settings.SEARCH_BACKEND == 'local' or settings.SEARCH_LOCAL_FALLBACK
 
 class MUserSearch(mongo.Document):
     '''Search index state of a user's subscriptions.'''
@@ -75,7 +88,7 @@ class MUserSearch(mongo.Document):
             except Feed.DoesNotExist:
                 continue
         
-        feed_id_chunks = [c for c in chunks(feed_ids, 6)]
+        feed_id_chunks = [c for c in chunks(feed_ids, 20)]
         logging.user(user, "~FCIndexing ~SB%s feeds~SN in %s chunks..." % 
                      (total, len(feed_id_chunks)))
         
@@ -103,11 +116,7 @@ class MUserSearch(mongo.Document):
 
         logging.user(user, "~FCIndexing %s feeds..." % len(feed_ids))
 
-        for feed_id in feed_ids:
-            feed = Feed.get_by_id(feed_id)
-            if not feed: continue
-            
-            feed.index_stories_for_search()
+        Feed.index_feeds_stories_for_search(feed_ids)
             
         r.publish(user.username, 'search_index_complete:feeds:%s' % 
                   ','.join([str(f) for f in feed_ids]))
@@ -133,11 +142,7 @@ class MUserSearch(mongo.Document):
 
         logging.user(user, "~SB~FCIndexing %s~FC by request..." % feed_ids)
 
-        for feed_id in feed_ids:
-            feed = Feed.get_by_id(feed_id)
-            if not feed: continue
-            
-            feed.index_stories_for_search()
+        Feed.index_feeds_stories_for_search(feed_ids)
         
     @classmethod
     def remove_all(cls):
@@ -176,6 +181,10 @@ class SearchStory:
     
     ES = pyes.ES(settings.ELASTICSEARCH_STORY_HOSTS)
     name = "stories"
+    # Searches across more feeds than this filter on the user's feed set stored
+    # in the index, instead of sending every feed id along with each query.
+    MAX_INLINE_FEED_IDS = 200
+    FEEDSET_EXPIRE = 30
     
     @classmethod
     def index_name(cls):
@@ -185,11 +194,27 @@ class SearchStory:
     def type_name(cls):
         return "%s-type" % cls.name
         
+    @classmethod
+    def feedset_type_name(cls):
+        return "feedsets-type"
+        
+    @classmethod
+    def reset_feedsets(cls):
+        """Forgets which feed set documents are stored, for when the index that holds
+           them is dropped or created, so the next search stores them again."""
+        r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        r.incr("SFS:generation")
+        
     @classmethod
     def create_elasticsearch_mapping(cls, delete=False):
+        if delete and using_local_index():
+            LocalStoryIndex.drop()
+        if not using_elasticsearch():
+            return
         if delete:
             cls.ES.indices.delete_index_if_exists("%s-index" % cls.name)
         cls.ES.indices.create_index_if_missing("%s-index" % cls.name)
+        cls.reset_feedsets()
         mapping = { 
             'title': {
                 'boost': 3.0,
@@ -232,10 +257,28 @@ class SearchStory:
             'properties': mapping,
             '_source': {'enabled': False},
         }, ["%s-index" % cls.name])
+        # Terms lookups read the feed ids out of _source, so it stays enabled here.
+        cls.ES.indices.put_mapping(cls.feedset_type_name(), {
+            'properties': {
+                'feed_ids': {
+                    'index': 'no',
+                    'store': 'no',
+                    'type': 'integer',
+                },
+            },
+        }, ["%s-index" % cls.name])
         
     @classmethod
     def index(cls, story_hash, story_title, story_content, story_tags, story_author, story_feed_id, 
               story_date):
+        if using_local_index():
+            cls.index_local([dict(story_hash=story_hash, story_title=story_title,
+                                  story_content=story_content, story_tags=story_tags,
+                                  story_author=story_author, story_feed_id=story_feed_id,
+                                  story_date=story_date)])
+        if not using_elasticsearch():
+            return
+        
         doc = {
             "content"   : story_content,
             "title"     : story_title,
@@ -249,37 +292,317 @@ class SearchStory:
         except pyes.exceptions.NoServerAvailable:
             logging.debug(" ***> ~FRNo search server available.")
     
+    @classmethod
+    def index_stories(cls, stories):
+        """Indexes many stories, each a dict of `index`'s arguments, in one bulk request.
+           Returns False if the search server couldn't be reached."""
+        if using_local_index():
+            indexed = cls.index_local(stories)
+            if not using_elasticsearch():
+                return indexed
+        
+        try:
+            for story in stories:
+                doc = {
+                    "content"   : story['story_content'],
+                    "title"     : story['story_title'],
+                    "tags"      : ', '.join(story['story_tags']),
+                    "author"    : story['story_author'],
+                    "feed_id"   : story['story_feed_id'],
+                    "date"      : story['story_date'],
+                }
+                cls.ES.index(doc, "%s-index" % cls.name, "%s-type" % cls.name, story['story_hash'],
+                             bulk=True)
+            cls.ES.flush_bulk(forced=True)
+        except pyes.exceptions.NoServerAvailable:
+            logging.debug(" ***> ~FRNo search server available.")
+            return False
+        
+        return True
+    
+    @classmethod
+    def index_local(cls, stories):
+        try:
+            LocalStoryIndex.index_stories(stories)
+        except sqlite3.Error, e:
+            logging.debug(" ***> ~FRLocal search index error: %s" % e)
+            return False
+        
+        return True
+    
     @classmethod
     def remove(cls, story_hash):
+        cls.remove_stories([story_hash])
+        
+    @classmethod
+    def remove_stories(cls, story_hashes):
+        """Removes many stories from the index in one bulk request."""
+        if using_local_index():
+            try:
+                LocalStoryIndex.remove_stories(story_hashes)
+            except sqlite3.Error, e:
+                logging.debug(" ***> ~FRLocal search index error: %s" % e)
+        if not using_elasticsearch():
+            return
+        
+        if len(story_hashes) == 1:
+            cls.remove_elasticsearch(story_hashes[0])
+            return
+        try:
+            for story_hash in story_hashes:
+                cls.ES.delete("%s-index" % cls.name, "%s-type" % cls.name, story_hash, bulk=True)
+            cls.ES.flush_bulk(forced=True)
+        except pyes.exceptions.NoServerAvailable:
+            logging.debug(" ***> ~FRNo search server available.")
+    
+    @classmethod
+    def remove_elasticsearch(cls, story_hash):
         try:
             cls.ES.delete("%s-index" % cls.name, "%s-type" % cls.name, story_hash)
         except pyes.exceptions.NoServerAvailable:
             logging.debug(" ***> ~FRNo search server available.")
-        
+    
     @classmethod
     def drop(cls):
-        cls.ES.indices.delete_index_if_exists("%s-index" % cls.name)
+        if using_local_index():
+            LocalStoryIndex.drop()
+        if using_elasticsearch():
+            cls.ES.indices.delete_index_if_exists("%s-index" % cls.name)
+            cls.reset_feedsets()
+        
+    @classmethod
+    def feed_filter(cls, feed_ids, user_id=None):
+        """Filters stories down to `feed_ids`. Small sets are sent inline. Large
+           sets are stored once as a document for the user and set, and looked up
+           by the search server, which caches the filter under the same key."""
+        if not user_id or len(feed_ids) <= cls.MAX_INLINE_FEED_IDS:
+            return {'terms': {'feed_id': feed_ids}}
+        
+        feed_ids = sorted(set(feed_ids))
+        feedset = hashlib.sha1(','.join(str(f) for f in feed_ids)).hexdigest()[:12]
+        feedset_id = "%s:%s" % (user_id, feedset)
+        r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        feedset_key = "SFS:%s" % feedset_id
+        pipeline = r.pipeline()
+        pipeline.get("SFS:generation")
+        pipeline.get(feedset_key)
+        generation, stored_generation = pipeline.execute()
+        generation = generation or "0"
+        if stored_generation != generation:
+            cls.ES.index({'feed_ids': feed_ids}, cls.index_name(), cls.feedset_type_name(), feedset_id)
+            r.setex(feedset_key, generation, cls.FEEDSET_EXPIRE*60*60*24)
+        
+        return {
+            'terms': {
+                'feed_id': {
+                    'index': cls.index_name(),
+                    'type': cls.feedset_type_name(),
+                    'id': feedset_id,
+                    'path': 'feed_ids',
+                },
+                '_cache_key': "feedset:%s:%s" % (feedset_id, generation),
+            }
+        }
+    
+    @classmethod
+    def query(cls, feed_ids, query, order, offset, limit, user_id=None):
+        """Story hashes matching `query` in `feed_ids`, from Elasticsearch, or from the
+           local index when that's the backend or Elasticsearch can't be reached."""
+        start = time.time()
+        backend = "elasticsearch"
+        story_hashes = None
+        if using_elasticsearch():
+            story_hashes = cls.query_elasticsearch(feed_ids, query, order, offset, limit,
+                                                   user_id=user_id)
+        if story_hashes is None:
+            if not using_local_index():
+                return []
+            backend = "local"
+            try:
+                story_hashes = LocalStoryIndex.query(feed_ids, query, order, offset, limit)
+            except sqlite3.Error, e:
+                logging.debug(" ***> ~FRLocal search index error: %s" % e)
+                return []
         
+        duration = time.time() - start
+        RStats.add('story_search', duration=duration)
+        logging.info(" ---> ~FG~SNSearch ~FCstories~FG for: ~SB%s~SN (across %s feed%s) in ~SB%.3f~SN sec (%s)" % 
+                     (query, len(feed_ids), 's' if len(feed_ids) != 1 else '', duration, backend))
+        
+        return story_hashes
+    
     @classmethod
-    def query(cls, feed_ids, query, order, offset, limit):
-        cls.create_elasticsearch_mapping()
-        cls.ES.indices.refresh()
-        
-        sort     = "date:desc" if order == "newest" else "date:asc"
-        string_q = pyes.query.StringQuery(query, default_operator="AND")
-        feed_q   = pyes.query.TermsQuery('feed_id', feed_ids[:1000])
-        q        = pyes.query.BoolQuery(must=[string_q, feed_q])
+    def query_elasticsearch(cls, feed_ids, query, order, offset, limit, user_id=None):
+        # Mappings are put by the search migrations, and new stories show up on
+        # the index's own refresh interval, so neither happens per query.
         try:
-            results  = cls.ES.search(q, indices=cls.index_name(), doc_types=[cls.type_name()],
-                                     partial_fields={}, sort=sort, start=offset, size=limit)
+            search = {
+                'query': {
+                    'filtered': {
+                        'query': {
+                            'query_string': {
+                                'query': query,
+                                'default_operator': 'AND',
+                            },
+                        },
+                        'filter': cls.feed_filter(feed_ids, user_id=user_id),
+                    },
+                },
+                'sort': [{'date': {'order': 'desc' if order == "newest" else 'asc'}}],
+                'from': offset,
+                'size': limit,
+                'fields': [],
+            }
+            results = cls.ES.search_raw(search, indices=cls.index_name(),
+                                        doc_types=[cls.type_name()])
         except pyes.exceptions.NoServerAvailable:
             logging.debug(" ***> ~FRNo search server available.")
-            return []
+            return
+        
+        return [hit['_id'] for hit in results['hits']['hits']]
+
+
+def search_document(story):
+    """Builds `SearchStory.index`'s arguments from a raw story document. Lives at
+       module level so a worker pool can run it."""
+    story_content = story.get('story_content') or ""
+    if story.get('story_content_z'):
+        story_content = zlib.decompress(story['story_content_z'])
+    
+    return dict(story_hash=story['story_hash'],
+                story_title=story.get('story_title'),
+                story_content=prep_for_search(story_content),
+                story_tags=story.get('story_tags') or [],
+                story_author=story.get('story_author_name'),
+                story_feed_id=story['story_feed_id'],
+                story_date=story.get('story_date'))
+
 
-        logging.info(" ---> ~FG~SNSearch ~FCstories~FG for: ~SB%s~SN (across %s feed%s)" % 
-                     (query, len(feed_ids), 's' if len(feed_ids) != 1 else ''))
+class BulkStoryIndexer:
+    """
+    Streams the stories of many feeds into the search index. Stories are read
+    with projected cursors, stripped for search (in a pool of `workers`
+    processes when there's more than one), and sent in bulk requests bounded
+    by both document count and bytes.
+    
+    With a `checkpoint` name, feeds whose stories have all been sent are kept
+    in redis, so an interrupted backfill started again with the same name
+    picks up at the first feed it hadn't finished.
+    """
+    
+    FIELDS = ['story_hash', 'story_feed_id', 'story_date', 'story_title', 'story_content',
+              'story_content_z', 'story_tags', 'story_author_name']
+    MAX_BULK_DOCS = 400
+    MAX_BULK_BYTES = 5 * 1024 * 1024
+    CHECKPOINT_EXPIRE = 7
+    
+    def __init__(self, feed_ids, checkpoint=None, workers=1, verbose=False):
+        self.feed_ids = feed_ids
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.verbose = verbose
+        self.r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        self.finished_feed_ids = set()
+        self.stats = dict(feeds=0, docs=0, bytes=0, requests=0, seconds=0)
+    
+    @property
+    def checkpoint_key(self):
+        return "SIX:%s" % self.checkpoint
+    
+    @classmethod
+    def resuming(cls, checkpoint):
+        if not checkpoint:
+            return False
+        r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        return bool(r.exists("SIX:%s" % checkpoint))
+    
+    def pending_feed_ids(self):
+        if not self.checkpoint:
+            return list(self.feed_ids)
+        indexed = set(int(feed_id) for feed_id in self.r.smembers(self.checkpoint_key))
+        return [feed_id for feed_id in self.feed_ids if feed_id not in indexed]
+    
+    def raw_stories(self, feed_ids):
+        from apps.rss_feeds.models import MStory
+        for feed_id in feed_ids:
+            for story in MStory.raw_stories(fields=self.FIELDS, story_feed_id=feed_id):
+                yield story
+    
+    def run(self):
+        feed_ids = self.pending_feed_ids()
+        if self.checkpoint and len(feed_ids) < len(self.feed_ids):
+            logging.info(" ---> ~FCResuming ~SB%s~SN: ~SB%s/%s~SN feeds already indexed" % (
+                         self.checkpoint, len(self.feed_ids) - len(feed_ids), len(self.feed_ids)))
+        
+        start = time.time()
+        pool = None
+        # Celery's prefork workers are daemonic and can't start a pool of their own.
+        if self.workers > 1 and not multiprocessing.current_process().daemon:
+            pool = multiprocessing.Pool(self.workers)
+            documents = pool.imap(search_document, self.raw_stories(feed_ids), chunksize=50)
+        else:
+            documents = (search_document(story) for story in self.raw_stories(feed_ids))
         
-        return [r.get_id() for r in results]
+        batch = []
+        batch_bytes = 0
+        finished_feed_ids = []
+        current_feed_id = None
+        completed = True
+        try:
+            for document in documents:
+                if document['story_feed_id'] != current_feed_id:
+                    if current_feed_id is not None:
+                        finished_feed_ids.append(current_feed_id)
+                    current_feed_id = document['story_feed_id']
+                batch.append(document)
+                batch_bytes += len(document['story_content']) + len(document['story_title'] or "")
+                if len(batch) >= self.MAX_BULK_DOCS or batch_bytes >= self.MAX_BULK_BYTES:
+                    if not self.flush(batch, batch_bytes, finished_feed_ids, start):
+                        completed = False
+                        break
+                    batch, batch_bytes, finished_feed_ids = [], 0, []
+            else:
+                # Every pending feed is done once the stories run out, even those without any.
+                finished_feed_ids = [feed_id for feed_id in feed_ids
+                                     if feed_id not in self.finished_feed_ids]
+                completed = self.flush(batch, batch_bytes, finished_feed_ids, start)
+        finally:
+            if pool:
+                pool.terminate()
+        
+        self.stats['seconds'] = time.time() - start
+        if completed and self.checkpoint:
+            self.r.delete(self.checkpoint_key)
+        logging.info(" ---> ~FCIndexed ~SB%s stories~SN (%.1f MB) from ~SB%s feeds~SN in %s bulk requests, "
+                     "~SB%.1f~SN sec: ~FM~SB%.0f stories/sec%s" % (
+                     self.stats['docs'], self.stats['bytes'] / 1024.0 / 1024, self.stats['feeds'],
+                     self.stats['requests'], self.stats['seconds'],
+                     self.stats['docs'] / max(self.stats['seconds'], .001),
+                     "" if completed else " ~FR(stopped, run again to resume)"))
+        
+        return self.stats
+    
+    def flush(self, batch, batch_bytes, finished_feed_ids, start):
+        if batch:
+            if not SearchStory.index_stories(batch):
+                return False
+            self.stats['requests'] += 1
+            self.stats['docs'] += len(batch)
+            self.stats['bytes'] += batch_bytes
+        
+        if finished_feed_ids:
+            self.finished_feed_ids.update(finished_feed_ids)
+            self.stats['feeds'] += len(finished_feed_ids)
+            if self.checkpoint:
+                self.r.sadd(self.checkpoint_key, *finished_feed_ids)
+                self.r.expire(self.checkpoint_key, self.CHECKPOINT_EXPIRE*60*60*24)
+        
+        if self.verbose:
+            logging.info(" ---> ~FC%s stories from %s feeds indexed, ~SB%.0f~SN stories/sec" % (
+                         self.stats['docs'], self.stats['feeds'],
+                         self.stats['docs'] / max(time.time() - start, .001)))
+        
+        return True
 
 
 class SearchFeed:
@@ -297,6 +620,10 @@ class SearchFeed:
         
     @classmethod
     def create_elasticsearch_mapping(cls, delete=False):
+        if delete and using_local_index():
+            LocalFeedIndex.drop()
+        if not using_elasticsearch():
+            return
         if delete:
             cls.ES.indices.delete_index_if_exists("%s-index" % cls.name)
         settings =  {
@@ -374,6 +701,14 @@ class SearchFeed:
         
     @classmethod
     def index(cls, feed_id, title, address, link, num_subscribers):
+        if using_local_index():
+            try:
+                LocalFeedIndex.index(feed_id, title, address, link, num_subscribers)
+            except sqlite3.Error, e:
+                logging.debug(" ***> ~FRLocal search index error: %s" % e)
+        if not using_elasticsearch():
+            return
+        
         doc = {
             "feed_id"           : feed_id,
             "title"             : title,
@@ -388,28 +723,45 @@ class SearchFeed:
         
     @classmethod
     def query(cls, text):
+        results = None
+        if using_elasticsearch():
+            results = cls.query_elasticsearch(text)
+        if results is None:
+            if not using_local_index():
+                return []
+            logging.info("~FGSearch ~FCfeeds~FG in the local index: ~SB%s" % text)
+            try:
+                results = LocalFeedIndex.query(text)
+            except sqlite3.Error, e:
+                logging.debug(" ***> ~FRLocal search index error: %s" % e)
+                return []
+        
+        return results
+    
+    @classmethod
+    def query_elasticsearch(cls, text):
         try:
             cls.ES.default_indices = cls.index_name()
             cls.ES.indices.refresh()
-        except pyes.exceptions.NoServerAvailable:
-            logging.debug(" ***> ~FRNo search server available.")
-            return []
-        
-        logging.info("~FGSearch ~FCfeeds~FG by address: ~SB%s" % text)
-        q = MatchQuery('address', text, operator="and", type="phrase")
-        results = cls.ES.search(query=q, sort="num_subscribers:desc", size=5,
-                                doc_types=[cls.type_name()])
-
-        if not results.total:
-            logging.info("~FGSearch ~FCfeeds~FG by title: ~SB%s" % text)
-            q = MatchQuery('title', text, operator="and")
-            results = cls.ES.search(query=q, sort="num_subscribers:desc", size=5,
-                                    doc_types=[cls.type_name()])
             
-        if not results.total:
-            logging.info("~FGSearch ~FCfeeds~FG by link: ~SB%s" % text)
-            q = MatchQuery('link', text, operator="and")
+            logging.info("~FGSearch ~FCfeeds~FG by address: ~SB%s" % text)
+            q = MatchQuery('address', text, operator="and", type="phrase")
             results = cls.ES.search(query=q, sort="num_subscribers:desc", size=5,
                                     doc_types=[cls.type_name()])
+
+            if not results.total:
+                logging.info("~FGSearch ~FCfeeds~FG by title: ~SB%s" % text)
+                q = MatchQuery('title', text, operator="and")
+                results = cls.ES.search(query=q, sort="num_subscribers:desc", size=5,
+                                        doc_types=[cls.type_name()])
+                
+            if not results.total:
+                logging.info("~FGSearch ~FCfeeds~FG by link: ~SB%s" % text)
+                q = MatchQuery('link', text, operator="and")
+                results = cls.ES.search(query=q, sort="num_subscribers:desc", size=5,
+                                        doc_types=[cls.type_name()])
+        except pyes.exceptions.NoServerAvailable:
+            logging.debug(" ***> ~FRNo search server available.")
+            return
             
         return results
@@ -171,11 +171,16 @@ class MSocialProfile(mongo.Document):
             self.custom_css = strip_tags(self.custom_css)
             
         super(MSocialProfile, self).save(*args, **kwargs)
+        self.clear_compact_profile()
         if self.user_id not in self.following_user_ids:
             self.follow_user(self.user_id, force=True)
             self.count_follows()
         
         return self
+    
+    def delete(self, *args, **kwargs):
+        self.clear_compact_profile()
+        super(MSocialProfile, self).delete(*args, **kwargs)
             
     @property
     def blurblog_url(self):
@@ -278,6 +283,33 @@ class MSocialProfile(mongo.Document):
         profiles = cls.objects.filter(user_id__in=user_ids)
         return profiles
 
+    @classmethod
+    def compact_profiles(cls, user_ids):
+        """The same profiles as `canonical(compact=True)`, kept in redis so story
+           lists don't have to load and build every profile they mention."""
+        user_ids = list(set(user_ids))
+        if not user_ids:
+            return []
+        r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        cached_profiles = r.mget(["PC:%s" % user_id for user_id in user_ids])
+        profiles = [json.decode(profile) for profile in cached_profiles if profile]
+        missing_user_ids = [user_id for user_id, profile in zip(user_ids, cached_profiles)
+                            if not profile]
+        if missing_user_ids:
+            pipeline = r.pipeline()
+            for profile in cls.objects.filter(user_id__in=missing_user_ids):
+                params = profile.canonical(compact=True)
+                profiles.append(params)
+                pipeline.set("PC:%s" % profile.user_id, json.encode(params))
+                pipeline.expire("PC:%s" % profile.user_id, settings.COMPACT_PROFILE_EXPIRE*60*60*24)
+            pipeline.execute()
+        
+        return profiles
+    
+    def clear_compact_profile(self):
+        r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        r.delete("PC:%s" % self.user_id)
+        
     @classmethod
     def profile_feeds(cls, user_ids):
         profiles = cls.objects.filter(user_id__in=user_ids)
@@ -1811,8 +1843,7 @@ class MSharedStory(mongo.Document):
         profile_user_ids = profile_user_ids.union(comment['liking_users'])
         if comment['source_user_id']:
             profile_user_ids.add(comment['source_user_id'])
-        profiles = MSocialProfile.objects.filter(user_id__in=list(profile_user_ids))
-        profiles = [profile.canonical(compact=True) for profile in profiles]
+        profiles = MSocialProfile.compact_profiles(profile_user_ids)
 
         return comment, profiles
         
@@ -1821,22 +1852,59 @@ class MSharedStory(mongo.Document):
         r = redis.Redis(connection_pool=settings.REDIS_POOL)
         friend_key = "F:%s:F" % (user_id)
         profile_user_ids = set()
-        for story in stories: 
+        
+        # Every story's comment and share sets, in one round trip.
+        pipeline = r.pipeline()
+        for story in stories:
+            if check_all or story['comment_count']:
+                comment_key = "C:%s:%s" % (story['story_feed_id'], story['guid_hash'])
+                pipeline.scard(comment_key)
+                pipeline.sinter(comment_key, friend_key)
+                pipeline.smembers(comment_key)
+            if check_all or story['share_count']:
+                share_key = "S:%s:%s" % (story['story_feed_id'], story['guid_hash'])
+                pipeline.scard(share_key)
+                pipeline.sinter(share_key, friend_key)
+                pipeline.sdiff(share_key, friend_key)
+        results = iter(pipeline.execute())
+        
+        story_comments = {}
+        story_shares = {}
+        for s, story in enumerate(stories):
+            if check_all or story['comment_count']:
+                comment_count, friends_with_comments, sharer_user_ids = next(results), next(results), next(results)
+                story_comments[s] = (comment_count,
+                                     [int(f) for f in friends_with_comments],
+                                     [int(f) for f in sharer_user_ids])
+            if check_all or story['share_count']:
+                share_count, friends_with_shares, nonfriend_user_ids = next(results), next(results), next(results)
+                story_shares[s] = (share_count,
+                                   [int(f) for f in friends_with_shares],
+                                   [int(f) for f in nonfriend_user_ids])
+        
+        # Every commented story's shared stories, in one query.
+        sharers = set((stories[s]['story_hash'], sharer_user_id)
+                      for s, (_, _, sharer_user_ids) in story_comments.items()
+                      for sharer_user_id in sharer_user_ids)
+        shared_stories_by_hash = defaultdict(list)
+        if sharers:
+            params = {
+                'story_hash__in': list(set(story_hash for story_hash, _ in sharers)),
+                'user_id__in': list(set(sharer_user_id for _, sharer_user_id in sharers)),
+            }
+            for shared_story in cls.objects.filter(**params):
+                if (shared_story.story_hash, shared_story.user_id) in sharers:
+                    shared_stories_by_hash[shared_story.story_hash].append(shared_story)
+        
+        for s, story in enumerate(stories):
             story['friend_comments'] = []
             story['public_comments'] = []
             story['reply_count'] = 0
-            if check_all or story['comment_count']:
-                comment_key = "C:%s:%s" % (story['story_feed_id'], story['guid_hash'])
-                story['comment_count'] = r.scard(comment_key)
-                friends_with_comments = [int(f) for f in r.sinter(comment_key, friend_key)]
-                sharer_user_ids = [int(f) for f in r.smembers(comment_key)]
+            if s in story_comments:
+                story['comment_count'], friends_with_comments, sharer_user_ids = story_comments[s]
                 shared_stories = []
                 if sharer_user_ids:
-                    params = {
-                        'story_hash': story['story_hash'],
-                        'user_id__in': sharer_user_ids,
-                    }
-                    shared_stories = cls.objects.filter(**params)
+                    shared_stories = shared_stories_by_hash[story['story_hash']]
                 for shared_story in shared_stories:
                     comments = shared_story.comments_with_author()
                     story['reply_count'] += len(comments['replies'])
@@ -1857,11 +1925,8 @@ class MSharedStory(mongo.Document):
                 story['comment_count_friends'] = len(friends_with_comments)
                 story['comment_count_public'] = story['comment_count'] - len(friends_with_comments)
                 
-            if check_all or story['share_count']:
-                share_key = "S:%s:%s" % (story['story_feed_id'], story['guid_hash'])
-                story['share_count'] = r.scard(share_key)
-                friends_with_shares = [int(f) for f in r.sinter(share_key, friend_key)]
-                nonfriend_user_ids = [int(f) for f in r.sdiff(share_key, friend_key)]
+            if s in story_shares:
+                story['share_count'], friends_with_shares, nonfriend_user_ids = story_shares[s]
                 profile_user_ids.update(nonfriend_user_ids)
                 profile_user_ids.update(friends_with_shares)
                 story['commented_by_public']  = [c['user_id'] for c in story['public_comments']]
@@ -1879,8 +1944,7 @@ class MSharedStory(mongo.Document):
                 if story.get('source_user_id'):
                     profile_user_ids.add(story['source_user_id'])
             
-        profiles = MSocialProfile.objects.filter(user_id__in=list(profile_user_ids))
-        profiles = [profile.canonical(compact=True) for profile in profiles]
+        profiles = MSocialProfile.compact_profiles(profile_user_ids)
         
         # Toss public comments by private profiles
         profiles_dict = dict((profile['user_id'], profile) for profile in profiles)
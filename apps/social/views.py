@@ -30,6 +30,7 @@ from utils.view_functions import render_to, is_true
 from utils.view_functions import required_params
 from utils.story_functions import format_story_link_date__short
 from utils.story_functions import format_story_link_date__long
+from utils.story_functions import StoryDateFormatter
 from utils.story_functions import strip_tags
 from utils import jennyholzer
 from vendor.timezones.utilities import localtime_for_timezone
@@ -50,7 +51,7 @@ def load_social_stories(request, user_id, username=None):
     message        = None
     
     if page: offset = limit * (int(page) - 1)
-    now = localtime_for_timezone(datetime.datetime.now(), user.profile.timezone)
+    dates = StoryDateFormatter(user.profile.timezone)
     
     social_profile = MSocialProfile.get_user(social_user.pk)
     try:
@@ -121,13 +122,12 @@ def load_social_stories(request, user_id, username=None):
                                                    comments=story.comments))
                            for story in shared_stories])
     
-    nowtz = localtime_for_timezone(now, user.profile.timezone)
     for story in stories:
         story['social_user_id'] = social_user_id
         # story_date = localtime_for_timezone(story['story_date'], user.profile.timezone)
-        shared_date = localtime_for_timezone(story['shared_date'], user.profile.timezone)
-        story['short_parsed_date'] = format_story_link_date__short(shared_date, nowtz)
-        story['long_parsed_date'] = format_story_link_date__long(shared_date, nowtz)
+        shared_date = dates.localtime(story['shared_date'])
+        story['short_parsed_date'] = dates.short(shared_date)
+        story['long_parsed_date'] = dates.long(shared_date)
         
         story['read_status'] = 1
         if (read_filter == 'all' or query) and socialsub:
@@ -137,9 +137,8 @@ def load_social_stories(request, user_id, username=None):
 
         if story['story_hash'] in starred_stories:
             story['starred'] = True
-            starred_date = localtime_for_timezone(starred_stories[story['story_hash']]['starred_date'],
-                                                  user.profile.timezone)
-            story['starred_date'] = format_story_link_date__long(starred_date, now)
+            starred_date = dates.localtime(starred_stories[story['story_hash']]['starred_date'])
+            story['starred_date'] = dates.long(starred_date)
             story['user_tags'] = starred_stories[story['story_hash']]['user_tags']
         if story['story_hash'] in shared_stories:
             story['shared'] = True
@@ -187,7 +186,7 @@ def load_river_blurblog(request):
     read_filter       = request.REQUEST.get('read_filter', 'unread')
     relative_user_id  = request.REQUEST.get('relative_user_id', None)
     global_feed       = request.REQUEST.get('global_feed', None)
-    now               = localtime_for_timezone(datetime.datetime.now(), user.profile.timezone)
+    dates             = StoryDateFormatter(user.profile.timezone)
 
     if global_feed:
         global_user = User.objects.get(username='popular')
@@ -275,18 +274,17 @@ def load_river_blurblog(request):
         classifier_tags = []
     
     # Just need to format stories
-    nowtz = localtime_for_timezone(now, user.profile.timezone)
     for story in stories:
         story['read_status'] = 0
         if story['story_hash'] not in unread_feed_story_hashes:
             story['read_status'] = 1
-        story_date = localtime_for_timezone(story['story_date'], user.profile.timezone)
-        story['short_parsed_date'] = format_story_link_date__short(story_date, nowtz)
-        story['long_parsed_date']  = format_story_link_date__long(story_date, nowtz)
+        story_date = dates.localtime(story['story_date'])
+        story['short_parsed_date'] = dates.short(story_date)
+        story['long_parsed_date']  = dates.long(story_date)
         if story['story_hash'] in starred_stories:
             story['starred'] = True
-            starred_date = localtime_for_timezone(starred_stories[story['story_hash']]['starred_date'], user.profile.timezone)
-            story['starred_date'] = format_story_link_date__long(starred_date, now)
+            starred_date = dates.localtime(starred_stories[story['story_hash']]['starred_date'])
+            story['starred_date'] = dates.long(starred_date)
             story['user_tags'] = starred_stories[story['story_hash']]['user_tags']
         story['intelligence'] = {
             'feed':   apply_classifier_feeds(classifier_feeds, story['story_feed_id'],
@@ -297,9 +295,8 @@ def load_river_blurblog(request):
         }
         if story['story_hash'] in shared_stories:
             story['shared'] = True
-            shared_date = localtime_for_timezone(shared_stories[story['story_hash']]['shared_date'],
-                                                 user.profile.timezone)
-            story['shared_date'] = format_story_link_date__long(shared_date, now)
+            shared_date = dates.localtime(shared_stories[story['story_hash']]['shared_date'])
+            story['shared_date'] = dates.long(shared_date)
             story['shared_comments'] = strip_tags(shared_stories[story['story_hash']]['comments'])
             if (shared_stories[story['story_hash']]['shared_date'] < user.profile.unread_cutoff or 
                 story['story_hash'] not in unread_feed_story_hashes):
@@ -10,6 +10,7 @@ class RStats:
     STATS_TYPE = {
         'page_load': 'PLT',
         'feed_fetch': 'FFH',
+        'story_search': 'SSQ',
     }
     
     @classmethod
@@ -214,8 +214,20 @@ DAYS_OF_UNREAD_FREE     = 14
 # DoSH can be more, since you can up this value by N, and after N days, 
 # you can then up the DAYS_OF_UNREAD value with no impact.
 DAYS_OF_STORY_HASHES    = 30
+# Read unread story hashes from the incrementally maintained per-user index (zU:<user_id>).
+UNREAD_INDEX            = False
+# Fetch feeds around their learned weekly publishing rhythm (PR:<feed_id>), see PublishingRhythm.
+ADAPTIVE_FETCH_INTERVALS = False
 
 SUBSCRIBER_EXPIRE       = 2
+# Recount a feed's subscribers on every fetch. When off, the hourly count-subscribers
+# task recounts in bulk, and subscribing, unsubscribing and premium changes still recount.
+COUNT_SUBSCRIBERS_ON_FETCH = True
+# Days a compact profile (PC:<user_id>) is cached for story lists. Saving a profile clears it.
+COMPACT_PROFILE_EXPIRE  = 1
+# Serve load_feeds from a per-user cached feed list (LF:<user_id>), and only what
+# changed when clients send the version they last loaded. See RUserFeedList.
+FEED_LIST_CACHE         = False
 
 AUTH_PROFILE_MODULE     = 'newsblur.UserProfile'
 TEST_DATABASE_COLLATION = 'utf8_general_ci'
@@ -434,6 +446,11 @@ CELERYBEAT_SCHEDULE = {
         'schedule': datetime.timedelta(minutes=5),
         'options': {'queue': 'beat_tasks'},
     },
+    'count-subscribers': {
+        'task': 'count-subscribers',
+        'schedule': datetime.timedelta(hours=1),
+        'options': {'queue': 'beat_tasks'},
+    },
 }
 
 # =========
@@ -498,6 +515,18 @@ SESSION_REDIS_DB = 5
 
 ELASTICSEARCH_FEED_HOSTS = ['db_search_feed:9200']
 ELASTICSEARCH_STORY_HOSTS = ['db_search_story:9200']
+# Story and feed search go to Elasticsearch, or to the embedded index on this
+# host's disk with 'local'. With SEARCH_LOCAL_FALLBACK, everything indexed is
+# also written to the embedded index, which answers when Elasticsearch can't.
+SEARCH_BACKEND          = 'elasticsearch'
+SEARCH_LOCAL_FALLBACK   = False
+SEARCH_LOCAL_INDEX_DIR  = os.path.join(NEWSBLUR_DIR, 'search_index')
+# Serve feed autocomplete from an in-process prefix index, loaded from the
+# snapshot at FEED_AUTOCOMPLETE_SNAPSHOT and rebuilt from the feeds table when
+# it's older than FEED_AUTOCOMPLETE_REBUILD hours. See FeedPrefixIndex.
+FEED_AUTOCOMPLETE           = False
+FEED_AUTOCOMPLETE_SNAPSHOT  = os.path.join(SEARCH_LOCAL_INDEX_DIR, 'feed_autocomplete.snapshot')
+FEED_AUTOCOMPLETE_REBUILD   = 6
 
 # ===============
 # = Social APIs =
@@ -1,17 +1,24 @@
 import time
 import datetime
+import hashlib
 import traceback
 import multiprocessing
+import threading
 import urllib2
 import xml.sax
 import redis
 import random
 import pymongo
+import calendar
+import Queue
+import requests
+from StringIO import StringIO
+from email.utils import formatdate
 from django.conf import settings
 from django.db import IntegrityError
 from django.core.cache import cache
 from apps.reader.models import UserSubscription
-from apps.rss_feeds.models import Feed, MStory
+from apps.rss_feeds.models import Feed, MStory, MFetchHistory
 from apps.rss_feeds.page_importer import PageImporter
 from apps.rss_feeds.icon_importer import IconImporter
 from apps.push.models import PushSubscription
@@ -27,7 +34,7 @@ from utils.feed_functions import timelimit, TimeoutError, utf8encode, cache_bust
 # Refresh feed code adapted from Feedjack.
 # http://feedjack.googlecode.com
 
-FEED_OK, FEED_SAME, FEED_ERRPARSE, FEED_ERRHTTP, FEED_ERREXC = range(5)
+FEED_OK, FEED_SAME, FEED_ERRPARSE, FEED_ERRHTTP, FEED_ERREXC, FEED_UNCHANGED = range(6)
 
 def mtime(ttime):
     """ datetime auxiliar function.
@@ -36,24 +43,24 @@ def mtime(ttime):
     
     
 class FetchFeed:
-    def __init__(self, feed_id, options):
-        self.feed = Feed.get_by_id(feed_id)
+    def __init__(self, feed_id, options, feed=None):
+        self.feed = feed or Feed.get_by_id(feed_id)
         self.options = options
         self.fpf = None
+        self.content_hash = None
     
-    @timelimit(20)
-    def fetch(self):
-        """ 
-        Uses feedparser to download the feed. Will be parsed later.
-        """
-        start = time.time()
-        identity = self.get_identity()
-        log_msg = u'%2s ---> [%-30s] ~FYFetching feed (~FB%d~FY), last update: %s' % (identity,
-                                                            self.feed.title[:30],
-                                                            self.feed.id,
-                                                            datetime.datetime.now() - self.feed.last_update)
-        logging.debug(log_msg)
-                                                 
+    @property
+    def user_agent(self):
+        return ('NewsBlur Feed Fetcher - %s subscriber%s - %s '
+                '(Mozilla/5.0 (Macintosh; Intel Mac OS X 10_7_1) '
+                'AppleWebKit/534.48.3 (KHTML, like Gecko) Version/5.1 '
+                'Safari/534.48.3)' % (
+                    self.feed.num_subscribers,
+                    's' if self.feed.num_subscribers != 1 else '',
+                    self.feed.permalink,
+               ))
+    
+    def request_params(self):
         etag=self.feed.etag
         modified = self.feed.last_modified.utctimetuple()[:7] if self.feed.last_modified else None
         address = self.feed.feed_address
@@ -68,14 +75,22 @@ class FetchFeed:
             modified = None
             etag = None
         
-        USER_AGENT = ('NewsBlur Feed Fetcher - %s subscriber%s - %s '
-                      '(Mozilla/5.0 (Macintosh; Intel Mac OS X 10_7_1) '
-                      'AppleWebKit/534.48.3 (KHTML, like Gecko) Version/5.1 '
-                      'Safari/534.48.3)' % (
-                          self.feed.num_subscribers,
-                          's' if self.feed.num_subscribers != 1 else '',
-                          self.feed.permalink,
-                     ))
+        return address, etag, modified
+        
+    @timelimit(20)
+    def fetch(self):
+        """ 
+        Uses feedparser to download the feed. Will be parsed later.
+        """
+        start = time.time()
+        identity = self.get_identity()
+        log_msg = u'%2s ---> [%-30s] ~FYFetching feed (~FB%d~FY), last update: %s' % (identity,
+                                                            self.feed.title[:30],
+                                                            self.feed.id,
+                                                            datetime.datetime.now() - self.feed.last_update)
+        logging.debug(log_msg)
+        
+        USER_AGENT = self.user_agent
         if self.options.get('feed_xml'):
             logging.debug(u'   ---> [%-30s] ~FM~BKFeed has been fat pinged. Ignoring fat: %s' % (
                           self.feed.title[:30], len(self.options.get('feed_xml'))))
@@ -85,12 +100,38 @@ class FetchFeed:
             logging.debug(u'   ---> [%-30s] ~FM~BKFeed fetched in real-time with fat ping.' % (
                           self.feed.title[:30]))
             return FEED_OK, self.fpf
-
+        
+        prefetcher = self.options.get('prefetcher')
+        if prefetcher:
+            response = prefetcher.response(self.feed.pk)
+            if response is not None:
+                if response.status_code == 200 and self.content_unchanged(response.content):
+                    return FEED_UNCHANGED, None
+                self.fpf = prefetcher.parse_response(response)
+                self.fpf['content_hash'] = self.content_hash
+                logging.debug(u'   ---> [%-30s] ~FYFeed prefetched, parsed in ~FM%.4ss' % (
+                              self.feed.title[:30], time.time() - start))
+                return FEED_OK, self.fpf
+        
+        address, etag, modified = self.request_params()
         try:
-            self.fpf = feedparser.parse(address,
+            try:
+                response = feedparser._open_resource(address, etag, modified, USER_AGENT,
+                                                     None, [], {})
+                content = response.read()
+            except Exception, e:
+                # Let feedparser fetch it again and report the error the usual way.
+                response = address
+            else:
+                if getattr(response, 'status', 200) == 200 and self.content_unchanged(content):
+                    response.close()
+                    return FEED_UNCHANGED, None
+                response.read = lambda: content
+            self.fpf = feedparser.parse(response,
                                         agent=USER_AGENT,
                                         etag=etag,
                                         modified=modified)
+            self.fpf['content_hash'] = self.content_hash
         except (TypeError, ValueError, KeyError, EOFError), e:
             logging.debug(u'   ***> [%-30s] ~FR%s, turning off headers.' % 
                           (self.feed.title[:30], e))
@@ -104,6 +145,25 @@ class FetchFeed:
                       self.feed.title[:30], time.time() - start))
 
         return FEED_OK, self.fpf
+    
+    def content_unchanged(self, content):
+        """
+        True when the feed body is byte for byte the last one that was fully
+        processed, which many servers send instead of a 304. Parsing, story
+        matching and all of the saving that follows are then skipped.
+        """
+        self.content_hash = hashlib.sha1(content).hexdigest()
+        if self.options.get('force'):
+            return False
+        
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+        if r.get('FC:%s' % self.feed.pk) != self.content_hash:
+            return False
+        
+        logging.debug(u'   ---> [%-30s] ~FBFeed content unchanged (~SB%s bytes~SN), skipping parse' % (
+                      self.feed.title[:30], len(content)))
+        self.feed.save_feed_history(208, "Unchanged content")
+        return True
         
     def get_identity(self):
         identity = "X"
@@ -292,6 +352,12 @@ class ProcessFeed:
             self.feed.expire_redis()
         self.feed.save_feed_history(200, "OK")
         
+        # Only remember the body once it's been processed, so a failure here gets retried.
+        if self.fpf.get('content_hash'):
+            r = redis.Redis(connection_pool=settings.REDIS_FEED_POOL)
+            r.set('FC:%s' % self.feed.pk, self.fpf['content_hash'])
+            r.expire('FC:%s' % self.feed.pk, 60*60*24*7)
+        
         if self.options['verbose']:
             logging.debug(u'   ---> [%-30s] ~FBTIME: feed parse in ~FM%.4ss' % (
                           self.feed.title[:30], time.time() - start))
@@ -299,6 +365,131 @@ class ProcessFeed:
         return FEED_OK, ret_values
 
         
+class FeedPrefetcher:
+    """
+    Keeps many feed downloads in flight for a worker's queue of feeds, reusing
+    keep-alive connections per host. Bodies are buffered until FetchFeed asks
+    for them, in queue order, and are then parsed on the worker's own thread.
+    """
+    
+    def __init__(self, feed_ids, options):
+        self.feed_ids = list(feed_ids)
+        self.options = options
+        self.concurrency = int(options.get('concurrency') or 100)
+        self.timeout = options.get('timeout') or 10
+        self.queue = Queue.Queue()
+        self.responses = {}
+        self.finished = {}
+        self.positions = dict((feed_id, i) for i, feed_id in enumerate(self.feed_ids))
+        self.cursor = 0
+        self.buffered = threading.BoundedSemaphore(self.concurrency * 2)
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.concurrency,
+                                                pool_maxsize=max(4, self.concurrency / 10))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+    
+    def start(self):
+        feeds = dict((f.pk, f) for f in Feed.objects.filter(pk__in=self.feed_ids))
+        for feed_id in self.feed_ids:
+            feed = feeds.get(feed_id)
+            if not feed:
+                continue
+            ffeed = FetchFeed(feed.pk, self.options, feed=feed)
+            address, etag, modified = ffeed.request_params()
+            headers = {
+                'User-Agent': ffeed.user_agent,
+                'Accept-Encoding': 'gzip, deflate',
+            }
+            if etag:
+                headers['If-None-Match'] = etag
+            if modified:
+                headers['If-Modified-Since'] = formatdate(calendar.timegm(modified), usegmt=True)
+            self.finished[feed.pk] = threading.Event()
+            self.queue.put((feed.pk, address, headers))
+        
+        for _ in range(min(self.concurrency, len(self.finished))):
+            worker = threading.Thread(target=self.download_feeds)
+            worker.setDaemon(True)
+            worker.start()
+        
+        logging.debug(u'   ---> ~FBPrefetching ~SB%s~SN feeds with ~SB%s~SN connections...' % (
+                      len(self.finished), self.concurrency))
+        
+        return self
+    
+    def download_feeds(self):
+        while True:
+            try:
+                feed_id, address, headers = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            
+            self.buffered.acquire()
+            try:
+                response = self.session.get(address, headers=headers, timeout=self.timeout)
+                with self.lock:
+                    self.responses[feed_id] = response
+            except Exception, e:
+                logging.debug(u'   ***> [%-30s] ~FRPrefetch failed, fetching inline: %s' % (feed_id, e))
+                self.buffered.release()
+            finally:
+                self.finished[feed_id].set()
+    
+    def discard(self, feed_id):
+        with self.lock:
+            if self.responses.pop(feed_id, None) is not None:
+                self.buffered.release()
+    
+    def parse(self, feed_id, timeout=10):
+        """
+        Returns a feedparser result for a prefetched feed, or None if the feed
+        wasn't prefetched or didn't download in time (fetch it inline instead).
+        """
+        response = self.response(feed_id, timeout=timeout)
+        if response is None:
+            return None
+        
+        return self.parse_response(response)
+    
+    def response(self, feed_id, timeout=10):
+        """The prefetched response for a feed, unparsed, or None as in `parse`."""
+        finished = self.finished.get(feed_id)
+        if not finished or not finished.wait(timeout):
+            return None
+        
+        # Feeds earlier in the queue that were skipped will never be parsed.
+        position = self.positions.get(feed_id, 0)
+        for skipped_feed_id in self.feed_ids[self.cursor:position]:
+            self.discard(skipped_feed_id)
+        self.cursor = max(self.cursor, position + 1)
+        
+        with self.lock:
+            response = self.responses.pop(feed_id, None)
+        if response is None:
+            return None
+        self.buffered.release()
+        
+        return response
+    
+    def parse_response(self, response):
+        if response.status_code == 304:
+            return feedparser.FeedParserDict(status=304, href=response.url, bozo=0,
+                                             feed=feedparser.FeedParserDict(), entries=[])
+        
+        # Requests has already decoded gzip/deflate, so don't let feedparser try again.
+        headers = dict((k, v) for k, v in response.headers.items()
+                       if k.lower() not in ('content-encoding', 'content-length', 'transfer-encoding'))
+        fpf = feedparser.parse(StringIO(response.content), response_headers=headers)
+        fpf['href'] = response.url
+        fpf['status'] = response.status_code
+        if response.history and response.history[0].status_code == 301:
+            fpf['status'] = 301
+        
+        return fpf
+
+
 class Dispatcher:
     def __init__(self, options, num_threads):
         self.options = options
@@ -307,13 +498,15 @@ class Dispatcher:
             FEED_SAME:0,
             FEED_ERRPARSE:0,
             FEED_ERRHTTP:0,
-            FEED_ERREXC:0}
+            FEED_ERREXC:0,
+            FEED_UNCHANGED:0}
         self.feed_trans = {
             FEED_OK:'ok',
             FEED_SAME:'unchanged',
             FEED_ERRPARSE:'cant_parse',
             FEED_ERRHTTP:'http_error',
-            FEED_ERREXC:'exception'}
+            FEED_ERREXC:'exception',
+            FEED_UNCHANGED:'unchanged_content'}
         self.feed_keys = sorted(self.feed_trans.keys())
         self.num_threads = num_threads
         self.time_start = datetime.datetime.utcnow()
@@ -331,197 +524,218 @@ class Dispatcher:
         
         if current_process._identity:
             identity = current_process._identity[0]
-            
-        for feed_id in feed_queue:
-            start_duration = time.time()
-            feed_fetch_duration = None
-            feed_process_duration = None
-            page_duration = None
-            icon_duration = None
-            feed_code = None
-            ret_entries = None
-            start_time = time.time()
-            ret_feed = FEED_ERREXC
-            try:
-                feed = self.refresh_feed(feed_id)
+        
+        queue_start = time.time()
+        fetch_mode = self.options.get('fetch_mode') or 'serial'
+        if (fetch_mode == 'concurrent' and len(feed_queue) > 1 and
+            not self.options.get('prefetcher')):
+            self.options['prefetcher'] = FeedPrefetcher(feed_queue, self.options).start()
+        if len(feed_queue) > 1:
+            MFetchHistory.start_batch()
+        
+        try:
+            for feed_id in feed_queue:
+                start_duration = time.time()
+                feed_fetch_duration = None
+                feed_process_duration = None
+                page_duration = None
+                icon_duration = None
+                feed_code = None
+                ret_entries = None
+                start_time = time.time()
+                ret_feed = FEED_ERREXC
+                try:
+                    feed = self.refresh_feed(feed_id)
                 
-                skip = False
-                if self.options.get('fake'):
-                    skip = True
-                    weight = "-"
-                    quick = "-"
-                    rand = "-"
-                elif (self.options.get('quick') and not self.options['force'] and 
-                      feed.known_good and feed.fetched_once and not feed.is_push):
-                    weight = feed.stories_last_month * feed.num_subscribers
-                    random_weight = random.randint(1, max(weight, 1))
-                    quick = float(self.options.get('quick', 0))
-                    rand = random.random()
-                    if random_weight < 100 and rand < quick:
+                    skip = False
+                    if self.options.get('fake'):
                         skip = True
-                elif False and feed.feed_address.startswith("http://news.google.com/news"):
-                    skip = True
-                    weight = "-"
-                    quick = "-"
-                    rand = "-"
-                if skip:
-                    logging.debug('   ---> [%-30s] ~BGFaking fetch, skipping (%s/month, %s subs, %s < %s)...' % (
-                        feed.title[:30],
-                        weight,
-                        feed.num_subscribers,
-                        rand, quick))
-                    continue
+                        weight = "-"
+                        quick = "-"
+                        rand = "-"
+                    elif (self.options.get('quick') and not self.options['force'] and 
+                          feed.known_good and feed.fetched_once and not feed.is_push):
+                        weight = feed.stories_last_month * feed.num_subscribers
+                        random_weight = random.randint(1, max(weight, 1))
+                        quick = float(self.options.get('quick', 0))
+                        rand = random.random()
+                        if random_weight < 100 and rand < quick:
+                            skip = True
+                    elif False and feed.feed_address.startswith("http://news.google.com/news"):
+                        skip = True
+                        weight = "-"
+                        quick = "-"
+                        rand = "-"
+                    if skip:
+                        logging.debug('   ---> [%-30s] ~BGFaking fetch, skipping (%s/month, %s subs, %s < %s)...' % (
+                            feed.title[:30],
+                            weight,
+                            feed.num_subscribers,
+                            rand, quick))
+                        if self.options.get('prefetcher'):
+                            self.options['prefetcher'].discard(feed.pk)
+                        continue
                     
-                ffeed = FetchFeed(feed_id, self.options)
-                ret_feed, fetched_feed = ffeed.fetch()
-                feed_fetch_duration = time.time() - start_duration
+                    ffeed = FetchFeed(feed_id, self.options)
+                    ret_feed, fetched_feed = ffeed.fetch()
+                    feed_fetch_duration = time.time() - start_duration
                 
-                if ((fetched_feed and ret_feed == FEED_OK) or self.options['force']):
-                    pfeed = ProcessFeed(feed_id, fetched_feed, self.options)
-                    ret_feed, ret_entries = pfeed.process()
-                    feed = pfeed.feed
-                    feed_process_duration = time.time() - start_duration
+                    if ((fetched_feed and ret_feed == FEED_OK) or self.options['force']):
+                        pfeed = ProcessFeed(feed_id, fetched_feed, self.options)
+                        ret_feed, ret_entries = pfeed.process()
+                        feed = pfeed.feed
+                        feed_process_duration = time.time() - start_duration
                     
-                    if (ret_entries and ret_entries['new']) or self.options['force']:
-                        start = time.time()
-                        if not feed.known_good or not feed.fetched_once:
-                            feed.known_good = True
-                            feed.fetched_once = True
-                            feed = feed.save()
-                        if self.options['force'] or random.random() <= 0.02:
-                            logging.debug('   ---> [%-30s] ~FBPerforming feed cleanup...' % (feed.title[:30],))
-                            start_cleanup = time.time()
-                            feed.sync_redis()
-                            logging.debug('   ---> [%-30s] ~FBDone with feed cleanup. Took ~SB%.4s~SN sec.' % (feed.title[:30], time.time() - start_cleanup))
-                        try:
-                            self.count_unreads_for_subscribers(feed)
-                        except TimeoutError:
-                            logging.debug('   ---> [%-30s] Unread count took too long...' % (feed.title[:30],))
-                        if self.options['verbose']:
-                            logging.debug(u'   ---> [%-30s] ~FBTIME: unread count in ~FM%.4ss' % (
-                                          feed.title[:30], time.time() - start))
-            except urllib2.HTTPError, e:
-                logging.debug('   ---> [%-30s] ~FRFeed throws HTTP error: ~SB%s' % (unicode(feed_id)[:30], e.fp.read()))
-                feed.save_feed_history(e.code, e.msg, e.fp.read())
-                fetched_feed = None
-            except Feed.DoesNotExist, e:
-                logging.debug('   ---> [%-30s] ~FRFeed is now gone...' % (unicode(feed_id)[:30]))
-                continue
-            except TimeoutError, e:
-                logging.debug('   ---> [%-30s] ~FRFeed fetch timed out...' % (feed.title[:30]))
-                feed.save_feed_history(505, 'Timeout', e)
-                feed_code = 505
-                fetched_feed = None
-            except Exception, e:
-                logging.debug('[%d] ! -------------------------' % (feed_id,))
-                tb = traceback.format_exc()
-                logging.error(tb)
-                logging.debug('[%d] ! -------------------------' % (feed_id,))
-                ret_feed = FEED_ERREXC 
-                feed = Feed.get_by_id(getattr(feed, 'pk', feed_id))
-                if not feed: continue
-                feed.save_feed_history(500, "Error", tb)
-                feed_code = 500
-                fetched_feed = None
-                # mail_feed_error_to_admin(feed, e, local_vars=locals())
-                if (not settings.DEBUG and hasattr(settings, 'RAVEN_CLIENT') and
-                    settings.RAVEN_CLIENT):
-                    settings.RAVEN_CLIENT.captureException()
-
-            if not feed_code:
-                if ret_feed == FEED_OK:
-                    feed_code = 200
-                elif ret_feed == FEED_SAME:
-                    feed_code = 304
-                elif ret_feed == FEED_ERRHTTP:
-                    feed_code = 400
-                if ret_feed == FEED_ERREXC:
-                    feed_code = 500
-                elif ret_feed == FEED_ERRPARSE:
-                    feed_code = 550
-                
-            if not feed: continue
-            feed = self.refresh_feed(feed.pk)
-            if ((self.options['force']) or 
-                (random.random() > .9) or
-                (fetched_feed and
-                 feed.feed_link and
-                 feed.has_page and
-                 (ret_feed == FEED_OK or
-                  (ret_feed == FEED_SAME and feed.stories_last_month > 10)))):
-                  
-                logging.debug(u'   ---> [%-30s] ~FYFetching page: %s' % (feed.title[:30], feed.feed_link))
-                page_importer = PageImporter(feed)
-                try:
-                    page_data = page_importer.fetch_page()
-                    page_duration = time.time() - start_duration
+                        if (ret_entries and ret_entries['new']) or self.options['force']:
+                            start = time.time()
+                            if not feed.known_good or not feed.fetched_once:
+                                feed.known_good = True
+                                feed.fetched_once = True
+                                feed = feed.save()
+                            if self.options['force'] or random.random() <= 0.02:
+                                logging.debug('   ---> [%-30s] ~FBPerforming feed cleanup...' % (feed.title[:30],))
+                                start_cleanup = time.time()
+                                feed.sync_redis()
+                                logging.debug('   ---> [%-30s] ~FBDone with feed cleanup. Took ~SB%.4s~SN sec.' % (feed.title[:30], time.time() - start_cleanup))
+                            try:
+                                self.count_unreads_for_subscribers(feed)
+                            except TimeoutError:
+                                logging.debug('   ---> [%-30s] Unread count took too long...' % (feed.title[:30],))
+                            if self.options['verbose']:
+                                logging.debug(u'   ---> [%-30s] ~FBTIME: unread count in ~FM%.4ss' % (
+                                              feed.title[:30], time.time() - start))
+                except urllib2.HTTPError, e:
+                    logging.debug('   ---> [%-30s] ~FRFeed throws HTTP error: ~SB%s' % (unicode(feed_id)[:30], e.fp.read()))
+                    feed.save_feed_history(e.code, e.msg, e.fp.read())
+                    fetched_feed = None
+                except Feed.DoesNotExist, e:
+                    logging.debug('   ---> [%-30s] ~FRFeed is now gone...' % (unicode(feed_id)[:30]))
+                    continue
                 except TimeoutError, e:
-                    logging.debug('   ---> [%-30s] ~FRPage fetch timed out...' % (feed.title[:30]))
-                    page_data = None
-                    feed.save_page_history(555, 'Timeout', '')
+                    logging.debug('   ---> [%-30s] ~FRFeed fetch timed out...' % (feed.title[:30]))
+                    feed.save_feed_history(505, 'Timeout', e)
+                    feed_code = 505
+                    fetched_feed = None
                 except Exception, e:
                     logging.debug('[%d] ! -------------------------' % (feed_id,))
                     tb = traceback.format_exc()
                     logging.error(tb)
                     logging.debug('[%d] ! -------------------------' % (feed_id,))
-                    feed.save_page_history(550, "Page Error", tb)
+                    ret_feed = FEED_ERREXC 
+                    feed = Feed.get_by_id(getattr(feed, 'pk', feed_id))
+                    if not feed: continue
+                    feed.save_feed_history(500, "Error", tb)
+                    feed_code = 500
                     fetched_feed = None
-                    page_data = None
                     # mail_feed_error_to_admin(feed, e, local_vars=locals())
                     if (not settings.DEBUG and hasattr(settings, 'RAVEN_CLIENT') and
                         settings.RAVEN_CLIENT):
                         settings.RAVEN_CLIENT.captureException()
 
+                if not feed_code:
+                    if ret_feed == FEED_OK:
+                        feed_code = 200
+                    elif ret_feed == FEED_SAME:
+                        feed_code = 304
+                    elif ret_feed == FEED_UNCHANGED:
+                        feed_code = 208
+                    elif ret_feed == FEED_ERRHTTP:
+                        feed_code = 400
+                    if ret_feed == FEED_ERREXC:
+                        feed_code = 500
+                    elif ret_feed == FEED_ERRPARSE:
+                        feed_code = 550
+                
+                if not feed: continue
                 feed = self.refresh_feed(feed.pk)
-                logging.debug(u'   ---> [%-30s] ~FYFetching icon: %s' % (feed.title[:30], feed.feed_link))
-                force = self.options['force']
-                if random.random() > .99:
-                    force = True
-                icon_importer = IconImporter(feed, page_data=page_data, force=force)
-                try:
-                    icon_importer.save()
-                    icon_duration = time.time() - start_duration
-                except TimeoutError, e:
-                    logging.debug('   ---> [%-30s] ~FRIcon fetch timed out...' % (feed.title[:30]))
-                    feed.save_page_history(556, 'Timeout', '')
-                except Exception, e:
-                    logging.debug('[%d] ! -------------------------' % (feed_id,))
-                    tb = traceback.format_exc()
-                    logging.error(tb)
-                    logging.debug('[%d] ! -------------------------' % (feed_id,))
-                    # feed.save_feed_history(560, "Icon Error", tb)
-                    # mail_feed_error_to_admin(feed, e, local_vars=locals())
-                    if (not settings.DEBUG and hasattr(settings, 'RAVEN_CLIENT') and
-                        settings.RAVEN_CLIENT):
-                        settings.RAVEN_CLIENT.captureException()
-            else:
-                logging.debug(u'   ---> [%-30s] ~FBSkipping page fetch: (%s on %s stories) %s' % (feed.title[:30], self.feed_trans[ret_feed], feed.stories_last_month, '' if feed.has_page else ' [HAS NO PAGE]'))
+                if ((self.options['force']) or 
+                    (random.random() > .9) or
+                    (fetched_feed and
+                     feed.feed_link and
+                     feed.has_page and
+                     (ret_feed == FEED_OK or
+                      (ret_feed == FEED_SAME and feed.stories_last_month > 10)))):
+                  
+                    logging.debug(u'   ---> [%-30s] ~FYFetching page: %s' % (feed.title[:30], feed.feed_link))
+                    page_importer = PageImporter(feed)
+                    try:
+                        page_data = page_importer.fetch_page()
+                        page_duration = time.time() - start_duration
+                    except TimeoutError, e:
+                        logging.debug('   ---> [%-30s] ~FRPage fetch timed out...' % (feed.title[:30]))
+                        page_data = None
+                        feed.save_page_history(555, 'Timeout', '')
+                    except Exception, e:
+                        logging.debug('[%d] ! -------------------------' % (feed_id,))
+                        tb = traceback.format_exc()
+                        logging.error(tb)
+                        logging.debug('[%d] ! -------------------------' % (feed_id,))
+                        feed.save_page_history(550, "Page Error", tb)
+                        fetched_feed = None
+                        page_data = None
+                        # mail_feed_error_to_admin(feed, e, local_vars=locals())
+                        if (not settings.DEBUG and hasattr(settings, 'RAVEN_CLIENT') and
+                            settings.RAVEN_CLIENT):
+                            settings.RAVEN_CLIENT.captureException()
+
+                    feed = self.refresh_feed(feed.pk)
+                    logging.debug(u'   ---> [%-30s] ~FYFetching icon: %s' % (feed.title[:30], feed.feed_link))
+                    force = self.options['force']
+                    if random.random() > .99:
+                        force = True
+                    icon_importer = IconImporter(feed, page_data=page_data, force=force)
+                    try:
+                        icon_importer.save()
+                        icon_duration = time.time() - start_duration
+                    except TimeoutError, e:
+                        logging.debug('   ---> [%-30s] ~FRIcon fetch timed out...' % (feed.title[:30]))
+                        feed.save_page_history(556, 'Timeout', '')
+                    except Exception, e:
+                        logging.debug('[%d] ! -------------------------' % (feed_id,))
+                        tb = traceback.format_exc()
+                        logging.error(tb)
+                        logging.debug('[%d] ! -------------------------' % (feed_id,))
+                        # feed.save_feed_history(560, "Icon Error", tb)
+                        # mail_feed_error_to_admin(feed, e, local_vars=locals())
+                        if (not settings.DEBUG and hasattr(settings, 'RAVEN_CLIENT') and
+                            settings.RAVEN_CLIENT):
+                            settings.RAVEN_CLIENT.captureException()
+                else:
+                    logging.debug(u'   ---> [%-30s] ~FBSkipping page fetch: (%s on %s stories) %s' % (feed.title[:30], self.feed_trans[ret_feed], feed.stories_last_month, '' if feed.has_page else ' [HAS NO PAGE]'))
             
-            feed = self.refresh_feed(feed.pk)
-            delta = time.time() - start_time
+                feed = self.refresh_feed(feed.pk)
+                delta = time.time() - start_time
             
-            feed.last_load_time = round(delta)
-            feed.fetched_once = True
-            try:
-                feed = feed.save()
-            except IntegrityError:
-                logging.debug("   ---> [%-30s] ~FRIntegrityError on feed: %s" % (feed.title[:30], feed.feed_address,))
+                feed.last_load_time = round(delta)
+                feed.fetched_once = True
+                try:
+                    feed = feed.save()
+                except IntegrityError:
+                    logging.debug("   ---> [%-30s] ~FRIntegrityError on feed: %s" % (feed.title[:30], feed.feed_address,))
             
-            if ret_entries and ret_entries['new']:
-                self.publish_to_subscribers(feed)
+                if ret_entries and ret_entries['new']:
+                    self.publish_to_subscribers(feed)
                 
-            done_msg = (u'%2s ---> [%-30s] ~FYProcessed in ~FM~SB%.4ss~FY~SN (~FB%s~FY) [%s]' % (
-                identity, feed.title[:30], delta,
-                feed.pk, self.feed_trans[ret_feed],))
-            logging.debug(done_msg)
-            total_duration = time.time() - start_duration
-            MAnalyticsFetcher.add(feed_id=feed.pk, feed_fetch=feed_fetch_duration,
-                                  feed_process=feed_process_duration, 
-                                  page=page_duration, icon=icon_duration,
-                                  total=total_duration, feed_code=feed_code)
+                done_msg = (u'%2s ---> [%-30s] ~FYProcessed in ~FM~SB%.4ss~FY~SN (~FB%s~FY) [%s]' % (
+                    identity, feed.title[:30], delta,
+                    feed.pk, self.feed_trans[ret_feed],))
+                logging.debug(done_msg)
+                total_duration = time.time() - start_duration
+                MAnalyticsFetcher.add(feed_id=feed.pk, feed_fetch=feed_fetch_duration,
+                                      feed_process=feed_process_duration, 
+                                      page=page_duration, icon=icon_duration,
+                                      total=total_duration, feed_code=feed_code)
+            
+                self.feed_stats[ret_feed] += 1
+        finally:
+            MFetchHistory.flush_batch()
+
+        if len(feed_queue) > 1:
+            queue_duration = time.time() - queue_start
+            logging.debug(u'%2s ---> ~FBFetched ~SB%s~SN feeds in ~SB%.4s~SN sec (~SB%.4s~SN feeds/sec, %s)' % (
+                          identity, len(feed_queue), queue_duration,
+                          len(feed_queue) / max(queue_duration, .001), fetch_mode))
             
-            self.feed_stats[ret_feed] += 1
-                
         if len(feed_queue) == 1:
             return feed
         
@@ -540,45 +754,48 @@ class Dispatcher:
         user_subs = UserSubscription.objects.filter(feed=feed, 
                                                     active=True,
                                                     user__profile__last_seen_on__gte=feed.unread_cutoff)\
+                                            .select_related('user__profile')\
                                             .order_by('-last_read_date')
         
         if not user_subs.count():
             return
             
-        for sub in user_subs:
-            if not sub.needs_unread_recalc:
-                sub.needs_unread_recalc = True
-                sub.save()
+        user_subs.filter(needs_unread_recalc=False).update(needs_unread_recalc=True)
 
         if self.options['compute_scores']:
             r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
-            stories = MStory.objects(story_feed_id=feed.pk,
-                                     story_date__gte=feed.unread_cutoff)
-            stories = Feed.format_stories(stories, feed.pk)
+            # Sizing the stories encodes each one again, so it's only done when verbose.
+            scoring_stats = {} if self.options['verbose'] else None
+            stories = list(MStory.scoring_stories(feed_id=feed.pk, stats=scoring_stats,
+                                                  story_feed_id=feed.pk,
+                                                  story_date={'$gte': feed.unread_cutoff},
+                                                  sort=[('story_date', -1)]))
             story_hashes = r.zrangebyscore('zF:%s' % feed.pk, int(feed.unread_cutoff.strftime('%s')),
                                            int(time.time() + 60*60*24))
             missing_story_hashes = set(story_hashes) - set([s['story_hash'] for s in stories])
             if missing_story_hashes:
-                missing_stories = MStory.objects(story_feed_id=feed.pk,
-                                                 story_hash__in=missing_story_hashes)\
-                                        .read_preference(pymongo.ReadPreference.PRIMARY)
-                missing_stories = Feed.format_stories(missing_stories, feed.pk)
+                missing_stories = list(MStory.scoring_stories(missing_story_hashes, feed_id=feed.pk,
+                                                              stats=scoring_stats,
+                                                              story_feed_id=feed.pk,
+                                                              sort=[('story_date', -1)],
+                                                              read_preference=pymongo.ReadPreference.PRIMARY))
                 stories = missing_stories + stories
                 logging.debug(u'   ---> [%-30s] ~FYFound ~SB~FC%s(of %s)/%s~FY~SN un-secondaried stories while computing scores' % (feed.title[:30], len(missing_stories), len(missing_story_hashes), len(stories)))
             cache.set("S:%s" % feed.pk, stories, 60)
-            logging.debug(u'   ---> [%-30s] ~FYComputing scores: ~SB%s stories~SN with ~SB%s subscribers ~SN(%s/%s/%s)' % (
-                          feed.title[:30], len(stories), user_subs.count(),
+            stories_size = " (%.1fKB)" % (scoring_stats['bytes'] / 1024.0) if scoring_stats else ""
+            logging.debug(u'   ---> [%-30s] ~FYComputing scores: ~SB%s stories~SN%s with ~SB%s subscribers ~SN(%s/%s/%s)' % (
+                          feed.title[:30], len(stories), stories_size, user_subs.count(),
                           feed.num_subscribers, feed.active_subscribers, feed.premium_subscribers))        
-            self.calculate_feed_scores_with_stories(user_subs, stories)
+            self.calculate_feed_scores_with_stories(feed, user_subs, stories)
         elif self.options.get('mongodb_replication_lag'):
             logging.debug(u'   ---> [%-30s] ~BR~FYSkipping computing scores: ~SB%s seconds~SN of mongodb lag' % (
               feed.title[:30], self.options.get('mongodb_replication_lag')))
     
     @timelimit(10)
-    def calculate_feed_scores_with_stories(self, user_subs, stories):
-        for sub in user_subs:
-            silent = False if self.options['verbose'] >= 2 else True
-            sub.calculate_feed_scores(silent=silent, stories=stories)
+    def calculate_feed_scores_with_stories(self, feed, user_subs, stories):
+        silent = False if self.options['verbose'] >= 2 else True
+        UserSubscription.calculate_feed_scores_for_subscribers(feed, user_subs, stories=stories,
+                                                               silent=silent)
             
     def add_jobs(self, feeds_queue, feeds_count=1):
         """ adds a feed processing job to the pool
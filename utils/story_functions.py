@@ -2,13 +2,16 @@ import re
 import datetime
 import struct
 import dateutil
+import pytz
 from HTMLParser import HTMLParser
 from lxml.html.diff import tokenize, fixup_ins_del_tags, htmldiff_tokens
 from lxml.etree import ParserError, XMLSyntaxError
 import lxml.html, lxml.etree
 from lxml.html.clean import Cleaner
 from itertools import chain
+from django.conf import settings
 from django.utils.dateformat import DateFormat
+from django.utils.encoding import smart_str
 from django.utils.html import strip_tags as strip_tags_django
 from utils.tornado_escape import linkify as linkify_tornado
 from utils.tornado_escape import xhtml_unescape as xhtml_unescape_tornado
@@ -58,6 +61,75 @@ def format_story_link_date__long(date, now=None):
     else:
         return parsed_date.format('l, F jS, Y g:ia').replace('.','')
 
+class StoryDateFormatter(object):
+    """
+    Story dates for one request in one timezone. Converts from UTC, and gives the
+    same short and long forms as `format_story_link_date__short` and `__long`,
+    with today's, yesterday's and this month's boundaries worked out once, and
+    the day and time parts of each format kept as they're made.
+    """
+    
+    def __init__(self, timezone, now=None):
+        self.from_tz = pytz.timezone(smart_str(settings.TIME_ZONE))
+        self.to_tz = pytz.timezone(smart_str(timezone))
+        self.now = self.localtime(now or datetime.datetime.now())
+        self.midnight = midnight_today(self.now)
+        self.midnight_yesterday = midnight_yesterday(self.midnight)
+        self.beginning_of_this_month = beginning_of_this_month()
+        self._days = {}
+        self._times = {}
+    
+    def localtime(self, date):
+        """Same as `localtime_for_timezone(date, timezone)`."""
+        if not date:
+            date = datetime.datetime.now()
+        if date.tzinfo is None:
+            date = self.from_tz.localize(date)
+        return date.astimezone(self.to_tz)
+    
+    def _day(self, date, date_format, strftime=False):
+        key = (date.year, date.month, date.day, date_format)
+        if key not in self._days:
+            if strftime:
+                self._days[key] = date.strftime(date_format)
+            else:
+                self._days[key] = DateFormat(date).format(date_format)
+        return self._days[key]
+    
+    def _time(self, date):
+        key = (date.hour, date.minute)
+        if key not in self._times:
+            self._times[key] = (date.strftime('%I:%M%p').lstrip('0').lower(),
+                                DateFormat(date).format('g:ia').replace('.',''))
+        return self._times[key]
+    
+    def short(self, date):
+        date = date.replace(tzinfo=None)
+        time_short, _ = self._time(date)
+        if date >= self.midnight:
+            return time_short
+        elif date >= self.midnight_yesterday:
+            return 'Yesterday, ' + time_short
+        else:
+            return self._day(date, '%d %b %Y, ', strftime=True) + time_short
+    
+    def long(self, date):
+        date = date.replace(tzinfo=None)
+        time_short, time_long = self._time(date)
+        if date >= self.midnight:
+            return 'Today, ' + self._day(date, 'F jS ') + time_short
+        elif date >= self.midnight_yesterday:
+            return 'Yesterday, ' + self._day(date, 'F jS ').replace('.','') + time_long
+        elif date >= self.beginning_of_this_month:
+            return self._day(date, 'l, F jS ').replace('.','') + time_long
+        else:
+            return self._day(date, 'l, F jS, Y ').replace('.','') + time_long
+    
+    def story_dates(self, date):
+        """A UTC date's short and long forms, in this timezone."""
+        date = self.localtime(date)
+        return self.short(date), self.long(date)
+
 def _extract_date_tuples(date):
     parsed_date = DateFormat(date)
     date_tuple = datetime.datetime.timetuple(date)[:3]